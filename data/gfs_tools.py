@@ -16,13 +16,59 @@ gfs_dir = "/data/forecastData/gfs/"
 ############# Functions for Processing GFS grib data ############################
 
 # Define alias for aggreate_df_dict
+#   now from get_zone_frame(), split into a dataframe per station
 def get_data(gfs_dir = f'/data/forecastData/gfs/gfs.{datetime.today().strftime("%Y%m%d")}/00/atmos/',
              location_dict = {"401": (45.0, -73.25),
                               "402": (44.75, -73.25),
                               "403": (44.75, -73.25)
                              }
 ):
-    return aggregate_station_df_dict(gfs_dir=gfs_dir, location_dict=location_dict)
+    zone_frame = get_zone_frame(gfs_dir=gfs_dir, location_dict=location_dict)
+    return {station: zone_frame.xs(station, axis=1, level='zone') for station in location_dict}
+
+### get_zone_frame() - every location from every grib file, picked out of each file in one vectorized selection
+# -- gfs_dir (str) [opt]: directory of the grib files for one forecast
+# -- location_dict (dict) [opt]: zone name -> (lat, long); each zone takes the nearest grid cell, so any
+#                                number of zones (e.g. a lake wide grid of them) costs one selection per file
+# returns a dataframe indexed by time with (variable, zone) columns, variables named and ordered as calibrate_columns()
+def get_zone_frame(gfs_dir = f'/data/forecastData/gfs/gfs.{datetime.today().strftime("%Y%m%d")}/00/atmos/',
+				   location_dict = {"401": (45.0, -73.25),"402": (44.75, -73.25),"403": (44.75, -73.25)},
+				   ordered_names=['T2','TCDC','SWDOWN','U10','V10','RH2','RAIN','CPOFP'],
+				   grib_to_expected_names = {'t2m': 'T2', 'tcc':'TCDC', 'dswrf':'SWDOWN', 'u10':'U10', 'v10':'V10', 'r2':'RH2', 'prate':'RAIN', 'cpofp':'CPOFP'}):
+	zones = list(location_dict)
+	# pointwise indexers: one (lat, long) pair per zone along a new 'zone' dimension
+	lats = xr.DataArray([location_dict[zone][0] for zone in zones], dims='zone')
+	longs = xr.DataArray([location_dict[zone][1] for zone in zones], dims='zone')
+	expected_to_grib = {name: grib for grib, name in grib_to_expected_names.items()}
+
+	times = []
+	blocks = []
+	for grib_file in sorted(glob.glob(f'{gfs_dir}gfs.t00z.pgrb2.0p25.f[0-9][0-9][0-9]')):
+		grib_datasets = cfgrib.open_datasets(grib_file)
+		coords_to_drop = ["step", "atmosphere", "heightAboveGround", "surface", "time", "t"]
+		grib_datasets = [ds.drop_vars(coords_to_drop, errors='ignore') for ds in grib_datasets]
+		# the averaged cloud cover and precip rate are duplicates of the instantaneous ones
+		grib_datasets = [ds for ds in grib_datasets
+						 if not any((var_name == 'tcc' and var.attrs.get('GRIB_stepType') == 'avg' and var.attrs.get('GRIB_typeOfLevel') == 'atmosphere') or
+									(var_name == 'prate' and var.attrs.get('GRIB_stepType') == 'avg' and var.attrs.get('GRIB_typeOfLevel') == 'surface')
+									for var_name, var in ds.variables.items())]
+		merged_ds = xr.merge(grib_datasets)
+		# create a downward short-wave radiation flux for the .f000 files (since they don't have one) and set to 0
+		if grib_file.endswith('.f000'):
+			merged_ds['dswrf'] = 0
+		points = remap_longs(merged_ds).sel(latitude=lats, longitude=longs, method='nearest')
+		times.append(points['valid_time'].values)
+		# (variables, zones) for this forecast hour
+		blocks.append(np.stack([np.broadcast_to(points[expected_to_grib[name]].values, (len(zones),)).astype('float64')
+								for name in ordered_names]))
+
+	columns = pd.MultiIndex.from_product([ordered_names, zones], names=['variable', 'zone'])
+	if not blocks:
+		return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name='time'), dtype='float64')
+	zone_frame = pd.DataFrame(np.stack(blocks).reshape(len(blocks), -1),
+							  index=pd.DatetimeIndex(times, name='time'),
+							  columns=columns)
+	return zone_frame.sort_index()
 
 def aggregate_station_df_dict(gfs_dir = f'/data/forecastData/gfs/gfs.{datetime.today().strftime("%Y%m%d")}/00/atmos/',
 							location_dict = {"401": (45.0, -73.25),"402": (44.75, -73.25),"403": (44.75, -73.25)}
@@ -144,13 +190,12 @@ def isolate_loc_rows(ds, loc_dict):
     return concat_stations_ds
 
 ### In-place function that transforms the longitude indices from 0-360 t0 -180-180
+#   (kept sorted, so the grid can be searched for the nearest cell)
 def remap_longs(ds):
-    map_function = lambda lon: (lon - 360) if (lon > 180) else lon
-    vector_fcn = np.vectorize(map_function)
     longitudes = ds.coords["longitude"].values
-    remapped_longitudes = vector_fcn(longitudes)
+    remapped_longitudes = np.where(longitudes > 180, longitudes - 360, longitudes)
     remapped_ds = ds.assign_coords(longitude=remapped_longitudes)
-    return remapped_ds
+    return remapped_ds.sortby("longitude")
 
 ################## Function for downloading GFS data ##############################
 
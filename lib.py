@@ -1,6 +1,12 @@
 import os
 import sh
+import copy
 import sys
+import json
+import hashlib
+import threading
+import importlib.resources
+import pandas as pd
 import logging, logging.config
 from contextlib import contextmanager
 from string import Template
@@ -26,10 +32,25 @@ class IAMBAY:
         self.wrfgridxy = (1,1)      # a default grid selection
         self.infile_dir = 'AEM3D-inputs/infiles'            # directory for boundary condition inputs
         self.template_dir = 'AEM3D-inputs/TEMPLATES'            # directory for boundary condition inputs
+        self.template_package = 'models.aem3d.resources'    # packaged templates, template_dir's override them
+        self.templates = None     # TemplateRegistry of the templates, loaded on first use
         self.run_dir = 'AEM3D-inputs'     # directory to contain everything the lake model needs to run
         self.bayfiles = []                           # initial (empty) list of boundary condition files for bay modeling
+        self._fileorder = []                         # (stage rank, sequence) sort key for each of bayfiles
+        self._filelock = threading.Lock()            # prep stages may register files from several threads
+        self._stage = threading.local()              # rank of the prep stage running in this thread
         self.flowdf =  None       # eventually to contain bay input flow time series dataframe
         self.tempdf = None        # will contain wtr_temp time series dataframe
+        self.lakedf = None        # lake level regression inputs: flows, their means and air temp
+        self.forcing = None       # aligned observed + forecast forcing series (models/aem3d/forcing.py)
+        self.appendfrom = None    # AEM3D ordinal date: incremental prep rewrites input files only from here on
+        self.manifest = None      # PrepManifest: skip regenerating files whose inputs haven't changed
+        self.history = None       # AEM3D.AppendHistory: digests of the rows each file keeps for the next incremental prep
+        self.resolution = None    # align.Resolution: coarser time steps for older rows of the input files
+        self.zonefiles = 'each'   # climate zone files: 'each' zone its own, or 'combined' into one per variable
+        self.sourcefiles = 'each' # inflow and wq files: 'each' source its own, or 'combined' into one per variable group
+        self.p_redux = 1.0        # fraction of the CQ phosphorus kept (P reduction scenario)
+        self.chunks = None        # pandas offset alias (e.g. 'MS'): series files made and written a period of rows at a time
 
 
 
@@ -47,10 +68,8 @@ class IAMBAY:
             'ILS': (31,38)
         }
         
-        climateZones_MAP = {
-            'MB': [{}],
-            'STA': [{}],
-            'ILS': [{'vars': ['T2', 'AEMLW', 'SWDOWN', 'U10', 'V10'],
+        #   the lake wide GFS zones cover each bay (401 MB, 402 SAB, 403 IS)
+        lakeZones = [{'vars': ['T2', 'AEMLW', 'SWDOWN', 'U10', 'V10'],
                      'zones': [{
                         'name': '401',
                         'desc': 'MB',
@@ -72,7 +91,12 @@ class IAMBAY:
                          'desc': 'Unified',
                          'lat': 44.778645,
                          'lon': -73.17273}]}
-                     ]}
+                     ]
+        climateZones_MAP = {
+            'MB': lakeZones,
+            'STA': lakeZones,
+            'ILS': lakeZones
+        }
                      
         #
         #  bay source list structure
@@ -137,26 +161,259 @@ class IAMBAY:
     #   method to keep track of files used to model the bay
     #       fname : unpathed name of file
     #       ftype : descriptor of file type (default = "boundary_condition_file")
+    #       a file already listed isn't listed again (e.g. a variant rewriting it)
     def addfile(self, fname, ftype = 'boundary_condition_file'):
 
-        self.bayfiles.append((fname, ftype))
+        with self._filelock:
+            if (fname, ftype) in self.bayfiles:
+                return
+            self.bayfiles.append((fname, ftype))
+            self._fileorder.append((getattr(self._stage, 'rank', 0), len(self.bayfiles)))
+
+    #
+    #   context for a prep stage running in the current thread
+    #       files added inside it are ordered by the stage's rank, so the
+    #       control file lists them the same way however the stages overlap
+    @contextmanager
+    def stage(self, rank):
+        self._stage.rank = rank
+        try:
+            yield
+        finally:
+            del self._stage.rank
+
+    #
+    #   bay files in stage order, then in the order each stage added them
+    def orderedfiles(self):
+        with self._filelock:
+            return [f for _, f in sorted(zip(self._fileorder, self.bayfiles))]
+
+    #
+    #   bay files added by the prep stage of the given rank
+    def stagefiles(self, rank):
+        with self._filelock:
+            return [f for (r, _), f in zip(self._fileorder, self.bayfiles) if r == rank]
+
+    #
+    #   the bay's templates, loaded (once) on first use
+    def templateregistry(self):
+        with self._filelock:
+            if self.templates is None:
+                self.templates = TemplateRegistry(self.template_dir, self.template_package)
+            return self.templates
+
+    #
+    #   a copy of the bay writing into another run directory, laid out like its own
+    #       (its templates are copies of the bay's, so it shares their registry)
+    #       the copy starts with the files registered so far, in its own list
+    def variant(self, run_dir):
+        variant = copy.copy(self)
+        variant.run_dir = run_dir
+        variant.infile_dir = os.path.join(run_dir, os.path.relpath(self.infile_dir, self.run_dir))
+        variant.template_dir = os.path.join(run_dir, os.path.relpath(self.template_dir, self.run_dir))
+        with self._filelock:
+            variant.bayfiles = list(self.bayfiles)
+            variant._fileorder = list(self._fileorder)
+        variant._filelock = threading.Lock()
+        variant._stage = threading.local()
+        return variant
+
+    #
+    #   pickled (e.g. for a process pool) without its lock and thread state
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_filelock'], state['_stage']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._filelock = threading.Lock()
+        self._stage = threading.local()
+
+    #
+    #   climate zones, as given by climateZones (any number of them)
+    #       zonecoords : {zone name: (lat, lon)} for every zone, in listed order
+    #       zonesfor : names of the zones whose group has the weather variable var
+    def zonecoords(self):
+        return {zone['name']: (zone['lat'], zone['lon'])
+                for group in self.climateZones for zone in group.get('zones', [])}
+
+    def zonesfor(self, var):
+        return [zone['name'] for group in self.climateZones if var in group.get('vars', [])
+                for zone in group.get('zones', [])]
     ##
     #       End of IAMBAY Class
     ##
 
 
-def generate_file_from_template(templateFile, outFile, theBay, sub_dict, outFileType='boundary_condition_file'):
-    
-    logger.info(f'Writing out {outFile} from template file {templateFile}')
+##
+#
+#   Prep Manifest
+#       Records, for every generated file, a hash of what it was made from
+#       (template text, substitutions, data series) and the size and mtime it was
+#       left with.  A file whose inputs hash the same and that hasn't been touched
+#       since doesn't need writing again.  Prep stages that only write files are
+#       recorded too, with the files they registered, so a prep that failed part
+#       way can skip the stages that already finished when it's rerun.
+#
+class PrepManifest:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.files = {}       # path -> {'key', 'size', 'mtime'}
+        self.stages = {}      # stage name -> {'key', 'files': [[fname, ftype], ...], 'history': {path: entry}}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                content = json.load(file)
+            self.files = content.get('files', {})
+            self.stages = content.get('stages', {})
+
+    #
+    #   hash of the given inputs: str, bytes, dicts, numpy arrays, pandas objects
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            if isinstance(part, (pd.DataFrame, pd.Series)):
+                digest.update(repr(list(part.to_frame().columns if isinstance(part, pd.Series) else part.columns)).encode())
+                digest.update(pd.util.hash_pandas_object(part, index=True).to_numpy().tobytes())
+            elif isinstance(part, bytes):
+                digest.update(part)
+            elif hasattr(part, 'dtype') and part.dtype != object:
+                digest.update(str(part.dtype).encode())
+                digest.update(part.tobytes())
+            elif isinstance(part, dict):
+                digest.update(repr(sorted((str(k), str(v)) for k, v in part.items())).encode())
+            else:
+                digest.update(str(part).encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    #
+    #   True if path was last written from inputs hashing to key and is untouched since
+    def unchanged(self, path, key):
+        with self._lock:
+            entry = self.files.get(path)
+        return entry is not None and entry['key'] == key and self.intact(path)
+
+    def intact(self, path):
+        with self._lock:
+            entry = self.files.get(path)
+        if entry is None or not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']
+
+    def record(self, path, key):
+        stat = os.stat(path)
+        with self._lock:
+            self.files[path] = {'key': key, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    #
+    #   files a stage registered when it last ran with this key, or None if it
+    #   has to run (different key, or any of its files missing or modified)
+    def stagefiles(self, name, key, infile_dir):
+        with self._lock:
+            entry = self.stages.get(name)
+        if entry is None or entry['key'] != key:
+            return None
+        if not all(self.intact(os.path.join(infile_dir, f)) for f, _ in entry['files']):
+            return None
+        return [tuple(f) for f in entry['files']]
+
+    def recordstage(self, name, key, files, history=None):
+        with self._lock:
+            self.stages[name] = {'key': key, 'files': [list(f) for f in files], 'history': history or {}}
+
+    #
+    #   the AppendHistory entries of the files a stage wrote when it last ran
+    def stagehistory(self, name):
+        with self._lock:
+            return dict(self.stages.get(name, {}).get('history', {}))
+
+    def forgetstage(self, name):
+        with self._lock:
+            self.stages.pop(name, None)
+
+    def save(self):
+        with self._lock:
+            content = json.dumps({'files': self.files, 'stages': self.stages}, indent=1)
+        with open(self.path + '.tmp', 'w') as file:
+            file.write(content)
+        os.replace(self.path + '.tmp', self.path)
+    ##
+    #       End of PrepManifest Class
+    ##
+
+
+class TemplateRegistry:
+    '''
+    Every template, read and compiled once.
+
+        directory - directory of templates (files with .template in their names)
+        package - package whose resources are templates too; the directory's
+                  override ones of the same name
+    '''
+
+    def __init__(self, directory=None, package=None):
+        self.texts = {}       # template file name -> text, directory's first (in its listing order)
+        if directory is not None and os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if '.template' in name:
+                    with open(os.path.join(directory, name), 'r') as file:
+                        self.texts[name] = file.read()
+        if package is not None:
+            for resource in importlib.resources.files(package).iterdir():
+                if '.template' in resource.name and resource.name not in self.texts:
+                    self.texts[resource.name] = resource.read_text()
+        self.templates = {name: Template(text) for name, text in self.texts.items()}
+
+    def template(self, name):
+        if name not in self.templates:
+            raise Exception(f'Template {name} not found')
+        return self.templates[name]
+
+    #
+    #   names of the templates containing part, e.g. 'Tracer'
+    def find(self, part):
+        return [name for name in self.texts if part in name]
 
-    with open(os.path.join(theBay.template_dir, templateFile), 'r') as file:
-        template = Template(file.read())
+    #
+    #   hash of every template, for keys of the files made from them
+    def key(self):
+        return PrepManifest.key(*(part for name in sorted(self.texts) for part in (name, self.texts[name])))
 
-    with open(os.path.join(theBay.infile_dir, outFile), 'w') as output_file:
-        output_file.write(template.substitute(**sub_dict))
-    
-    # remember generated bay files
-    theBay.addfile(fname=outFile, ftype=outFileType)
+    #
+    #   fill and write a batch of templates into the bay's infile_dir, each one
+    #       (templateFile, outFile, sub_dict[, outFileType]), skipping files the
+    #       bay's manifest has as written from the same template and values
+    def render(self, theBay, outputs):
+        for templateFile, outFile, sub_dict, *outFileType in outputs:
+            template = self.template(templateFile)
+            pathedfile = os.path.join(theBay.infile_dir, outFile)
+            key = None
+            if theBay.manifest is not None:
+                key = PrepManifest.key(template.template, sub_dict)
+
+            if key is not None and theBay.manifest.unchanged(pathedfile, key):
+                logger.info(f'{outFile} is unchanged, skipping')
+            else:
+                logger.info(f'Writing out {outFile} from template file {templateFile}')
+                with open(pathedfile, 'w') as output_file:
+                    output_file.write(template.substitute(**sub_dict))
+                if key is not None:
+                    theBay.manifest.record(pathedfile, key)
+
+            # remember generated bay files
+            theBay.addfile(fname=outFile, ftype=(outFileType or ['boundary_condition_file'])[0])
+    ##
+    #       End of TemplateRegistry Class
+    ##
+
+
+def generate_file_from_template(templateFile, outFile, theBay, sub_dict, outFileType='boundary_condition_file'):
+    theBay.templateregistry().render(theBay, [(templateFile, outFile, sub_dict, outFileType)])
 
 
 @contextmanager
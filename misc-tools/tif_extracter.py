@@ -3,21 +3,50 @@ This module will extract raster values at points of interest.
 
 One could do this in ArcGIS Pro, but for multiband rasters, the process is 
 cumbersome.  This script takes paths to a shapefile with points of interest
-and a raster as inputs.  The script currently just prints the results, however,
-I suggest you use pandas to log results and save to CSV.  Not knowing how this
-script will be used, I left it to simply print.
+and a raster as inputs.  extract_points() just prints the results, one GDAL
+read per point per band.  For many points or many rasters, use
+extract_points_batched() or extract_points_many(), which return a tidy pandas
+DataFrame (one row per raster / point / band) and can save it to CSV.
+
+The batched extractor converts all point geometries to pixel indices at once,
+groups the points by the raster's native block, and reads each needed block a
+single time for all bands.  extract_points_many() farms the rasters out to a
+process pool.
+
+extract_series() samples a directory or glob of dated rasters (daily or
+monthly satellite products, for example) at the same points and stores a
+time x point x band array in a chunked store on disk.  Rerunning it on the
+same store only reads rasters that are not in the store yet, so adding one
+day does not rescan the archive.  read_series() loads the store back.
+
+zonal_stats() summarises rasters over polygons (sub-watersheds, for example)
+instead of points.  The polygons are rasterized once to a label grid that is
+cached and reused for every raster on the same grid, and each band is reduced
+per zone in one vectorized pass (counts, means, min/max, std, and class
+fractions for categorical rasters such as land cover).
 
 To use the script, you may either call it from the command line or import
 tif_extracter as a submodule.
 
-Command line example:
+Command line examples:
 
 python tif_extracter.py "C:\path\to\pts.shp" "C:\path\to\raster.tif"
+python tif_extracter.py "C:\path\to\pts.shp" "C:\path\to\a.tif" "C:\path\to\b.tif" --csv "C:\path\to\out.csv"
+python tif_extracter.py "C:\path\to\pts.shp" "C:\path\to\chl\*.tif" --series "C:\path\to\chl_store"
+python tif_extracter.py "C:\path\to\basins.shp" "C:\path\to\landcover.tif" --zonal --csv "C:\path\to\out.csv"
 
 """
 
+import os
+import re
 import sys
+import glob
+import json
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from osgeo import gdal,ogr
+import numpy as np
+import pandas as pd
 
 
 def extract_points(point_path, raster_path):
@@ -47,7 +76,485 @@ def extract_points(point_path, raster_path):
             # to log info and save to csv.
             print(f'{tmp_band.GetDescription()}: {val}')
 
+
+### read_points() - Reads all point geometries of a layer in one pass
+# -- point_path (str) [required]: path to the point shapefile (or any OGR point layer)
+# returns (fids, x, y) as numpy arrays
+def read_points(point_path):
+    ds = ogr.Open(point_path)
+    lyr = ds.GetLayer()
+
+    fids, xs, ys = [], [], []
+    for feat in lyr:
+        geom = feat.GetGeometryRef()
+        fids.append(feat.GetFID())
+        xs.append(geom.GetX())
+        ys.append(geom.GetY())
+
+    return np.asarray(fids, dtype='int64'), np.asarray(xs, dtype='float64'), np.asarray(ys, dtype='float64')
+
+
+### points_to_pixels() - Converts map coordinates to raster column/row indices, all at once
+# -- mx, my (arrays) [required]: map coordinates of the points
+# -- transform (tuple) [required]: GDAL geotransform of the raster
+# Truncates toward zero, same as int() in extract_points()
+def points_to_pixels(mx, my, transform):
+    px = ((mx - transform[0]) / transform[1]).astype('int64')
+    py = ((my - transform[3]) / transform[5]).astype('int64')
+    return px, py
+
+
+def band_names(raster):
+    names = []
+    for i in range(raster.RasterCount):
+        desc = raster.GetRasterBand(i + 1).GetDescription()
+        names.append(desc if desc else f'band_{i + 1}')
+    return names
+
+
+### read_pixel_values() - Reads the values of every band at the given pixels, one read per raster block
+# -- raster (gdal.Dataset) [required]: open raster
+# -- px, py (int arrays) [required]: column/row indices of the points
+# returns a (points x bands) float array, NaN for points that fall outside the raster
+def read_pixel_values(raster, px, py):
+    band_count = raster.RasterCount
+    xsize, ysize = raster.RasterXSize, raster.RasterYSize
+    values = np.full((len(px), band_count), np.nan)
+
+    inside = np.flatnonzero((px >= 0) & (px < xsize) & (py >= 0) & (py < ysize))
+    if len(inside) == 0 or band_count == 0:
+        return values
+
+    # Group points by the raster's native block so each block is read once
+    block_w, block_h = raster.GetRasterBand(1).GetBlockSize()
+    blocks_x = (xsize + block_w - 1) // block_w
+    block_id = (py[inside] // block_h) * blocks_x + (px[inside] // block_w)
+
+    order = np.argsort(block_id, kind='stable')
+    block_id = block_id[order]
+    inside = inside[order]
+    starts = np.flatnonzero(np.r_[True, block_id[1:] != block_id[:-1]])
+    stops = np.r_[starts[1:], len(block_id)]
+
+    for start, stop in zip(starts, stops):
+        pts = inside[start:stop]
+        xoff = int(block_id[start] % blocks_x) * block_w
+        yoff = int(block_id[start] // blocks_x) * block_h
+        win_w = min(block_w, xsize - xoff)
+        win_h = min(block_h, ysize - yoff)
+
+        # One read per block for all bands: (bands, rows, cols)
+        window = raster.ReadAsArray(xoff, yoff, win_w, win_h)
+        if window.ndim == 2:
+            window = window[np.newaxis, :, :]
+
+        values[pts, :] = window[:, py[pts] - yoff, px[pts] - xoff].T
+
+    return values
+
+
+def _read_raster_values(raster_path, mx, my):
+    raster = gdal.Open(raster_path)
+    px, py = points_to_pixels(mx, my, raster.GetGeoTransform())
+    return read_pixel_values(raster, px, py), band_names(raster)
+
+
+def _extract_raster(raster_path, fids, mx, my):
+    values, names = _read_raster_values(raster_path, mx, my)
+
+    # tidy (long) layout: one row per point per band
+    n_points, n_bands = values.shape
+    return pd.DataFrame({
+        'raster': os.path.basename(raster_path),
+        'fid': np.repeat(fids, n_bands),
+        'x': np.repeat(mx, n_bands),
+        'y': np.repeat(my, n_bands),
+        'band': np.tile(names, n_points),
+        'value': values.ravel()
+    })
+
+
+### extract_points_batched() - Batched replacement for extract_points()
+# -- point_path (str) [required]: path to the point shapefile
+# -- raster_path (str) [required]: path to the raster
+# -- out_csv (str) [optional]: if given, the results are also written to this csv
+# returns tidy DataFrame with columns raster, fid, x, y, band, value
+def extract_points_batched(point_path, raster_path, out_csv=None):
+    fids, mx, my = read_points(point_path)
+    df = _extract_raster(raster_path, fids, mx, my)
+    if out_csv is not None:
+        df.to_csv(out_csv, index=False)
+    return df
+
+
+### extract_points_many() - Extracts the same points from many rasters in a process pool
+# -- point_path (str) [required]: path to the point shapefile
+# -- raster_paths (list of str) [required]: rasters to sample
+# -- processes (int) [optional]: size of the process pool; 1 runs serially. Default is os.cpu_count()
+# -- out_csv (str) [optional]: if given, the results are also written to this csv
+def extract_points_many(point_path, raster_paths, processes=None, out_csv=None):
+    fids, mx, my = read_points(point_path)
+
+    if processes == 1 or len(raster_paths) <= 1:
+        frames = [_extract_raster(r, fids, mx, my) for r in raster_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            frames = list(pool.map(_extract_raster,
+                                   raster_paths,
+                                   [fids] * len(raster_paths),
+                                   [mx] * len(raster_paths),
+                                   [my] * len(raster_paths)))
+
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+        columns=['raster', 'fid', 'x', 'y', 'band', 'value'])
+    if out_csv is not None:
+        df.to_csv(out_csv, index=False)
+    return df
+
+
+############# Time-stacked raster series ############################
+#
+#   Store layout (a directory):
+#       manifest.json       - points, band names and the list of chunks
+#       chunk_NNNNNN.npy    - float array (times x points x bands), one per append batch
+#
+#   Chunks are written before the manifest is replaced, so an interrupted append
+#   leaves the store as it was.
+
+SERIES_CHUNK_TIMES = 64     # max rasters (time steps) per chunk file
+
+
+def list_rasters(raster_glob):
+    if os.path.isdir(raster_glob):
+        raster_glob = os.path.join(raster_glob, '*.tif')
+    return sorted(glob.glob(raster_glob))
+
+
+### raster_key() - A raster's name in a store: its path under the directory or glob root
+# -- raster_path (str) [required]: path to the raster, as list_rasters() gives it
+# -- raster_glob (str) [required]: the directory or glob pattern it was listed from
+# e.g. /data/20230401/chl.tif from /data/*/chl.tif is stored as 20230401/chl.tif
+def raster_key(raster_path, raster_glob):
+    if os.path.isdir(raster_glob):
+        root = raster_glob
+    else:
+        # the leading directories of the pattern without wildcards
+        parts = os.path.normpath(raster_glob).split(os.sep)
+        fixed = next((i for i, part in enumerate(parts) if glob.has_magic(part)), len(parts) - 1)
+        root = os.sep.join(parts[:fixed]) or os.curdir
+    return os.path.relpath(raster_path, root).replace(os.sep, '/')
+
+
+### raster_time() - Pulls the time stamp out of a raster file name, else its folders' (e.g. 20230401/chl.tif)
+# -- raster_path (str) [required]: path to the raster
+# -- date_pattern (str) [optional]: regex with one group capturing the date string
+# -- date_format (str) [optional]: strptime format for the captured date string
+def raster_time(raster_path, date_pattern=r'(\d{8})', date_format='%Y%m%d'):
+    match = re.search(date_pattern, os.path.basename(raster_path))
+    if match is None:
+        matches = list(re.finditer(date_pattern, os.path.dirname(raster_path)))
+        match = matches[-1] if matches else None
+    if match is None:
+        raise Exception(f'No date matching {date_pattern} in raster name {raster_path}')
+    return datetime.strptime(match.group(1), date_format)
+
+
+def _load_manifest(store_dir):
+    manifest_path = os.path.join(store_dir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+
+def _save_manifest(store_dir, manifest):
+    manifest_path = os.path.join(store_dir, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+### extract_series() - Samples a stack of dated rasters at points, appending to a chunked store
+# -- point_path (str) [required]: path to the point shapefile
+# -- raster_glob (str) [required]: directory of .tif files or a glob pattern
+# -- store_dir (str) [required]: directory of the chunked store; created on first use
+# -- date_pattern, date_format (str) [optional]: see raster_time()
+# -- processes (int) [optional]: size of the process pool; 1 runs serially. Default is os.cpu_count()
+# returns the list of rasters that were added
+def extract_series(point_path, raster_glob, store_dir,
+                   date_pattern=r'(\d{8})', date_format='%Y%m%d', processes=None):
+    fids, mx, my = read_points(point_path)
+
+    manifest = _load_manifest(store_dir)
+    if manifest is None:
+        os.makedirs(store_dir, exist_ok=True)
+        manifest = {'fids': fids.tolist(), 'x': mx.tolist(), 'y': my.tolist(),
+                    'bands': None, 'chunks': []}
+    elif manifest['fids'] != fids.tolist() or manifest['x'] != mx.tolist() or manifest['y'] != my.tolist():
+        # moved points would be sampled elsewhere and appended to the same series
+        raise Exception(f'Points in {point_path} do not match the points (ids and locations) of store {store_dir}')
+
+    # Only rasters that are not in the store yet get read
+    stored = {r for chunk in manifest['chunks'] for r in chunk['rasters']}
+    new_rasters = [r for r in list_rasters(raster_glob) if raster_key(r, raster_glob) not in stored]
+    if not new_rasters:
+        return []
+
+    times = [raster_time(r, date_pattern, date_format) for r in new_rasters]
+    order = np.argsort(np.array(times, dtype='datetime64[s]'), kind='stable')
+    new_rasters = [new_rasters[i] for i in order]
+    times = [times[i] for i in order]
+
+    if processes == 1 or len(new_rasters) == 1:
+        results = [_read_raster_values(r, mx, my) for r in new_rasters]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_read_raster_values,
+                                    new_rasters,
+                                    [mx] * len(new_rasters),
+                                    [my] * len(new_rasters)))
+
+    for raster_path, (values, names) in zip(new_rasters, results):
+        if manifest['bands'] is None:
+            manifest['bands'] = names
+        elif names != manifest['bands']:
+            raise Exception(f'Bands of {raster_path} do not match the bands of store {store_dir}')
+
+    # (times x points x bands)
+    stack = np.stack([values for values, _ in results])
+    next_chunk = len(manifest['chunks'])
+    for start in range(0, len(new_rasters), SERIES_CHUNK_TIMES):
+        stop = start + SERIES_CHUNK_TIMES
+        chunk_file = f'chunk_{next_chunk:06d}.npy'
+        np.save(os.path.join(store_dir, chunk_file), stack[start:stop])
+        manifest['chunks'].append({
+            'file': chunk_file,
+            'times': [t.isoformat() for t in times[start:stop]],
+            'rasters': [raster_key(r, raster_glob) for r in new_rasters[start:stop]]
+        })
+        next_chunk += 1
+
+    _save_manifest(store_dir, manifest)
+    return new_rasters
+
+
+### read_series() - Loads a chunked store written by extract_series()
+# -- store_dir (str) [required]: directory of the chunked store
+# -- start, end (datetime) [optional]: only load chunks overlapping this time window
+# returns dict with 'time' (DatetimeIndex), 'values' (times x points x bands), 'fids' and 'bands'
+def read_series(store_dir, start=None, end=None):
+    manifest = _load_manifest(store_dir)
+    if manifest is None:
+        raise Exception(f'No series store found at {store_dir}')
+
+    times, arrays = [], []
+    for chunk in manifest['chunks']:
+        chunk_times = pd.DatetimeIndex(chunk['times'])
+        if start is not None and chunk_times.max() < pd.Timestamp(start):
+            continue
+        if end is not None and chunk_times.min() > pd.Timestamp(end):
+            continue
+        times.append(chunk_times)
+        arrays.append(np.load(os.path.join(store_dir, chunk['file']), mmap_mode='r'))
+
+    n_points, n_bands = len(manifest['fids']), len(manifest['bands'] or [])
+    if not arrays:
+        time = pd.DatetimeIndex([], name='time')
+        values = np.empty((0, n_points, n_bands))
+    else:
+        time = times[0].append(times[1:]) if len(times) > 1 else times[0]
+        values = np.concatenate(arrays, axis=0)
+        order = np.argsort(time.values, kind='stable')
+        time = time[order].rename('time')
+        values = values[order]
+
+    window = np.ones(len(time), dtype=bool)
+    if start is not None:
+        window &= time >= pd.Timestamp(start)
+    if end is not None:
+        window &= time <= pd.Timestamp(end)
+
+    return {'time': time[window], 'values': values[window],
+            'fids': np.asarray(manifest['fids']), 'bands': manifest['bands']}
+
+
+############# Zonal statistics over polygons ############################
+
+ZONAL_STATS = ('count', 'mean', 'min', 'max', 'std')
+
+# label grids by (polygon file, zone field, raster grid); see zone_label_grid()
+_label_grid_cache = {}
+
+
+### zone_label_grid() - Rasterizes polygons to a grid of zone labels (1..n, 0 = no zone)
+# -- polygon_path (str) [required]: path to the polygon shapefile, same projection as the raster
+# -- raster (gdal.Dataset) [required]: raster whose grid the labels should match
+# -- zone_field (str) [optional]: attribute used to name the zones. Default is the feature FID
+# -- all_touched (bool) [optional]: label every cell touched by a polygon, not just cell centers
+# returns (labels array, list of zone names); cached across rasters with the same geotransform
+def zone_label_grid(polygon_path, raster, zone_field=None, all_touched=False):
+    transform = raster.GetGeoTransform()
+    key = (os.path.abspath(polygon_path), os.path.getmtime(polygon_path), zone_field, all_touched,
+           tuple(transform), raster.RasterXSize, raster.RasterYSize)
+    if key in _label_grid_cache:
+        return _label_grid_cache[key]
+
+    ds = ogr.Open(polygon_path)
+    lyr = ds.GetLayer()
+
+    # Copy the polygons to memory with a 1..n label attribute to burn
+    mem_ds = ogr.GetDriverByName('Memory').CreateDataSource('zones')
+    mem_lyr = mem_ds.CreateLayer('zones', srs=lyr.GetSpatialRef(), geom_type=lyr.GetGeomType())
+    mem_lyr.CreateField(ogr.FieldDefn('zone_label', ogr.OFTInteger))
+    names = []
+    for i, feat in enumerate(lyr):
+        out_feat = ogr.Feature(mem_lyr.GetLayerDefn())
+        out_feat.SetGeometry(feat.GetGeometryRef().Clone())
+        out_feat.SetField('zone_label', i + 1)
+        mem_lyr.CreateFeature(out_feat)
+        names.append(feat.GetField(zone_field) if zone_field else feat.GetFID())
+
+    label_ds = gdal.GetDriverByName('MEM').Create('', raster.RasterXSize, raster.RasterYSize, 1, gdal.GDT_Int32)
+    label_ds.SetGeoTransform(transform)
+    label_ds.SetProjection(raster.GetProjection())
+    options = ['ATTRIBUTE=zone_label']
+    if all_touched:
+        options.append('ALL_TOUCHED=TRUE')
+    gdal.RasterizeLayer(label_ds, [1], mem_lyr, options=options)
+
+    labels = label_ds.GetRasterBand(1).ReadAsArray()
+    _label_grid_cache[key] = (labels, names)
+    return labels, names
+
+
+### reduce_zones() - Per-zone statistics of one band in a single vectorized pass
+# -- labels (int array) [required]: zone label grid from zone_label_grid()
+# -- values (array) [required]: band values on the same grid
+# -- n_zones (int) [required]: number of zones (labels run 1..n_zones)
+# -- nodata (float) [optional]: band nodata value, excluded along with NaN
+# -- stats (tuple) [optional]: any of ZONAL_STATS
+# -- categorical (bool) [optional]: also return the fraction of each class value per zone
+# returns dict of stat name -> array of length n_zones
+def reduce_zones(labels, values, n_zones, nodata=None, stats=ZONAL_STATS, categorical=False):
+    valid = labels > 0
+    if nodata is not None:
+        valid &= values != nodata
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+
+    lab = labels[valid]
+    vals = values[valid]
+    fvals = vals.astype('float64')
+
+    count = np.bincount(lab, minlength=n_zones + 1)[1:]
+    result = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(lab, weights=fvals, minlength=n_zones + 1)[1:] / count
+        if 'count' in stats:
+            result['count'] = count
+        if 'mean' in stats:
+            result['mean'] = mean
+        if 'std' in stats:
+            # squared deviations from each zone's own mean: sumsq/count - mean**2
+            #   cancels away the spread of values far from zero
+            deviation = fvals - mean[lab - 1]
+            result['std'] = np.sqrt(np.bincount(lab, weights=deviation * deviation, minlength=n_zones + 1)[1:] / count)
+
+    if 'min' in stats or 'max' in stats:
+        # sort by zone once, then reduce each contiguous run
+        order = np.argsort(lab, kind='stable')
+        sorted_lab = lab[order]
+        sorted_vals = fvals[order]
+        starts = np.flatnonzero(np.r_[True, sorted_lab[1:] != sorted_lab[:-1]]) if len(lab) else np.array([], dtype='int64')
+        present = sorted_lab[starts] - 1
+        for name, ufunc in (('min', np.minimum), ('max', np.maximum)):
+            if name in stats:
+                out = np.full(n_zones, np.nan)
+                if len(starts):
+                    out[present] = ufunc.reduceat(sorted_vals, starts)
+                result[name] = out
+
+    if categorical:
+        classes, class_idx = np.unique(vals, return_inverse=True)
+        counts = np.bincount(lab * len(classes) + class_idx.ravel(),
+                             minlength=(n_zones + 1) * len(classes)).reshape(n_zones + 1, len(classes))[1:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fractions = counts / count[:, np.newaxis]
+        for j, cls in enumerate(classes):
+            result[f'frac_{cls}'] = fractions[:, j]
+
+    return result
+
+
+### zonal_stats() - Zonal statistics of every band of a raster over polygons
+# -- polygon_path (str) [required]: path to the polygon shapefile, same projection as the raster
+# -- raster_path (str) [required]: path to the raster
+# -- zone_field, all_touched: see zone_label_grid()
+# -- stats, categorical: see reduce_zones()
+# -- out_csv (str) [optional]: if given, the results are also written to this csv
+# returns tidy DataFrame with columns raster, zone, band, stat, value
+def zonal_stats(polygon_path, raster_path, zone_field=None, stats=ZONAL_STATS,
+                categorical=False, all_touched=False, out_csv=None):
+    raster = gdal.Open(raster_path)
+    labels, names = zone_label_grid(polygon_path, raster, zone_field, all_touched)
+    n_zones = len(names)
+
+    frames = []
+    for band_name, i in zip(band_names(raster), range(raster.RasterCount)):
+        band = raster.GetRasterBand(i + 1)
+        result = reduce_zones(labels, band.ReadAsArray(), n_zones, band.GetNoDataValue(), stats, categorical)
+        for stat, values in result.items():
+            frames.append(pd.DataFrame({
+                'raster': os.path.basename(raster_path),
+                'zone': names,
+                'band': band_name,
+                'stat': stat,
+                'value': values
+            }))
+
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+        columns=['raster', 'zone', 'band', 'stat', 'value'])
+    if out_csv is not None:
+        df.to_csv(out_csv, index=False)
+    return df
+
+
+### zonal_stats_many() - zonal_stats() over many rasters, reusing the label grid where the grids match
+def zonal_stats_many(polygon_path, raster_paths, zone_field=None, stats=ZONAL_STATS,
+                     categorical=False, all_touched=False, out_csv=None):
+    frames = [zonal_stats(polygon_path, r, zone_field, stats, categorical, all_touched) for r in raster_paths]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+        columns=['raster', 'zone', 'band', 'stat', 'value'])
+    if out_csv is not None:
+        df.to_csv(out_csv, index=False)
+    return df
+
+
 if __name__ == '__main__':
-    points = sys.argv[1]
-    raster = sys.argv[2]
-    extract_points(points, raster)
+    args = sys.argv[1:]
+    out_csv = None
+    store_dir = None
+    zonal = False
+    if '--zonal' in args:
+        zonal = True
+        args.remove('--zonal')
+    if '--csv' in args:
+        i = args.index('--csv')
+        out_csv = args[i + 1]
+        args = args[:i] + args[i + 2:]
+    if '--series' in args:
+        i = args.index('--series')
+        store_dir = args[i + 1]
+        args = args[:i] + args[i + 2:]
+
+    points = args[0]
+    rasters = args[1:]
+    if zonal:
+        print(zonal_stats_many(points, rasters, out_csv=out_csv))
+    elif store_dir is not None:
+        added = extract_series(points, rasters[0], store_dir)
+        print(f'Added {len(added)} rasters to {store_dir}')
+    elif len(rasters) == 1 and out_csv is None:
+        extract_points(points, rasters[0])
+    else:
+        print(extract_points_many(points, rasters, out_csv=out_csv))
@@ -1,3 +1,11 @@
+import os
+import shutil
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+
+from . import align
 
 ## Check on naming convention for classes and functions and variables
 class Model:
@@ -12,12 +20,14 @@ class Model:
     # Copy base files
     # Mod setup
     generate_input_files()
+    pass
 
   def generate_input_files():
     # Use starttime / endtime from model creation
 
     #generate_temp()
     # and so on... See current AEM3D
+    pass
 
 
   def input_from_calibration_file(filename, newRange, origRange = None):
@@ -30,35 +40,658 @@ class Model:
     
     #Create Pandas dataframe from lists within list
     #return dataframe
+    pass
   
   def input_from_NWS_v21_hindcast():
     #read in hindcast to dataFrame
+    pass
+
+## Boundary condition (.dat) files
+#
+#   Every AEM3D time series file is a '!' comment banner, a small header and then
+#   one whitespace separated row per time step:
+#
+#       !-----------------------------------------------------!
+#       ! Written by AEM3D_prep_IAM                           !
+#       ! Bay ID: ILS                                         !
+#       !-----------------------------------------------------!
+#       3 data sets
+#       0 seconds between data
+#       0    201  201  201
+#       TIME      PO4  DOPL  POPL
+#       2023002.0000 0.012 0.028 0.111
+#
+#   InputFile builds the header from the source IDs and column names and formats the
+#   rows in bulk: every field is laid out as ascii digits in a NUL padded byte matrix
+#   with integer arithmetic, then the NULs are dropped and the whole body is written
+#   in one go.  Values come out like to_csv(float_format='%.3f'): correctly rounded,
+#   '-0.000' for small negatives, empty for NaN.
+#
+#   With chunks set (e.g. 'MS') a file is made a period of rows at a time instead:
+#   each chunk is derived, coarsened, formatted and written before the next is made,
+#   so a long spinup is never held whole as values or as text (see InputFile.stream()).
+#
+#   An incremental prep keeps each file's rows before the last run's forecast start
+#   and rewrites only the rest.  The last run recorded a digest of the rows it wrote
+#   before that time, per column and source (see AppendHistory); the kept rows are
+#   trusted only if the same digest of this run's rows matches, however far back
+#   upstream revised them, otherwise the whole file is written again.
+
+BANNER_RULE = '!-----------------------------------------------------!'
+
+# rows formatted at a time when writing, so a long series isn't held as text all at once
+WRITE_CHUNK_ROWS = 16384
+COPY_CHUNK = 1 << 20
+
+
+def format_fixed(values, decimals=3):
+  '''
+  Format an array of floats like '%.{decimals}f', in bulk.
+      Returns a NUL padded (values x width) uint8 matrix of ascii; NaN is all NUL.
+  '''
+  values = np.asarray(values, dtype='float64')
+  scale = 10 ** decimals
+
+  finite = np.isfinite(values)
+  scaled = np.abs(np.where(finite, values, 0.0)) * scale
+  # round half to even matches '%f' except right at a tie, where the binary value
+  # decides; send those (and anything too big for exact float math) through '%f'
+  exact = finite & (np.abs(scaled - np.floor(scaled) - 0.5) > 1e-6) & (scaled < 1e9)
+  rounded = np.where(exact, np.rint(scaled), 0).astype('int64')
+  whole = rounded // scale
+  fraction = rounded % scale
+
+  # digits in the whole part (at least 1), and the widest one
+  ndigits = 1 + np.searchsorted(10 ** np.arange(1, 10, dtype='int64'), whole, side='right')
+  maxdigits = int(ndigits.max()) if len(values) else 1
+
+  # [sign][whole digits, right aligned][.][fraction digits]
+  field = np.zeros((len(values), maxdigits + 2 + decimals), dtype='uint8')
+  field[:, 0] = np.where(exact & np.signbit(values), ord('-'), 0)
+  powers = 10 ** np.arange(maxdigits - 1, -1, -1, dtype='int64')
+  field[:, 1:maxdigits + 1] = np.where(np.arange(maxdigits) >= (maxdigits - ndigits)[:, np.newaxis],
+                                       (whole[:, np.newaxis] // powers) % 10 + ord('0'), 0)
+  field[:, maxdigits + 1] = ord('.')
+  powers = 10 ** np.arange(decimals - 1, -1, -1, dtype='int64')
+  field[:, maxdigits + 2:] = (fraction[:, np.newaxis] // powers) % 10 + ord('0')
+
+  field[~exact] = 0
+  slow = np.flatnonzero(~exact & ~np.isnan(values))
+  if len(slow):
+    slow_text = [('%.*f' % (decimals, values[i])).encode('ascii') for i in slow]
+    width = max(len(t) for t in slow_text)
+    if width > field.shape[1]:
+      field = np.hstack([field, np.zeros((len(values), width - field.shape[1]), dtype='uint8')])
+    for i, text in zip(slow, slow_text):
+      field[i, :len(text)] = np.frombuffer(text, dtype='uint8')
+  return field
+
+
+def format_rows(times, columns, decimals=3, sep=' '):
+  '''
+  Format time strings and value columns into the (bytes) data section of a .dat file.
+  '''
+  times = np.asarray(times).astype('S')
+  if len(times) == 0:
+    return b''
+
+  def constant(text):
+    return np.tile(np.frombuffer(text.encode('ascii'), dtype='uint8'), (len(times), 1))
+
+  parts = [times.view('uint8').reshape(len(times), -1)]
+  for column in columns:
+    parts.append(constant(sep))
+    parts.append(format_fixed(column, decimals))
+  parts.append(constant(os.linesep))
+
+  body = np.hstack(parts).ravel()
+  return body[body != 0].tobytes()
+
+
+class RowDigest:
+  '''
+  Digests of a series file's rows before each of some cutoffs, fed a chunk at a time.
+
+      cutoffs - AEM3D ordinal dates (None is skipped)
+      columns - number of value columns
+      The raw rows are hashed, nothing is formatted: the times once, as int64
+      seconds, and each column as its values scaled to decimals and rounded
+      to int64, so a digest is the same however the rows were chunked and
+      changes when what would be written does.  Rows come in time order.
+  '''
+
+  def __init__(self, cutoffs, columns, decimals=3):
+    cutoffs = sorted(set(cutoff for cutoff in cutoffs if cutoff is not None))
+    stamps = InputFile.stamps(None, np.asarray(cutoffs, dtype='U')) if cutoffs else []
+    self.cutoffs = list(zip(stamps, cutoffs))
+    self.scale = 10 ** decimals
+    self.times = hashlib.blake2b(digest_size=16)
+    self.hashes = [hashlib.blake2b(digest_size=16) for _ in range(columns)]
+    self.done = {}        # cutoff -> digests of the rows before it, once past it
+
+  def feed(self, stamps, columns):
+    # stamps - the rows' int64 ns times (see InputFile.stamps())
+    start = 0
+    while self.cutoffs:
+      end = start + np.searchsorted(stamps[start:], self.cutoffs[0][0])
+      self.times.update((stamps[start:end] // 1000000000).tobytes())
+      for digest, column in zip(self.hashes, columns):
+        scaled = np.rint(column[start:end] * self.scale)
+        digest.update(np.where(np.isnan(scaled), -2.0 ** 63, scaled).astype('int64').tobytes())
+      if end == len(stamps):
+        return
+      self.done[self.cutoffs.pop(0)[1]] = self.digests()
+      start = end
+
+  def digests(self):
+    return [self.times.hexdigest()] + [digest.hexdigest() for digest in self.hashes]
+
+  def result(self, cutoff, source_ids, headers):
+    # what AppendHistory keeps of a file: the digests of its rows before cutoff
+    times, *digests = self.done.get(cutoff) or self.digests()
+    return {'cutoff': cutoff,
+            'times': times,
+            'columns': [[str(source), str(header), digest]
+                        for source, header, digest in zip(source_ids, headers, digests)]}
+
+
+class AppendHistory:
+  '''
+  The rows each series file keeps for the next incremental prep.
+
+      cutoff - AEM3D ordinal date this prep's forecast starts at; the next
+               incremental prep keeps every file's rows before it
+      previous - files as the last prep recorded them, up to this prep's appendfrom
+      Thread safe: the prep stages write their files concurrently.
+  '''
+
+  def __init__(self, cutoff, previous={}):
+    self.cutoff = cutoff
+    self.previous = dict(previous)
+    self._lock = threading.Lock()
+    self.files = {}       # path -> RowDigest.result() for cutoff, 'size', 'mtime'
+
+  def record(self, path, digest):
+    stat = os.stat(path)
+    with self._lock:
+      self.files[path] = dict(digest, size=stat.st_size, mtime=stat.st_mtime_ns)
+
+  def entries(self, paths):
+    # what's recorded of some of the files, e.g. for a prep stage skipped next time (see stages.py)
+    with self._lock:
+      return {path: self.files[path] for path in paths if path in self.files}
+
+  def restore(self, entries):
+    # record files again as entries() gave them; False (nothing restored) if
+    #   any was recorded for another cutoff
+    if any(entry['cutoff'] != self.cutoff for entry in entries.values()):
+      return False
+    with self._lock:
+      self.files.update(entries)
+    return True
+
+  def matches(self, path, digest):
+    # True if path is as the last prep wrote it, from rows digesting the same before digest's cutoff
+    with self._lock:
+      entry = self.previous.get(path)
+    if entry is None or not os.path.exists(path):
+      return False
+    stat = os.stat(path)
+    return ((stat.st_size, stat.st_mtime_ns) == (entry['size'], entry['mtime'])
+            and all(entry.get(name) == digest[name] for name in ['cutoff', 'times', 'columns']))
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
 
 class InputFile:
-  def write(headers = {}, data):
-  
-  def read():
-    # Return {{Headers}, pandas DF}
+  '''
+  An AEM3D boundary condition file.
+
+      path - where the file is written
+      bayid - bay ID written in the header banner
+      comments - any extra banner lines (e.g. 'Bay Source: PikeRiver')
+      appendfrom - AEM3D ordinal date; if set, an existing file is kept up to
+                   this time and only the rows from it on are rewritten, when
+                   history has its rows before it written from the same data
+      manifest - lib.PrepManifest; if set, the file isn't written again when
+                 its header and data hash the same as last time
+      resolution - align.Resolution; if set, older rows are averaged into its
+                   coarser steps, per column header
+      chunks - pandas offset alias (e.g. 'MS'); if set, the file is written a
+               period of rows at a time (see stream())
+      history - AppendHistory; if set, the digests of the rows written before
+                its cutoff are recorded for the next incremental prep
+  '''
+
+  def __init__(self, path, bayid='', comments=[], appendfrom=None, manifest=None, resolution=None, chunks=None,
+               history=None):
+    self.path = path
+    self.bayid = bayid
+    self.comments = list(comments)
+    self.appendfrom = appendfrom
+    self.manifest = manifest
+    self.resolution = resolution
+    self.chunks = chunks
+    self.history = history
+
+  def header(self, source_ids, headers):
+    banner = ['Written by AEM3D_prep_IAM']
+    if self.bayid:
+      banner.append(f'Bay ID: {self.bayid}')
+    banner += self.comments
+
+    lines = [BANNER_RULE]
+    lines += ['! ' + line.ljust(len(BANNER_RULE) - 3) + '!' for line in banner]
+    lines += [BANNER_RULE,
+              f'{len(headers)} data sets',
+              '0 seconds between data',
+              '0    ' + '  '.join(str(s) for s in source_ids),
+              'TIME      ' + '  '.join(str(h) for h in headers)]
+    return '\n'.join(lines) + '\n'
+
+  def write(self, data, source_ids, headers = None, decimals=3):
+    '''
+    Write a time series file.
+
+        data - DataFrame (or Series) of values, indexed by time; the index is either
+               a DatetimeIndex or AEM3D ordinal date strings
+        source_ids - source/zone ID for each column, or one ID for all columns
+        headers - column names for the TIME row (default: the data's column names)
+    '''
+    if isinstance(data, pd.Series):
+      data = data.to_frame()
+
+    headers = list(data.columns) if headers is None else list(headers)
+    if self.chunks is not None:
+      self.stream((data.iloc[rows] for rows in self.periods(data.index, self.chunks)),
+                  source_ids, headers, decimals)
+      return
+
+    times = self.encode(data.index)
+    if isinstance(source_ids, str) or not np.iterable(source_ids):
+      source_ids = [source_ids] * len(headers)
+
+    columns = [data.iloc[:, i].to_numpy(dtype='float64', na_value=np.nan) for i in range(data.shape[1])]
+    rows = self.rowdigest(len(headers), decimals)
+    stamps = self.stamps(data.index, times) if rows is not None or self.resolution is not None else None
+    if rows is not None:
+      rows.feed(stamps, columns)
+    if self.resolution is not None:
+      times, columns = self.coarsen(stamps, times, columns, headers)
+    header = self.header(source_ids, headers).encode('ascii')
+
+    key = None
+    if self.manifest is not None:
+      key = self.manifest.key(header, times, decimals, *columns)
+      if self.manifest.unchanged(self.path, key):
+        self.remember(rows, source_ids, headers)
+        return
 
+    if not self.kept(rows, source_ids, headers) or not self.append(header, times, columns, decimals):
+      with open(self.path, mode='wb') as output_file:
+        output_file.write(header)
+        self.write_rows(output_file, times, columns, decimals)
 
+    if key is not None:
+      self.manifest.record(self.path, key)
+    self.remember(rows, source_ids, headers)
 
+  def generate(self, index, make, source_ids, headers, decimals=3):
+    '''
+    Write a time series file made from the rows of index.
+
+        make - function of a slice of index's rows, returning their DataFrame (or
+               Series) of values; called once for all of them, or per chunk when
+               chunks is set
+    '''
+    if self.chunks is None:
+      self.write(make(slice(None)), source_ids, headers, decimals)
+    else:
+      self.stream((make(rows) for rows in self.periods(index, self.chunks)), source_ids, headers, decimals)
+
+  def stream(self, chunks, source_ids, headers, decimals=3):
+    '''
+    Write a time series file from its rows a chunk at a time.
+
+        chunks - DataFrames (or Series) indexed like write()'s data, in time order
+        source_ids, headers - as for write()
+        Comes out as write() makes it from all the rows at once.  Each chunk is
+        coarsened (see align.Coarsening), formatted and written to a .partial file
+        next to the file, hashing it for the manifest, before the next is made;
+        then the partial file replaces the file, is appended from (see append()),
+        or is dropped if the manifest has the file unchanged.  The rows are
+        digested for the history as they come, before they're coarsened.
+    '''
+    headers = list(headers)
+    if isinstance(source_ids, str) or not np.iterable(source_ids):
+      source_ids = [source_ids] * len(headers)
+    header = self.header(source_ids, headers).encode('ascii')
+    coarsening = self.resolution.stream(headers) if self.resolution is not None else None
+    rows = self.rowdigest(len(headers), decimals)
+
+    digest = hashlib.blake2b(header, digest_size=16)
+    ordered = True        # rows in order, so the file can be appended from
+    last = None
+    offset = None         # where the rows from appendfrom on start in the partial file
+
+    partial = self.path + '.partial'
+    with open(partial, mode='wb') as output_file:
+      output_file.write(header)
+
+      def put(times, columns):
+        nonlocal ordered, last, offset
+        if len(times) == 0:
+          return
+        ordered = ordered and not np.any(times[1:] < times[:-1]) and (last is None or last <= times[0])
+        last = times[-1]
+        cutoff = len(times)
+        if self.appendfrom is not None and offset is None:
+          cutoff = np.searchsorted(times, self.appendfrom)
+        for start, end in [(0, cutoff), (cutoff, len(times))]:
+          if start < end and start == cutoff:
+            offset = output_file.tell()
+          for row in range(start, end, WRITE_CHUNK_ROWS):
+            stop = min(end, row + WRITE_CHUNK_ROWS)
+            body = format_rows(times[row:stop], [c[row:stop] for c in columns], decimals)
+            digest.update(body)
+            output_file.write(body)
+
+      for data in chunks:
+        if isinstance(data, pd.Series):
+          data = data.to_frame()
+        times = self.encode(data.index)
+        columns = [data.iloc[:, i].to_numpy(dtype='float64', na_value=np.nan) for i in range(data.shape[1])]
+        stamps = self.stamps(data.index, times) if rows is not None or coarsening is not None else None
+        if rows is not None:
+          rows.feed(stamps, columns)
+        if coarsening is not None:
+          coarse, coarse_times, coarse_columns = coarsening.feed(stamps, columns)
+          put(Datetime.encode(coarse_times.view('datetime64[ns]')), coarse_columns)
+          times, columns = times[coarse:], [column[coarse:] for column in columns]
+        put(times, columns)
+      if coarsening is not None:
+        coarse_times, coarse_columns = coarsening.finish()
+        put(Datetime.encode(coarse_times.view('datetime64[ns]')), coarse_columns)
+      if offset is None:
+        offset = output_file.tell()
+
+    key = digest.hexdigest()
+    if self.manifest is not None and self.manifest.unchanged(self.path, key):
+      os.unlink(partial)
+    else:
+      if not ordered or not self.kept(rows, source_ids, headers) or not self.splice(partial, header, offset):
+        os.replace(partial, self.path)
+      if self.manifest is not None:
+        self.manifest.record(self.path, key)
+    self.remember(rows, source_ids, headers)
+
+  def rowdigest(self, columns, decimals):
+    # a RowDigest for the history's cutoff and appendfrom, None without a history
+    if self.history is None:
+      return None
+    return RowDigest([self.appendfrom, self.history.cutoff], columns, decimals)
+
+  def kept(self, rows, source_ids, headers):
+    # True if the history has the file's rows before appendfrom as digested in rows
+    return (self.appendfrom is not None and rows is not None
+            and self.history.matches(self.path, rows.result(self.appendfrom, source_ids, headers)))
+
+  def remember(self, rows, source_ids, headers):
+    # the digests of the rows written before the history's cutoff, for the next prep
+    if rows is not None:
+      self.history.record(self.path, rows.result(self.history.cutoff, source_ids, headers))
+
+  @staticmethod
+  def encode(index):
+    # AEM3D ordinal date strings of an index of times, or of ordinal dates already
+    if isinstance(index, pd.DatetimeIndex):
+      return Datetime(index).to_AEM3D_datetime()
+    return np.asarray(index, dtype='U')
+
+  @staticmethod
+  def stamps(index, times):
+    # int64 ns times of an index, decoding its ordinal date strings (times) if it's those
+    if isinstance(index, pd.DatetimeIndex):
+      return index.values.astype('datetime64[ns]').view('int64')
+    return Datetime.from_AEM3D_datetime(times).to_datetime().values.astype('datetime64[ns]').view('int64')
+
+  @staticmethod
+  def periods(index, frequency):
+    '''
+    Row slices of an index (times or ordinal dates, in order), one per period of frequency.
+    '''
+    return align.periods(InputFile.stamps(index, InputFile.encode(index)), frequency)
+
+  def coarsen(self, stamps, times, columns, headers):
+    # replace the rows the resolution policy averages; the rest keep their own times
+    #   stamps - the rows' times as int64 ns (see stamps())
+    if np.any(stamps[1:] < stamps[:-1]):
+      return times, columns
+
+    rows, coarse_times, coarse_columns = self.resolution.apply(stamps, columns, headers)
+    if rows == 0:
+      return times, columns
+    times = np.concatenate([Datetime.encode(coarse_times.view('datetime64[ns]')), times[rows:]])
+    columns = [np.concatenate([coarse, column[rows:]]) for coarse, column in zip(coarse_columns, columns)]
+    return times, columns
+
+  def append(self, header, times, columns, decimals=3):
+    '''
+    Update the file an earlier run wrote: keep its rows before appendfrom and
+        replace the rest with the new rows from appendfrom on.
+        Only called once kept() has the history vouch for the kept rows, and
+        only the tail of the old file is read, to find where they end.  If its
+        header differs or it has no rows to keep, nothing is touched and False
+        is returned so the caller rewrites.
+    '''
+    if not os.path.exists(self.path):
+      return False
+    if np.any(times[1:] < times[:-1]):
+      return False
+
+    cutoff = np.searchsorted(times, self.appendfrom)
+    if cutoff == 0:
+      return False
+
+    with open(self.path, mode='r+b') as output_file:
+      offset = self.keptrows(output_file, header)
+      if offset is None:
+        return False
+      output_file.seek(offset)
+      output_file.truncate()
+      self.write_rows(output_file, times[cutoff:], [c[cutoff:] for c in columns], decimals)
+    return True
+
+  def keptrows(self, output_file, header):
+    # in the file an earlier run wrote: where its rows from appendfrom on start;
+    #   None if its header differs or it has no rows before appendfrom
+    if output_file.read(len(header)) != header:
+      return None
+    end = output_file.seek(0, os.SEEK_END)
+
+    # read back from the end until a kept row turns up
+    cutoff_key = self.appendfrom.encode('ascii')
+    block = 1 << 16
+    start = end
+    while True:
+      start = max(len(header), start - block)
+      output_file.seek(start)
+      rows = output_file.read(end - start).splitlines(keepends=True)
+      if start > len(header):
+        first_offset = start + len(rows[0])
+        rows = rows[1:]                # partial row at the start of the block
+      else:
+        first_offset = start
+      kept = sum(1 for row in rows if row[:len(cutoff_key)] < cutoff_key)
+      if kept > 0 or start == len(header):
+        break
+      block *= 2
+
+    if kept == 0:
+      return None
+    return first_offset + sum(len(row) for row in rows[:kept])
+
+  def splice(self, partial, header, offset):
+    # append() for a streamed file: the rows from appendfrom on are copied over from
+    #   offset in the partial file
+    if offset == len(header) or not os.path.exists(self.path):
+      return False
+    with open(self.path, mode='r+b') as output_file:
+      kept = self.keptrows(output_file, header)
+      if kept is None:
+        return False
+      with open(partial, mode='rb') as new_file:
+        new_file.seek(offset)
+        output_file.seek(kept)
+        output_file.truncate()
+        shutil.copyfileobj(new_file, output_file, COPY_CHUNK)
+    os.unlink(partial)
+    return True
+
+  @staticmethod
+  def write_rows(output_file, times, columns, decimals=3):
+    for start in range(0, len(times), WRITE_CHUNK_ROWS):
+      end = start + WRITE_CHUNK_ROWS
+      output_file.write(format_rows(times[start:end], [c[start:end] for c in columns], decimals))
+
+  def read(self):
+    # Return {{Headers}, pandas DF}
+    comments = []
+    header_lines = []
+    with open(self.path, 'r') as input_file:
+      for line in input_file:
+        if line.startswith('!'):
+          comments.append(line.strip('! \n'))
+          continue
+        header_lines.append(line.split())
+        if len(header_lines) == 4:
+          break
+      data = pd.read_csv(input_file, sep=r'\s+', header=None, dtype={0: str})
+
+    headers = {
+      'comments': [c for c in comments if c.strip('-')],
+      'data_sets': int(header_lines[0][0]),
+      'seconds_between_data': int(header_lines[1][0]),
+      'source_ids': header_lines[2][1:],
+      'columns': header_lines[3][1:]
+    }
+    data = data.set_index(0).rename_axis('TIME')
+    data.columns = headers['columns'][:data.shape[1]]
+    return headers, data
 
 
 ## Emulate Python datetime... just add conversion capabilities to/from AEM3D datetime
+#
+#   AEM3D dates are YYYYDDD.ffff : year, zero padded day of year, and the first four
+#   digits of the fraction of the day (truncated, not rounded), e.g. 2023002.0104 for
+#   2023-01-02 00:15.  Datetime holds a whole DatetimeIndex and converts all of it at
+#   once with integer arithmetic, matching AEM3D_prep_IAM.datetimeToOrdinal() byte for byte.
+#   Encodings are memoized per index, so re-encoding the same spinup index is a lookup.
 
 class Datetime:
   
   datetime = None
   aem3d_datetime = None  ## Or, just format on the fly each time
 
-  def from_AEM3D_datetime(aem3d_datetime):
-  
-  def to_AEM3D_datetime():
-    return aem3d_datetime
+  # content fingerprint of an index -> encoded ordinal dates
+  _cache = {}
+  _cache_size = 64
+  _cache_lock = threading.Lock()   # prep stages encode from several threads
+
+  def __init__(self, datetime=None, aem3d_datetime=None):
+    if datetime is not None:
+      datetime = pd.DatetimeIndex(datetime)
+    self.datetime = datetime
+    self.aem3d_datetime = aem3d_datetime
+
+  @classmethod
+  def from_AEM3D_datetime(cls, aem3d_datetime, resolution=60):
+    '''
+    Decode AEM3D ordinal dates (strings or floats) to a DatetimeIndex.
+        The 4 digit day fraction is only good to 8.64 seconds, so times are
+        rounded to the nearest `resolution` seconds (default: whole minutes).
+    '''
+    ordinal = np.atleast_1d(np.asarray(aem3d_datetime))
+    value = ordinal.astype('float64')
+
+    yearday = np.floor(value).astype('int64')
+    year = yearday // 1000
+    dayofyear = yearday % 1000
+    seconds = np.rint((value - yearday) * 86400 / resolution).astype('int64') * resolution
+
+    yearstart = (year - 1970).astype('datetime64[Y]').astype('datetime64[s]')
+    times = yearstart + (dayofyear - 1) * 86400 + seconds
+
+    return cls(datetime=pd.DatetimeIndex(times, name='time'),
+               aem3d_datetime=ordinal.astype('U'))
+
+  def to_AEM3D_datetime(self):
+    if self.aem3d_datetime is None:
+      self.aem3d_datetime = Datetime.encode(self.datetime)
+    return self.aem3d_datetime
+
+  def to_datetime(self):
+    if self.datetime is None:
+      self.datetime = Datetime.from_AEM3D_datetime(self.aem3d_datetime).datetime
+    return self.datetime
+
+  @staticmethod
+  def fingerprint(index):
+    seconds = np.ascontiguousarray(pd.DatetimeIndex(index).values.astype('datetime64[s]').view('int64'))
+    return (len(seconds), hashlib.blake2b(seconds.view('uint8'), digest_size=16).hexdigest())
+
+  @classmethod
+  def encode(cls, index):
+    '''
+    Encode a DatetimeIndex (or anything pandas can make one from) to an array
+        of AEM3D ordinal date strings.
+    '''
+    index = pd.DatetimeIndex(index)
+    key = cls.fingerprint(index)
+    cached = cls._cache.get(key)
+    if cached is not None:
+      return cached.astype('U12')
+
+    seconds = index.values.astype('datetime64[s]').view('int64')
+    days = seconds // 86400
+    daysec = seconds - days * 86400
+
+    year = days.astype('datetime64[D]').astype('datetime64[Y]').view('int64') + 1970
+    yearstart = (year - 1970).astype('datetime64[Y]').astype('datetime64[D]').view('int64')
+    dayofyear = days - yearstart + 1
+    frac = daysec * 10000 // 86400
+
+    # 12 ascii bytes per date: YYYYDDD.ffff
+    digits = np.empty((len(index), 12), dtype='uint8')
+    for pos, (value, width) in enumerate([(year, 4), (dayofyear, 3)]):
+      start = 0 if pos == 0 else 4
+      for d in range(width):
+        digits[:, start + d] = (value // 10 ** (width - 1 - d)) % 10 + ord('0')
+    digits[:, 7] = ord('.')
+    for d in range(4):
+      digits[:, 8 + d] = (frac // 10 ** (3 - d)) % 10 + ord('0')
+
+    encoded = digits.view('S12').ravel().astype('U12')
+
+    # str() of fractions under 1e-4 (1 to 8 seconds past midnight) is in scientific
+    # notation, which datetimeToOrdinal() slices as-is; reproduce it for those rows
+    for i in np.flatnonzero((daysec > 0) & (daysec < 9)):
+      encoded[i] = encoded[i][:7] + str(daysec[i] / 86400.0)[1:6].ljust(5, '0')
+
+    # cache the ascii bytes, a quarter the size of the unicode strings handed back
+    with cls._cache_lock:
+      if len(cls._cache) >= cls._cache_size:
+        cls._cache.pop(next(iter(cls._cache)))
+      cls._cache[key] = encoded.astype('S12')
+    return encoded
 
-  def to_datetime():
-    return datetime
-  
 def main():
   settings = parse_args(sys.argv[1:])
 
@@ -23,15 +23,67 @@ from data import (nwm_forecast,
                   btv_met
 )
 from .waterquality import *
+from .AEM3D import Datetime, InputFile, AppendHistory
+from .stages import Stage, StageGraph
+from .forcing import ForcingStore, ForcingFrame
+from . import align
+from .align import Resolution
+from . import kernels
+from .allocation import SourceAllocation
 
 import pandas as pd
 import numpy as np
 import glob
 import os
+import json
+import time
+import threading
 import datetime as dt
 
 AEM3D_DEL_T = 300
 USE_GFS_CSVS = False
+PREP_WORKERS = 4      # threads for overlapping independent prep stages
+
+# Colchester Reef wind speed scaled to each zone (others: CR_WIND_EXPOSURE_DEFAULT)
+CR_WIND_EXPOSURE = {'403': 0.75}
+CR_WIND_EXPOSURE_DEFAULT = 0.65
+WTR_TEMP_WINDOW = '4D'    # inflow water temp is the air temp averaged over this long
+BAY_TEMP_ZONE = '403'     # zone whose air temp drives inflow water temp and the lake level
+
+# input file rows older than these ages before the forecast date are averaged over
+#   the given steps: as sampled (15 min at best) for the last 30 days, hourly for the
+#   year before that, 6 hourly before then
+RESOLUTION_TIERS = [('30D', '1h'), ('365D', '6h')]
+
+# how each input file column is averaged onto the coarser steps (others: 'mean')
+#   rates are integrated over the step so their totals are kept
+RESOLUTION_AGGREGATION = {
+    'INFLOW': 'conserve',
+    'RAIN': 'conserve',
+    'SNOW': 'conserve',
+    'SOLAR_RAD': 'conserve',
+    'LW_RAD_IN': 'conserve',
+    'LW_RAD_NET': 'conserve',
+    'WIND_DIR': 'circular'
+}
+
+PREP_STATE_FILE = 'prep_state.json'   # in the run directory, for incremental preps
+PREP_MANIFEST_FILE = 'prep_manifest.json'   # in the run directory, hashes of generated files' inputs
+
+# a prep split into workflow jobs (see handoff.py): the prep job runs the
+#   PREP_JOB_STAGES and hands the bay to a job running the WQ_JOB_STAGES
+PREP_JOB_STAGES = ['fetchdata', 'getflowfiles', 'genclimatefiles', 'gensalinefile', 'genboundaryfile',
+                   'gentracerfiles', 'gendatablockfile']
+WQ_JOB_STAGES = ['genwqfiles', 'gencntlfile']
+
+# seconds each upstream source may take, counted from the start of the fetch stage
+FETCH_TIMEOUTS = {
+    'usgs': 600,
+    'nwm': 900,
+    'btv': 600,
+    'colchester': 600,
+    'gfs': 1800
+}
 
 def print_df(df):
     logger.info('\n'
@@ -46,6 +98,12 @@ def colsToHeader(columns):
         return_string += ' ' + str(col)
     return return_string
 
+def bayforcing(theBay):
+    # the bay's aligned forcing store, made on first use
+    if theBay.forcing is None:
+        theBay.forcing = ForcingStore()
+    return theBay.forcing
+
 def remove_nas(series):
     # logger.info('Size with nas')
     # logger.info(len(series))
@@ -97,28 +155,49 @@ def datetimeToOrdinal(date):
 
 
 def seriesIndexToOrdinalDate(series):
-    # Now, using datetimeToOrdinal()
-    ordinaldate = series.index.to_series().apply(datetimeToOrdinal)
+    # Now, using the vectorized (and memoized) AEM3D.Datetime encoder,
+    #   byte-identical to datetimeToOrdinal() applied to every timestamp
+    ordinaldate = Datetime(series.index).to_AEM3D_datetime()
 
     #ordinaldate = pandasDatetimeToOrdinal(series.index)
     #ordinaldate = pd.Series(wrfdf['ordinaldate'].array, index = wrfdf['wrftime'])
     return pd.Series(series.array, index = ordinaldate)
 
-def writeFile(filename, bayid, zone, varName, dataSeries):
-    with open(filename, mode='w', newline='') as output_file:
+def writeFile(filename, bayid, zone, varName, dataSeries, appendfrom=None, manifest=None, resolution=None,
+              chunks=None, history=None):
+    InputFile(filename, bayid, appendfrom=appendfrom, manifest=manifest,
+              resolution=resolution, chunks=chunks, history=history).write(dataSeries, zone, [varName])
 
-        # output the header text
-        output_file.write('!-----------------------------------------------------!\n')
-        output_file.write('! Written by AEM3D_prep_IAM                           !\n')
-        output_file.write(f'! Bay ID: {bayid}                                 !\n')
-        #output_file.write('! Bay Source: ' + bs_name + '                         !\n')
-        output_file.write('!-----------------------------------------------------!\n')
-        output_file.write('1 data sets\n')
-        output_file.write('0 seconds between data\n')
-        output_file.write(f'0            {zone}\n')
-        output_file.write(f'TIME         {varName}\n')
 
-        dataSeries.to_csv(path_or_buf = output_file, float_format='%.3f', sep=' ', index=True, header=False)
+def writezones(THEBAY, frame, prefix, variables, headers, zones):
+    '''
+    writezones : Write climate variables for many zones from a ForcingFrame
+        THEBAY.zonefiles 'each' writes a {prefix}_{zone}.dat per zone; 'combined'
+        writes them all as columns of one {prefix}.dat, on the times every zone has
+        headers - AEM3D names of the variables' columns
+    '''
+    if THEBAY.zonefiles == 'combined':
+        tables = [(f'{prefix}.dat', lambda rows: frame.block(variables, zones, rows),
+                   [zone for zone in zones for _ in variables], headers * len(zones))]
+    elif THEBAY.zonefiles == 'each':
+        tables = ((f'{prefix}_{zone}.dat', lambda rows, zone=zone: frame.table(variables, zone, rows=rows),
+                   zone, headers) for zone in zones)
+    else:
+        raise Exception(f'zonefiles is neither "each" nor "combined": {THEBAY.zonefiles}')
+
+    for filename, table, source_ids, names in tables:
+        logger.info(f'Generating {" / ".join(headers)} File: {filename}')
+        output = InputFile(os.path.join(THEBAY.infile_dir, filename), THEBAY.bayid,
+                           appendfrom=THEBAY.appendfrom, manifest=THEBAY.manifest,
+                           resolution=THEBAY.resolution, chunks=THEBAY.chunks, history=THEBAY.history)
+        if THEBAY.chunks is None:
+            data = table(slice(None))
+            logger.info(print_df(data))
+            output.write(data, source_ids, names)
+        else:
+            # a period of the frame at a time, never the whole table
+            output.stream((table(rows) for rows in frame.periods(THEBAY.chunks)), source_ids, names)
+        THEBAY.addfile(fname=filename)        # remember generated bay files
 
 
 # Doesn't work... need to now calculate in climate_lib
@@ -159,7 +238,12 @@ def writeLongwaveRadiationDownward(climate, THEBAY):
             THEBAY.bayid,
             zone,
             "LW_RAD_IN",
-            seriesIndexToOrdinalDate(climate['AEMLW'][zone]))
+            seriesIndexToOrdinalDate(climate['AEMLW'][zone]),
+            THEBAY.appendfrom,
+            THEBAY.manifest,
+            THEBAY.resolution,
+            THEBAY.chunks,
+            THEBAY.history)
         THEBAY.addfile(fname=filename)
 
 
@@ -177,10 +261,150 @@ def writeCloudCover(climate, THEBAY):
             THEBAY.bayid,
             zone,
             "CLOUDS",
-            seriesIndexToOrdinalDate(climate['AEMLW'][zone]))
+            seriesIndexToOrdinalDate(climate['AEMLW'][zone]),
+            THEBAY.appendfrom,
+            THEBAY.manifest,
+            THEBAY.resolution,
+            THEBAY.chunks,
+            THEBAY.history)
         THEBAY.addfile(fname=filename)
 
 
+#########################################################################
+#
+#   Fetch Upstream Data - all sources loaded concurrently
+#
+##########################################################################
+
+
+def loadgfs(forecastDate, zones):
+    '''
+    loadgfs : GFS forecast climate for every zone, from the GRIB files or the .csv cached from them
+        zones - {zone name: (lat, lon)}; each zone takes its nearest GFS grid cell
+        Returns one DataFrame indexed by time with (variable, zone) columns.
+    '''
+
+    # dates = gfs_tools.generate_date_strings(forecastDate.strftime('%Y%m%d'), 1)
+    # Add [0:2] to generate_hours_list(7) to run shorter test model
+
+    ############## Use this bit to load forecast climate from .csvs previously created above
+    #   one file for all the zones (formerly gfs{zone}.csv per zone)
+    csvfile = f'/data/forecastData/gfs/gfs.{forecastDate.strftime("%Y%m%d")}/gfs_zones.csv'
+    if USE_GFS_CSVS:
+        climateForecast = pd.read_csv(csvfile, header=[0, 1], index_col=0, parse_dates=True)
+        climateForecast = climateForecast.loc[:, climateForecast.columns.get_level_values(1).isin(list(zones))]
+    ##############
+    else:
+    ############## Use this bit to load forecast climate from original GRIB files and create the .csv for quick loading later
+        climateForecast = gfs_tools.get_zone_frame(
+                gfs_dir=f'/data/forecastData/gfs/gfs.{forecastDate.strftime("%Y%m%d")}/00/atmos/',
+                location_dict=zones).rename_axis('time').astype('float')
+        climateForecast.to_csv(csvfile)
+    ##############
+
+    return climateForecast
+
+
+def fetchdata(forecastDate, names=None, timeouts=FETCH_TIMEOUTS, zones=None):
+    '''
+    fetchdata : Start every upstream loader at once and collect the results
+        names - sources to fetch (default all of FETCH_TIMEOUTS)
+        zones - {zone name: (lat, lon)} of the climate zones to get forecasts for
+        timeouts - seconds allowed per source, from when the fetch starts
+        Returns the bundle {source name: loaded data} for the compute stages.
+        A source that fails or runs past its timeout fails the fetch.
+    '''
+
+    loaders = {
+        # dict by id: 04294000 (MS), 04292810 (J-S), 04292750 (Mill)
+        'usgs': lambda: usgs_obs.get_data(ForecastStartDate=forecastDate,
+                                          SpinupStartDate=dt.date(2023,1,2),
+                                          station_ids = ['04294000', '04292810', '04292750']),
+        'nwm': lambda: nwm_forecast.get_data(ForecastStartDate = forecastDate.strftime('%Y%m%d'),
+                                             ForecastStartTimestep = '00',
+                                             download_base_path = '/data/forecastData/nwm'),
+        'btv': lambda: btv_met.get_data(ForecastStartDate=forecastDate,
+                                        SpinupStartDate=dt.date(2023,1,2)),
+        'colchester': lambda: colchester_reef_met.get_data(ForecastStartDate=forecastDate,
+                                                           SpinupStartDate=dt.date(2023,1,2)
+                                                           ).rename_axis('time'),
+        'gfs': lambda: loadgfs(forecastDate, zones)
+    }
+    if names is None:
+        names = list(timeouts)
+
+    sources = {}
+    errors = {}
+
+    def load(name):
+        try:
+            sources[name] = loaders[name]()
+        except Exception as e:
+            errors[name] = e
+
+    # daemon threads, so a source that never answers can't keep the prep from exiting
+    threads = {name: threading.Thread(target=load, args=(name,), name=f'fetch-{name}', daemon=True)
+               for name in names}
+    start = time.monotonic()
+    for thread in threads.values():
+        thread.start()
+
+    for name, thread in threads.items():
+        thread.join(max(0, start + timeouts[name] - time.monotonic()))
+        if thread.is_alive():
+            raise Exception(f'Fetching {name} data timed out after {timeouts[name]}s')
+        if name in errors:
+            logger.info(f'Fetching {name} data failed')
+            raise errors[name]
+        logger.info(f'Fetched {name} data in {time.monotonic() - start:.1f}s')
+
+    return sources
+
+
+def flowforcing(sources):
+    '''
+    flowforcing : The gauges' observed and forecast flows spliced on one clock
+        sources - bundle from fetchdata(), with 'usgs' and 'nwm'
+        Returns the 'flow' ForcingFrame (zone '0'), msflow, jsflow and mlflow in cubic m / s.
+    '''
+
+    # dict by id: 04294000 (MS), 04292810 (J-S), 04292750 (Mill)
+    observedUSGS = sources['usgs']
+    forecastNWM = sources['nwm']
+
+    # Splice observed and forecast flow once per gauge into a forcing frame,
+    #   converting from cubic ft / s to cubic m / s
+    flows = ForcingFrame(['0'])
+    for column, gauge, reach in [('msflow', '04294000', 'MS'),
+                                 ('jsflow', '04292810', 'J-S'),
+                                 ('mlflow', '04292750', 'Mill')]:
+        flows.splice(column,
+                     observedUSGS[gauge]['streamflow'].astype('float') * 0.0283168,
+                     {'0': forecastNWM[reach]['streamflow'].astype('float') * 0.0283168})
+
+    # Fix Mill... it seems to have some negative sensor readings
+    #temp = mlflow[mlflow > 0]
+    #   drop those, then fill every time on the flow clock from the nearest good reading
+    mlflow = flows.series('mlflow', '0')
+    flows.splice('mlflow', mlflow[mlflow >= 0])
+    flows.splice('mlflow', flows.at('mlflow', '0', flows.time, method='nearest'))
+
+    return flows
+
+
+def sharedforcing(sources, zones):
+    '''
+    sharedforcing : Derive the forcing every bay of a batch reads, once, into the bundle
+        sources - bundle from fetchdata(), for the union of the bays' zones
+        zones - the union of the bays' climate zones
+        Adds 'flow' (see flowforcing()) and 'gfs_forcing', the GFS forecast in AEM3D
+        units for every zone (see kernels.GFS_FORCING); returns the bundle.
+    '''
+    sources['flow'] = flowforcing(sources)
+    sources['gfs_forcing'] = kernels.zonal(kernels.GFS_FORCING, sources['gfs'], list(zones))
+    return sources
+
+
 #########################################################################
 #
 #   Import Hydrology Flow - Generate Flow Files
@@ -188,10 +412,11 @@ def writeCloudCover(climate, THEBAY):
 ##########################################################################
 
 
-def getflowfiles(forecastDate, whichbay):
+def getflowfiles(forecastDate, whichbay, sources=None):
     '''
     getflowfiles : Get hydrology model flow file(s) for Bay Inflow
         Most information contained in passed Bay Object
+        sources - bundle from fetchdata(), fetched here if not given
     '''
 
     THEBAY = whichbay
@@ -212,31 +437,15 @@ def getflowfiles(forecastDate, whichbay):
 
     ######### TODO: Instead of from file below, get from data gathering functions
     
-    # dict by id: 04294000 (MS), 04292810 (J-S), 04292750 (Mill)
-    observedUSGS = usgs_obs.get_data(ForecastStartDate=forecastDate,
-                                     SpinupStartDate=dt.date(2023,1,2),
-                                     station_ids = ['04294000', '04292810', '04292750'])
-    forecastNWM = nwm_forecast.get_data(ForecastStartDate = forecastDate.strftime('%Y%m%d'),
-                                       ForecastStartTimestep = '00',
-                                       download_base_path = '/data/forecastData/nwm'
-    )
-
-    # logger.info(observedUSGS)
-    # logger.info(forecastNWM)
-    
-    # Need to adjust for column names and convert from ft / s to m / s
-    flowdf = pd.concat([observedUSGS['04294000'], forecastNWM['MS']]).rename_axis('time').astype('float')
-    mlflow = pd.concat([observedUSGS['04292750'], forecastNWM['Mill']]).rename_axis('time').astype('float')
-    jsflow = pd.concat([observedUSGS['04292810'], forecastNWM['J-S']]).rename_axis('time').astype('float')
+    if sources is None:
+        sources = fetchdata(forecastDate, names=['usgs', 'nwm'])
 
-    # Fix Mill... it seems to have some negative sensor readings
-    #temp = mlflow[mlflow > 0]
-    mlflow =  mlflow[mlflow['streamflow'] >= 0].reindex(flowdf.index, method='nearest')
+    # logger.info(sources['usgs'])
+    # logger.info(sources['nwm'])
 
-    # Convert from cubic ft / s to cubic m / s
-    flowdf = flowdf * 0.0283168
-    mlflow = mlflow * 0.0283168
-    jsflow = jsflow * 0.0283168
+    # The spliced gauge flows, shared by every bay of a batch when it derived them already
+    flows = sources['flow'] if 'flow' in sources else flowforcing(sources)
+    bayforcing(THEBAY).frames['flow'] = flows
 
     # logger.info(flowdf)
     # logger.info(mlflow)
@@ -295,12 +504,8 @@ def getflowfiles(forecastDate, whichbay):
     THEBAY.LastDate = flowdf['ordinaldate'].iloc[-1]
     '''
 
-    flowdf.columns = ['msflow']
-    ## Have to merge the other two because USGS sometimes doesn't return all dates for all gauges
-    jsflow.columns = ['jsflow']
-    flowdf = pd.merge(flowdf, jsflow, on='time', how='inner')
-    mlflow.columns = ['mlflow']
-    flowdf = pd.merge(flowdf, mlflow, on='time', how='inner')
+    ## Only times all gauges have, because USGS sometimes doesn't return all dates for all gauges
+    flowdf = flows.table(['msflow', 'mlflow', 'jsflow'], '0', how='inner')
    
     
     # flowdf['jsflow'] = jsflow['streamflow']
@@ -311,7 +516,7 @@ def getflowfiles(forecastDate, whichbay):
     # logger.info(mlflow.index)
     # logger.info(jsflow.index)   
     
-    flowdf['ordinaldate'] = flowdf.index.to_series().apply(datetimeToOrdinal)
+    flowdf.insert(0, 'ordinaldate', Datetime(flowdf.index).to_AEM3D_datetime())
 
     logger.info(flowdf)
 
@@ -341,38 +546,19 @@ def getflowfiles(forecastDate, whichbay):
     '''
 
     # Store flow series in bay object for later
-    THEBAY.flowdf = flowdf[['ordinaldate', 'msflow', 'mlflow', 'jsflow']].copy()
+    THEBAY.flowdf = flowdf
 
     logger.info('Daily Flow Data Scaled')
     # Scale Additional Inflows from Predicted Inflow
     #       sourcelist has list of source IDs
     #       sourcemap defines the source name and proportion of hydromodel output flow
-    for baysource in THEBAY.sourcelist :
-        logger.info('Generating Bay Source File for Id: '+baysource)
-        bs_prop = THEBAY.sourcemap[baysource]['prop']           # proportion of input file for this source
-        wshed = THEBAY.sourcemap[baysource]['wshed']            # get column name of watershed flow source for this stream
-        flowdf[baysource] = flowdf[wshed] * bs_prop             # scale source from hydromodel flow (some are split)
-        bs_name = THEBAY.sourcemap[baysource]['name']
-        filename = bs_name + '_Flow.dat'
-        logger.info('Bay Source File to Generate: '+filename)
-        # Write Inflow File
-        # open the file in output directory
-        pathedfile = os.path.join(THEBAY.infile_dir, filename)
-        with open(pathedfile, mode='w', newline='') as output_file:
-            THEBAY.addfile(fname=filename)    # remember generated file names
-            # output the header text
-            output_file.write('!-----------------------------------------------------!\n')
-            output_file.write('! Written by AEM3D_prep_IAM                           !\n')
-            output_file.write('! Bay ID: '+ THEBAY.bayid + '                         !\n')
-            output_file.write('! Bay Source: ' + bs_name + '                         !\n')
-            output_file.write('!-----------------------------------------------------!\n')
-            output_file.write('1 data sets\n')
-            output_file.write('0 seconds between data\n')
-            output_file.write('0    ' + baysource + '\n')
-            output_file.write('TIME      INFLOW\n')
-            # output the ordinal date and flow value time dataframe columns
-            flowdf.to_csv(path_or_buf = output_file, columns= ['ordinaldate', baysource], float_format='%.3f',
-            sep=' ', index=False, header=False)
+    #   all sources at once: (time, watersheds) flows times the (watersheds, sources) proportions
+    allocation = SourceAllocation.frombay(THEBAY)
+
+    # Write Inflow Files (or Inflows_Flow.dat, all sources) in output directory
+    allocation.write(THEBAY, [('Flow', 'Inflows_Flow.dat', lambda rows: {'INFLOW': allocation.flows(flowdf.iloc[rows])},
+                               ['INFLOW'])],
+                     flowdf.index)
 
 ##
 #       End of Flow Data Import
@@ -386,7 +572,7 @@ def getflowfiles(forecastDate, whichbay):
 ##########################################################################
 
 
-def genclimatefiles(forecastDate, whichbay):
+def genclimatefiles(forecastDate, whichbay, sources=None):
 
     global SCENARIO
 
@@ -398,49 +584,25 @@ def genclimatefiles(forecastDate, whichbay):
     #
     logger.info('Processing Meterological Data')
 
-    climateObsBTV = btv_met.get_data(ForecastStartDate=forecastDate,
-                                     SpinupStartDate=dt.date(2023,1,2)
-                                     )
+    if sources is None:
+        sources = fetchdata(forecastDate, names=['btv', 'colchester', 'gfs'], zones=THEBAY.zonecoords())
+
+    climateObsBTV = sources['btv']
     # climateObsBTV = {'TCDC': pd.DataFrame(data={'TCDC': [.50, .75, .25, .50]},
     #                                       index=pd.DatetimeIndex(data=pd.date_range('2021-09-08 20:45:00', periods=4, freq='H'), name='time')),
     #                  'RAIN': pd.DataFrame(data={'RAIN': [.5, .3, .1, 0.0]},
     #                                       index=pd.DatetimeIndex(data=pd.date_range('2021-09-08 20:00:00', periods=4, freq='H'), name='time'))
     #                 }
     
-    climateObsCR = colchester_reef_met.get_data(ForecastStartDate=forecastDate,
-                                                SpinupStartDate=dt.date(2023,1,2)
-                                                ).rename_axis('time')
-    
-    # dates = gfs_tools.generate_date_strings(forecastDate.strftime('%Y%m%d'), 1)
-    # Add [0:2] to generate_hours_list(7) to run shorter test model
-
-    ############## Use this bit to load forecast climate from .csvs previously created above
-    if USE_GFS_CSVS:
-        climateForecast = {}
-        for zone in ['401', '402', '403']:
-            climateForecast[zone] = pd.read_csv(
-                        f'/data/forecastData/gfs/gfs.{forecastDate.strftime("%Y%m%d")}/gfs{zone}.csv',
-                        index_col='time',
-                        parse_dates=True)
-    ##############
-    else:
-    ############## Use this bit to load forecast climate from original GRIB files and create .csvs for quick loading later
-        climateForecast = gfs_tools.get_data(
-                gfs_dir=f'/data/forecastData/gfs/gfs.{forecastDate.strftime("%Y%m%d")}/00/atmos/',
-                location_dict={'401': (45.00, -73.25),
-                               '402': (44.75, -73.25),
-                               '403': (44.75, -73.25)})
-        for zone in climateForecast.keys():
-            climateForecast[zone] = climateForecast[zone].rename_axis('time').astype('float')
-            climateForecast[zone].to_csv(f'/data/forecastData/gfs/gfs.{forecastDate.strftime("%Y%m%d")}/gfs{zone}.csv')
-    ##############
+    climateObsCR = sources['colchester']
+    climateForecast = sources['gfs']
 
     logger.info('BTV Data')
     logger.info(print_df(climateObsBTV['TCDC']))
     logger.info('Colchester Data')
     logger.info(print_df(climateObsCR))
-    logger.info('GFS Data (Zone 401)')
-    logger.info(print_df(climateForecast['401']))
+    logger.info('GFS Data')
+    logger.info(print_df(climateForecast))
 
     '''
     climate = [
@@ -492,57 +654,56 @@ def genclimatefiles(forecastDate, whichbay):
     #
     #print('Whole dataset TEMP Shape')
     #print(wrf_data.variables['T2'].shape)
+    #   Each variable's observations and forecasts are spliced once, for all
+    #   zones, into the bay's forcing store: 'met' on the Colchester Reef + GFS
+    #   clock and 'lcd' on the BTV + GFS clock
+    #
+    #   The zones are the bay's climateZones, however many; each file type is
+    #   written for the zones whose group lists its variable
+    #
+    zones = list(THEBAY.zonecoords())
+    if not zones:
+        raise Exception(f'Bay {THEBAY.bayid} has no climate zones')
+    met = bayforcing(THEBAY).frame('met', zones)
+    lcd = bayforcing(THEBAY).frame('lcd', zones)
+
+    #   Derived variables (unit conversions, wind from U/V, ...) for every
+    #   zone in one pass, from the formulas in kernels.py
+    #   (a batch derived them for every bay's zones already)
+    if 'gfs_forcing' in sources:
+        forecast = {name: frame[zones] for name, frame in sources['gfs_forcing'].items()}
+    else:
+        forecast = kernels.zonal(kernels.GFS_FORCING, climateForecast, zones)
+    exposure = np.array([[CR_WIND_EXPOSURE.get(zone, CR_WIND_EXPOSURE_DEFAULT)] for zone in zones])
+    observedCR = kernels.zonal(kernels.CR_FORCING, climateObsCR, zones, exposure=exposure)
+
     # New air_temp -- adjust window below if not hourly
-    air_temp = {"401": pd.concat([remove_nas(climateObsCR['T2']),climateForecast['401']['T2']-273.15]),
-                "402": pd.concat([remove_nas(climateObsCR['T2']),climateForecast['402']['T2']-273.15]),
-                "403": pd.concat([remove_nas(climateObsCR['T2']),climateForecast['403']['T2']-273.15])
-     }
-    
-    logger.info(print_df(air_temp['401']))
+    met.splice('T2', remove_nas(climateObsCR['T2']), forecast['T2'])
+    air_temp = met.series('T2', BAY_TEMP_ZONE)      # Use air temp at zone 403 (ILS)
+
+    logger.info(print_df(met.series('T2', zones[0])))
 
     # air_temp = climate['T2']    # temp at 2m
     #wrfdf['wtr_temp'] = wrfdf['air_temp'].rolling(window=4,min_periods=1).mean() # moving average over 4 days
-    # Use air temp at zone 403 (ILS)
-    wtr_temp = air_temp['403'].rolling(window=96,min_periods=1).mean() # moving average over 4 days
+    # wtr_temp = air_temp.rolling(window=96,min_periods=1).mean() # 96 samples is 4 days only for hourly data
+    # moving average over 4 days of time, whatever the sampling (15 min obs, 1 then 3 hourly GFS)
+    wtr_temp = pd.Series(align.window_mean(*align.arrays(air_temp), WTR_TEMP_WINDOW), index=air_temp.index)
 
     wtr_temp.loc[wtr_temp<0] = 0  # no subfreezing water
     wtr_temp = wtr_temp + 0.75    # 0.75 correction based on WQS Docs 2021.05.27
 
     # Store temp series in bay object for later use in wq calcs
     # THEBAY.tempdf = wrfdf[['ordinaldate', 'wtr_temp']].copy()
-    THEBAY.tempdf = pd.DataFrame({'ordinaldate' : wtr_temp.index.to_series().apply(datetimeToOrdinal), 'wtr_temp' : wtr_temp.array})
+    THEBAY.tempdf = pd.DataFrame({'ordinaldate' : Datetime(wtr_temp.index).to_AEM3D_datetime(), 'wtr_temp' : wtr_temp.array})
 
 
     #
-    #       Write the temperature file for each source of the bay
+    #       Write the temperature file for each source of the bay (or Inflows_Temp.dat, all
+    #       sources), the same series for all of them
     #
-    for baysource in THEBAY.sourcelist :
-
-        bs_name = THEBAY.sourcemap[baysource]['name']
-        filename = bs_name + '_Temp.dat'
-        logger.info('Generating Bay Source Temperature File: '+filename)
-
-        # Write Temp File
-        # open the file in output directory
-        pathedfile = os.path.join(THEBAY.infile_dir, filename)
-        with open(pathedfile, mode='w', newline='') as output_file:
-
-            THEBAY.addfile(fname=filename)        # remember generated bay files
-
-            # output the header text
-            output_file.write('!-----------------------------------------------------!\n')
-            output_file.write('! Written by AEM3D_prep_IAM                           !\n')
-            output_file.write('! Bay ID: '+ THEBAY.bayid + '                            !\n')
-            output_file.write('! Bay Source: ' + bs_name + '                         !\n')
-            output_file.write('!-----------------------------------------------------!\n')
-            output_file.write('1 data sets\n')
-            output_file.write('0 seconds between data\n')
-            output_file.write('0    '+baysource+'\n')
-            output_file.write('TIME      WTR_TEMP\n')
-
-            # output the ordinal date and temp dataframe columns
-            seriesIndexToOrdinalDate(wtr_temp).to_csv(path_or_buf = output_file, float_format='%.3f',
-            sep=' ', index=True, header=False)
+    SourceAllocation.frombay(THEBAY).write(
+        THEBAY, [('Temp', 'Inflows_Temp.dat', {'WTR_TEMP': wtr_temp.to_numpy()}, ['WTR_TEMP'])],
+        wtr_temp.index)
 
     #
     #   end water temp file
@@ -554,8 +715,21 @@ def genclimatefiles(forecastDate, whichbay):
     bay_rain = dict()
     bay_snow = dict()
 
-    ### TODO: Remove hardcoded single RAIN zone
-    for zone in ['403']:
+    # ['RAIN'] for BTV to get to a series
+    # AEM3D wants meters/day
+    # BTV is in inches/hr so thats * 24 to get hr -> day and * 0.0254 to convert inches to meters
+    #   for a total of 0.6096
+    #   LCD Ref: https://www.ncei.noaa.gov/pub/data/cdo/documentation/LCD_documentation.pdf
+    # GFS is in kg/m^2/s. kg/m^2 is mm, so really mm/s. To convert, * 86400 to get sec -> day,
+    #   and / 1000 to get mm to m, so, in all, * 86.4
+    #   GFS Ref: https://www.nco.ncep.noaa.gov/pmb/products/gfs/gfs.t00z.pgrb2.0p25.f003.shtml
+    #   precip zones: BTV observations, then each zone's own forecast
+    rainzones = THEBAY.zonesfor('RAIN')
+    observedRain = climateObsBTV['RAIN']['RAIN']
+    lcd.splice('RAIN', pd.Series(kernels.BTV_FORCING(RAIN=observedRain)['RAIN'], index=observedRain.index),
+               forecast['RAIN'][rainzones])
+
+    for zone in rainzones:
         ###bay_rain[zone] = climate['RAIN'][zone] * 24 / 1000.0     # want daily cummulative rate in meters
         
         # logger.info('BTV Rain')
@@ -564,15 +738,7 @@ def genclimatefiles(forecastDate, whichbay):
         # logger.info('GFS Rain')
         # logger.info(print_df(climateForecast[zone]['RAIN']))
         
-        # ['RAIN'] for BTV to get to a series
-        # AEM3D wants meters/day
-        # BTV is in inches/hr so thats * 24 to get hr -> day and * 0.0254 to convert inches to meters
-        #   for a total of 0.6096
-        #   LCD Ref: https://www.ncei.noaa.gov/pub/data/cdo/documentation/LCD_documentation.pdf
-        # GFS is in kg/m^2/s. kg/m^2 is mm, so really mm/s. To convert, * 86400 to get sec -> day,
-        #   and / 1000 to get mm to m, so, in all, * 86.4
-        #   GFS Ref: https://www.nco.ncep.noaa.gov/pmb/products/gfs/gfs.t00z.pgrb2.0p25.f003.shtml
-        bay_rain[zone] = pd.concat([climateObsBTV['RAIN']['RAIN'] * 0.6096, climateForecast[zone]['RAIN'] * 86.4])
+        bay_rain[zone] = lcd.series('RAIN', zone)
 
         ################################
         ## Resampling was an ok idea, but let's try reindexing temp to rain first -- see below
@@ -590,7 +756,7 @@ def genclimatefiles(forecastDate, whichbay):
         # logger.info('Air Temp after resample')
         # logger.info(print_df(TEMP))
         #########################################
-        TEMP = air_temp[zone].reindex(bay_rain[zone].index, method='nearest')
+        TEMP = met.at('T2', zone, bay_rain[zone].index, method='nearest')
 
         logger.info('TEMP after reindex')
         logger.info(print_df(TEMP))
@@ -606,14 +772,11 @@ def genclimatefiles(forecastDate, whichbay):
         # See Pat's rainToSnow.R
         # Calculate ratio using SNOW/PRCP, only take 1991 - present and days where SNOW and PRCP > 0
         # Tried using TMAX, but TAVG ((TMAX + TMIN)/2) got a curve closer to NASA table and makes more sense
-        snowcoeff = np.exp(2.1413626 - 0.1921400*TEMP - 0.0079924*TEMP*TEMP)
+        #snowcoeff = np.exp(2.1413626 - 0.1921400*TEMP - 0.0079924*TEMP*TEMP)
+        # Now kernels.SNOW, along with the -2.0 C cutoff below
 
         logger.info('bay_rain')
         logger.info(print_df(bay_rain[zone]))
-        
-        # Also a series, name = T2
-        logger.info('snowcoeff')
-        logger.info(print_df(snowcoeff))
 
         #####################
         ## Need to merge bay_rain and snowcoeff first (intersection) before calculation to make sure the equation has a result
@@ -624,18 +787,15 @@ def genclimatefiles(forecastDate, whichbay):
         ## Formerly...
         # bay_snow[zone] = bay_rain[zone] * snowcoeff
 
-        ## But, now...
-        ## Merge bay_rain and snowcoeff by time stamps so we know we have times for both
-        snowcalc_df = pd.merge(bay_rain[zone], snowcoeff, on='time', how='inner')
-        logger.info('snowcalc_df')
-        logger.info(print_df(snowcalc_df))
-        bay_snow[zone] = snowcalc_df['RAIN'] * snowcalc_df['T2']
-
+        ## Then, merged bay_rain and snowcoeff by time stamps so we know we have times for both
+        ## But, now... TEMP (so snowcoeff) was reindexed to the rain's times, they line up already
         # bay_snow[zone] = bay_rain[zone] * snowcoeff
         
         # If too warm, no snow - Use -2.0 C to get mean snowfall for 2017-2020 close to calibration data
         #  NOAA table above uses 34 F (1.1 C)
-        bay_snow[zone].loc[TEMP > -2.0] = 0.0
+        # bay_snow[zone].loc[TEMP > -2.0] = 0.0
+        bay_snow[zone] = pd.Series(kernels.SNOW(RAIN=bay_rain[zone], TEMP=TEMP)['SNOW'],
+                                   index=bay_rain[zone].index, name='SNOW')
         # In the WQS AEM3D calibration SNOW / RAIN data, RAIN looks like snow equivalent
         #   and SNOW is depth of snow, so we should have values for both when it snows
         # bay_rain[zone].loc[bay_snow[zone] > 0.0] = 0.0
@@ -652,36 +812,8 @@ def genclimatefiles(forecastDate, whichbay):
     #
     # Write Precip Files for Bay
     #
-    for zone in bay_rain.keys():
-        #################################
-        # Hardcode zone to 0 for now... only one precip station
-        filename = f'PRECIP_0.dat'
-        logger.info('Generating Bay Precipitation File: '+filename)
-
-        with open(os.path.join(THEBAY.infile_dir, filename), mode='w', newline='') as output_file:
-
-            THEBAY.addfile(fname=filename)        # remember generated bay files
-
-            # output the header text
-            output_file.write('!-----------------------------------------------------!\n')
-            output_file.write('! Written by AEM3D_prep_IAM                           !\n')
-            output_file.write('! Bay ID: '+ THEBAY.bayid + '                         !\n')
-            #output_file.write('! Bay Source: ' + bs_name + '                        !\n')
-            output_file.write('!-----------------------------------------------------!\n')
-            output_file.write('2 data sets\n')
-            output_file.write('0 seconds between data\n')
-            output_file.write('0    0    0\n')
-            output_file.write('TIME      RAIN     SNOW\n')
-
-            # output the ordinal date and flow value time dataframe columns
-            pd.concat([
-                    seriesIndexToOrdinalDate(bay_rain[zone]),
-                    seriesIndexToOrdinalDate(bay_snow[zone])],
-                    axis=1).to_csv(
-                    path_or_buf = output_file,
-                    float_format='%.3f',
-                    sep=' ',
-                    index=True, header=False)
+    lcd.splice('SNOW', None, bay_snow)
+    writezones(THEBAY, lcd, 'PRECIP', ['RAIN', 'SNOW'], ['RAIN', 'SNOW'], rainzones)
 
     #
     #   end precip file
@@ -701,23 +833,9 @@ def genclimatefiles(forecastDate, whichbay):
     #     writeLongwaveRadiationDownward(climate, THEBAY)
 
     # Use Cloud Cover
-    for zone in climateForecast.keys():
-        filename = f'CLOUDS_{zone}.dat'
-        logger.info('Generating Bay Cloud Cover File: '+filename)
-        
-        # Divide GFS TCDC by 100 to get true percentage
-        cloud_series = seriesIndexToOrdinalDate(pd.concat([climateObsBTV['TCDC']['TCDC'],climateForecast[zone]['TCDC']/100.0]))
-        logger.info(f'TCDC for zone {zone}')
-        logger.info(print_df(cloud_series))
-
-        writeFile(
-            os.path.join(THEBAY.infile_dir, filename),
-            THEBAY.bayid,
-            zone,
-            "CLOUDS",
-            cloud_series
-        )
-        THEBAY.addfile(fname=filename)
+    # Divide GFS TCDC by 100 to get true percentage
+    lcd.splice('TCDC', climateObsBTV['TCDC']['TCDC'], forecast['TCDC'])
+    writezones(THEBAY, lcd, 'CLOUDS', ['TCDC'], ['CLOUDS'], THEBAY.zonesfor('AEMLW'))
 
     ###########################################################################################
     #
@@ -730,62 +848,16 @@ def genclimatefiles(forecastDate, whichbay):
     #            (without the iloc[] at the end) and then
     #            each column of that new dataframe is the windspeed series for each location
     #            !! Similar issue for winddir and rhum
-    windspd = dict()
-    winddir = dict()
-    for zone in climateForecast.keys():
-        # a bit of vector math to combine the East(U) and North(V) wind components
-        windspd[zone] = np.sqrt(
-            np.square(climateForecast[zone]['U10']) +
-            np.square(climateForecast[zone]['V10'])
-        )
-        if zone == '403':
-            windspd[zone] = pd.concat([(remove_nas(climateObsCR['WSPEED']) * 0.75), windspd[zone]])
-        else:
-            windspd[zone] = pd.concat([(remove_nas(climateObsCR['WSPEED']) * 0.65), windspd[zone]])
-
-        #  a bit of trig to map the wind vector components into a direction
-        #  𝜙 =180+(180/𝜋)*atan2(𝑢,𝑣)
-        winddir[zone] = 180 + np.arctan2(
-                climateForecast[zone]['U10'],
-                climateForecast[zone]['V10']
-            ) * 180 / np.pi
-        winddir[zone] = pd.concat([remove_nas(climateObsCR['WDIR']), winddir[zone]])
-
-        logger.info(f'WINDSP for zone {zone}')
-        logger.info(print_df(windspd[zone]))        
-        logger.info(f'WINDDIR for zone {zone}')
-        logger.info(print_df(winddir[zone]))        
+    #   Speed and direction from the U and V components are in kernels.GFS_FORCING,
+    #   the Colchester Reef speed scaled to each zone in kernels.CR_FORCING
+    met.splice('WIND_SPEED', {zone: remove_nas(observedCR['WIND_SPEED'][zone]) for zone in zones},
+               forecast['WIND_SPEED'])
+    met.splice('WIND_DIR', remove_nas(climateObsCR['WDIR']), forecast['WIND_DIR'])
 
     # Write Wind Speed and Direction File
     #
-    for zone in windspd.keys():
-        filename = f'WS_WD_{zone}.dat'
-        logger.info('Generating Wind Speed and Direction File: '+filename)
-
-        with open(os.path.join(THEBAY.infile_dir, filename), mode='w', newline='') as output_file:
-
-            THEBAY.addfile(fname=filename)        # remember generated bay files
-
-            # output the header text
-            output_file.write('!-----------------------------------------------------!\n')
-            output_file.write('! Written by AEM3D_prep_IAM                           !\n')
-            output_file.write('! Bay ID: '+ THEBAY.bayid + '                            !\n')
-            #output_file.write('! Bay Source: ' + bs_name + '                         !\n')
-            output_file.write('!-----------------------------------------------------!\n')
-            output_file.write('2 data sets\n')
-            output_file.write('0 seconds between data\n')
-            output_file.write(f'0            {zone}          {zone}\n')
-            output_file.write('TIME         WIND_SPEED	  WIND_DIR\n')
-
-            # output the ordinal date and flow value time dataframe columns
-            pd.concat([
-                seriesIndexToOrdinalDate(windspd[zone]),
-                seriesIndexToOrdinalDate(winddir[zone])],
-                axis=1).to_csv(
-                path_or_buf = output_file,
-                float_format='%.3f',
-                sep=' ',
-                index=True, header=False)
+    writezones(THEBAY, met, 'WS_WD', ['WIND_SPEED', 'WIND_DIR'], ['WIND_SPEED', 'WIND_DIR'],
+               THEBAY.zonesfor('U10'))
     #
     #   end wind file
 
@@ -812,38 +884,18 @@ def genclimatefiles(forecastDate, whichbay):
     #     rhum_temp[rhum_temp>1] = 1
     #     rhum_temp[rhum_temp<0] = 0
     #     rhum[zone] = rhum_temp
-    rhum = {}
-    rhum['0'] = pd.concat([remove_nas(climateObsCR['RH2']) * .01, climateForecast['403']['RH2'] * .01])   
-    
-    logger.info(f'RH2')
-    logger.info(print_df(rhum['0']))
+    # relative humidity zones (ILS: zone 0, at zone 403's grid cell)
+    rhzones = THEBAY.zonesfor('RH2')
+    met.splice('RH2', {zone: remove_nas(observedCR['RH2'][zone]) for zone in rhzones}, forecast['RH2'][rhzones])
 
     #   Write Relative Humidity File
     #
-    for zone in rhum.keys():
-        filename = f'RELHUM_{zone}.dat'
-        logger.info('Generating Rel Humidity File: '+filename)
-        writeFile(
-            os.path.join(THEBAY.infile_dir, filename),
-            THEBAY.bayid,
-            zone,
-            "REL_HUM",
-            seriesIndexToOrdinalDate(rhum[zone]))
-        THEBAY.addfile(fname=filename)
+    writezones(THEBAY, met, 'RELHUM', ['RH2'], ['REL_HUM'], rhzones)
 
 
     #   Write Air Temp File
     #
-    for zone in air_temp.keys():
-        filename = f'AIRTEMP_{zone}.dat'
-        logger.info('Generating Air Temp File: '+filename)
-        writeFile(
-            os.path.join(THEBAY.infile_dir, filename),
-            THEBAY.bayid,
-            zone,
-            "AIR_TEMP",
-            seriesIndexToOrdinalDate(air_temp[zone]))
-        THEBAY.addfile(fname=filename)
+    writezones(THEBAY, met, 'AIRTEMP', ['T2'], ['AIR_TEMP'], THEBAY.zonesfor('T2'))
 
 
     # Write ShortwaveRad File
@@ -851,22 +903,8 @@ def genclimatefiles(forecastDate, whichbay):
     #swdown = climate['SWDOWN'] # * 0.875         # Scale Solar based on matching observed for 2018
     #
 
-    for zone in climateForecast.keys():
-        filename = f'SOLAR_{zone}.dat'
-        logger.info('Generating Short Wave Radiation File: '+filename)
-        
-        swdown_series = seriesIndexToOrdinalDate(pd.concat([remove_nas(climateObsCR['SWDOWN']), climateForecast[zone]['SWDOWN']]))
-        logger.info(f'SWDOWN for zone {zone}')
-        logger.info(print_df(swdown_series))
-        
-        writeFile(
-            os.path.join(THEBAY.infile_dir, filename),
-            THEBAY.bayid,
-            zone,
-            "SOLAR_RAD",
-            swdown_series
-        )
-        THEBAY.addfile(fname=filename)
+    met.splice('SWDOWN', remove_nas(climateObsCR['SWDOWN']), climateForecast['SWDOWN'][zones])
+    writezones(THEBAY, met, 'SOLAR', ['SWDOWN'], ['SOLAR_RAD'], THEBAY.zonesfor('SWDOWN'))
 
 
     ###
@@ -924,12 +962,16 @@ def genclimatefiles(forecastDate, whichbay):
     # wrfdailyF = 32 + 1.8 * wrfdailyraw.dropna(axis=0, inplace=False, how='any')
     # TemperatureF = wrfdailyF.to_numpy()
     
-    ## Now...
-    ### Need to merge these df's together on time stamp
-    lakeLevel_df = pd.merge(lakeLevel_df, air_temp['403'], on='time', how='inner')
+    ## Then, merged these df's together on time stamp
+    ## Now... look the flow times up in the aligned air temps, keeping the ones that have one
+    hasTemp, lakeTemp = met.lookup('T2', BAY_TEMP_ZONE, lakeLevel_df.index)
+    lakeLevel_df = lakeLevel_df[hasTemp].assign(T2=lakeTemp)
     logger.info(f'lakelevel_df after merge')
     logger.info(print_df(lakeLevel_df))
 
+    # Store the regression inputs in bay object for later use (parameter sweeps)
+    THEBAY.lakedf = lakeLevel_df
+
     # print('Air Temp Raw Stats (C)')
     # print(air_temp['403'].describe(percentiles=[]))
     # print(wrfdailyraw.describe(percentiles=[]))
@@ -938,25 +980,10 @@ def genclimatefiles(forecastDate, whichbay):
     # print(TemperatureF.describe(percentiles=[]))
 
     # print('Calculating Lake Levels')
-    lakeLevel_df['LakeLevel'] = 94.05887 + 0.007910834 * lakeLevel_df['T2'] + \
-        7.034478e-05 * lakeLevel_df['msflow'] + \
-        0.003396492 * lakeLevel_df['flowmean_07'] + \
-        0.01173037 * lakeLevel_df['flowmean_30'] + \
-        0.0258206 * lakeLevel_df['flowmean_60']
-
-    # print(flowdf['LakeLevel'].describe(percentiles=[]))
-
-    # print('Calculating Lake Level Bias')
-    # Next, apply the bias correction from the bias correction quadratic regression on the residuals against the observed lake level:
-    bias_correction = -358.51020205 + \
-        7.16150850 * lakeLevel_df['LakeLevel'] + \
-        -0.03570562 * np.power(lakeLevel_df['LakeLevel'],2)
-
-    lakeLevel_df['LakeLevel_corrected'] = lakeLevel_df['LakeLevel'] + bias_correction
-
-
-    #	AEM3D lake input defined as meters above 93ft - do the math
-    lakeLevel_df['LakeLevel_delta'] = (lakeLevel_df['LakeLevel_corrected'] - 93) * 0.3048
+    #   The regression, the bias correction from the quadratic regression on the
+    #   residuals against the observed lake level, and AEM3D's lake input as meters
+    #   above 93ft are in kernels.LAKE_LEVEL
+    lakeLevel_df = lakeLevel_df.assign(**lakelevels(lakeLevel_df))
 
     #
     #   write out lake level file
@@ -971,34 +998,8 @@ def genclimatefiles(forecastDate, whichbay):
     #                             )
     #####################################
 
-    filename = 'Lake_Level.dat'
-    logger.info('Writing Lake Level File '+filename)
-
-    pathedfile = os.path.join(THEBAY.infile_dir, filename)
-    with open(pathedfile, mode='w', newline='') as output_file:
-
-        THEBAY.addfile(fname=filename)        # remember generated bay files
-
-        # output the header text
-        output_file.write(
-            '!-----------------------------------------------------!\n')
-        output_file.write(
-            '! Written by AEM3D_prep_IAM                           !\n')
-        output_file.write('! Bay ID: ' + THEBAY.bayid +
-                          '                            !\n')
-        output_file.write(
-            '! values in (m) above 93 ft                           !\n')
-        output_file.write(
-            '!-----------------------------------------------------!\n')
-        output_file.write('1 data sets\n')
-        output_file.write('0 seconds between data\n')
-        output_file.write('0    300\n')
-        output_file.write('TIME	  HEIGHT\n')
-
-        # output the ordinal date and flow value time dataframe columns for AEM3D and as .csv
-        lakeLevel_df.to_csv(path_or_buf=output_file, columns=['ordinaldate', 'LakeLevel_delta'], float_format='%.3f',
-                      sep=' ', index=False, header=False)
-        # lakeLevel_df.to_csv(path_or_buf='lakeheight.csv', float_format='%.3f', sep=' ', index=False, header=True)
+    writelakelevel(THEBAY, lakeLevel_df['ordinaldate'].to_numpy(), lakeLevel_df['LakeLevel_delta'].to_numpy())
+    # lakeLevel_df.to_csv(path_or_buf='lakeheight.csv', float_format='%.3f', sep=' ', index=False, header=True)
 
     ##
     #
@@ -1007,6 +1008,37 @@ def genclimatefiles(forecastDate, whichbay):
     #
 
 
+def lakelevels(lakedf, coefficients=kernels.LAKE_LEVEL_COEFFICIENTS):
+    '''
+    lakelevels : The lake level regression (kernels.LAKE_LEVEL) on its inputs
+        lakedf - the flows, their means and air temp (THEBAY.lakedf)
+        coefficients - {name: value}; (sets, 1) columns of them give a row of levels per set
+    '''
+    return kernels.LAKE_LEVEL(**{column: lakedf[column].to_numpy()
+                                 for column in kernels.LAKE_LEVEL.inputs if column not in coefficients},
+                              **coefficients)
+
+
+def writelakelevel(THEBAY, ordinaldate, level):
+    '''
+    writelakelevel : Write the lake level file, meters above 93 ft at the ordinal dates
+    '''
+    filename = 'Lake_Level.dat'
+    logger.info('Writing Lake Level File '+filename)
+
+    # output the ordinal date and lake level columns for AEM3D
+    InputFile(os.path.join(THEBAY.infile_dir, filename),
+              THEBAY.bayid,
+              ['values in (m) above 93 ft'],
+              THEBAY.appendfrom,
+              THEBAY.manifest,
+              THEBAY.resolution,
+              THEBAY.chunks,
+              THEBAY.history
+              ).write(pd.DataFrame({'LakeLevel_delta': level}, index=ordinaldate), '300', ['HEIGHT'])
+    THEBAY.addfile(fname=filename)        # remember generated bay files
+
+
 def gensalinefile(theBay):
     #
     #   Salinity data time series
@@ -1037,21 +1069,14 @@ def gentracerfiles(theBay):
     # Write Tracer Files - fixed series, use templates and set $year
     #
 
-    for templateFile in [f for f in os.listdir(theBay.template_dir) if 'Tracer' in f]:
-        generate_file_from_template(templateFile,
-                                    os.path.splitext(templateFile)[0]+'.dat',
-                                    theBay,
-                                    {'firstdate': theBay.FirstDate,
-                                     'lastdate': theBay.LastDate
-                                    })
-    
-    generate_file_from_template('tracer_release.template',
-                                'tracer_release.dat',
-                                theBay,
-                                {'firstdate': theBay.FirstDate,
-                                 'lastdate': theBay.LastDate
-                                },
-                                'update_file')
+    templates = theBay.templateregistry()
+    dates = {'firstdate': theBay.FirstDate,
+             'lastdate': theBay.LastDate
+            }
+    templates.render(theBay,
+                     [(templateFile, os.path.splitext(templateFile)[0]+'.dat', dates)
+                      for templateFile in templates.find('Tracer')] +
+                     [('tracer_release.template', 'tracer_release.dat', dates, 'update_file')])
     #
     # End of Tracer File Generation
     #
@@ -1066,8 +1091,7 @@ def gencntlfile(forecastDate, theBay):
 
     logger.info(f'Configuring AEM3D to run {iterations} iterations')
     
-    with open(os.path.join(theBay.template_dir, 'aem3dcntl.template.txt'), 'r') as file:
-        template = Template(file.read())
+    template = theBay.templateregistry().template('aem3dcntl.template.txt')
 
     # control file is written to runtime directory
     pathedfile = os.path.join(theBay.run_dir, 'run_aem3d.dat')
@@ -1097,7 +1121,7 @@ def gencntlfile(forecastDate, theBay):
         # output_file.write(
         #     ' datablock.xml                                     datablock_file\n')
 
-        for f, t in theBay.bayfiles:        # for each filename, filetype
+        for f, t in theBay.orderedfiles():        # for each filename, filetype
             output_file.write(' '+f+'              '+t+'\n')
 
         output_file.write(
@@ -1125,32 +1149,187 @@ def gendatablockfile(forecastDate, theBay):
                                 'datablock_file')
 # end of datablock.xml generation
  
-def AEM3D_prep_IAM(forecastDate, theBay):
+def loadprepstate(theBay):
+    # what saveprepstate() recorded of the last run, or None
+    statefile = os.path.join(theBay.run_dir, PREP_STATE_FILE)
+    if not os.path.exists(statefile):
+        return None
+    with open(statefile, 'r') as file:
+        return json.load(file)
+
+
+def appendcutoff(forecastDate, theBay):
+    '''
+    appendcutoff : Where an incremental prep can start rewriting the input files
+        The previous run's forecast start: rows before it were observations, rows
+        from it on were forecast and get replaced.  None (rebuild everything) if
+        there is no previous run for the same spinup start.
+    '''
+
+    state = loadprepstate(theBay)
+    if state is None:
+        logger.info('No previous prep found, rebuilding all input files')
+        return None
+
+    lastForecastDate = dt.date.fromisoformat(state['forecastDate'])
+    if state['FirstDate'] != theBay.FirstDate or lastForecastDate > forecastDate:
+        logger.info('Previous prep does not line up with this one, rebuilding all input files')
+        return None
+
+    cutoff = Datetime([lastForecastDate]).to_AEM3D_datetime()[0]
+    logger.info(f'Appending to input files from {cutoff} ({lastForecastDate})')
+    return cutoff
+
+
+def saveprepstate(forecastDate, theBay):
+    # record this run for the next incremental prep, with the digests of the rows
+    #   each file keeps (see AEM3D.AppendHistory)
+    with open(os.path.join(theBay.run_dir, PREP_STATE_FILE), 'w') as file:
+        json.dump({'forecastDate': forecastDate.isoformat(),
+                   'FirstDate': theBay.FirstDate,
+                   'history': theBay.history.files if theBay.history is not None else {}
+                   }, file)
+
+
+def templatekey(theBay, *parts):
+    '''
+    templatekey : Hash of the bay set up and every template, plus any other given inputs
+        Key for the prep stages that fill templates with the bay's dates and sources.
+    '''
+
+    return PrepManifest.key(theBay.bayid, theBay.FirstDate, theBay.LastDate,
+                            sorted(theBay.sourcelist), theBay.sourcemap,
+                            theBay.templateregistry().key(), *parts)
+
+
+def AEM3D_prep_IAM(forecastDate, theBay, max_workers=PREP_WORKERS, incremental=False, cache=True,
+                   resolution=RESOLUTION_TIERS, zonefiles='each', sourcefiles='each', sources=None,
+                   chunks=None, stages=None):
 
     #logger.info(f'Processing Bay: {theBay.bayid} for year {theBay.year}')
 
-    # get flow files from hydrology model data
-    getflowfiles(forecastDate, theBay)
+    #
+    #   Incremental: keep the files from the last run and only rewrite each one
+    #   from that run's forecast start on.  Files whose history no longer
+    #   matches (e.g. revised observations) are rebuilt in full: every file's
+    #   rows before the cutoff are digested and checked against the digests the
+    #   last run recorded in its prep state.
+    #
+    theBay.appendfrom = appendcutoff(forecastDate, theBay) if incremental else None
+    theBay.history = AppendHistory(Datetime([forecastDate]).to_AEM3D_datetime()[0],
+                                   loadprepstate(theBay).get('history', {}) if theBay.appendfrom is not None else {})
 
-    # generate climate files including lake levels
-    genclimatefiles(forecastDate, theBay)
+    #
+    #   cache: skip writing files (and whole file-only stages) whose inputs hash
+    #   the same as in the last run
+    #
+    theBay.manifest = PrepManifest(os.path.join(theBay.run_dir, PREP_MANIFEST_FILE)) if cache else None
 
-    # generate salinity file
-    gensalinefile(theBay)
+    #
+    #   resolution: tiers of coarser time steps for the older rows of every
+    #   series file (None keeps everything as sampled).  An incremental prep
+    #   leaves the rows before its cutoff as they were written, so days that
+    #   aged past a tier boundary since the last full rebuild stay finer.
+    #
+    theBay.resolution = Resolution(resolution, forecastDate, RESOLUTION_AGGREGATION) if resolution else None
 
-    # generate boundary condition file
-    genboundaryfile(theBay)
-    
-    # generate tracer files
-    gentracerfiles(theBay)
+    #
+    #   zonefiles: climate files a zone at a time ('each'), or every zone of a
+    #   variable as the columns of one file ('combined')
+    #
+    theBay.zonefiles = zonefiles
 
-    # generate the water quality files (waterquality.py script)
-    genwqfiles(theBay)
+    #
+    #   sourcefiles: inflow, temp and water quality files a source at a time
+    #   ('each'), or every source as the columns of one file per variable
+    #   group ('combined': Inflows_Flow.dat, Inflows_Temp.dat, WQ_P.dat, ...)
+    #
+    theBay.sourcefiles = sourcefiles
 
-    # generate the datablock.xml file
-    gendatablockfile(forecastDate, theBay)
+    #
+    #   chunks: make and write each series file a period of rows at a time (e.g.
+    #   'MS', a month each) instead of all at once, so however long the spinup
+    #   only a chunk of a file is held as values and as text (see InputFile.stream())
+    #
+    theBay.chunks = chunks
 
-    # generate control file
-    gencntlfile(forecastDate, theBay)
+    #
+    #   sources: an upstream data bundle fetched already (e.g. shared by the bays
+    #   of a batch, see batch.py), used instead of fetching it again
+    #
+    #   stages: names of the prep stages to run, the rest left to another job
+    #   (e.g. PREP_JOB_STAGES, see prepstages()); the prep state is recorded
+    #   once the control file is written
+    #
+    prepstages(forecastDate, theBay, stages, sources, max_workers)
+    if stages is None or 'gencntlfile' in stages:
+        saveprepstate(forecastDate, theBay)
 
     return 0
+
+
+def prepstages(forecastDate, theBay, stages=None, sources=None, max_workers=PREP_WORKERS):
+    '''
+    prepstages : Run the prep stages on a bay AEM3D_prep_IAM() set up
+        stages - names of the stages to run (default all of them); the others
+                 are taken as done, e.g. by the job the bay was handed from
+                 (see handoff.py)
+        sources - an upstream data bundle fetched already, or None to fetch it
+    '''
+
+    shared = sources
+
+    #
+    #   Each stage lists what it needs and what it makes; stages run as soon as
+    #   their inputs are ready, so the template files are written while the
+    #   flow and climate data are still loading.
+    #   Declaration order is also the order files are listed in the control file.
+    #
+    sources = {}      # bundle of upstream data, filled by the fetch stage
+
+    StageGraph([
+        # fetch all upstream data sources concurrently (unless given them)
+        Stage('fetchdata', lambda: sources.update(shared if shared is not None else
+                                                  fetchdata(forecastDate, zones=theBay.zonecoords())),
+              inputs=['forecastDate'], outputs=['sources']),
+
+        # get flow files from hydrology model data
+        Stage('getflowfiles', lambda: getflowfiles(forecastDate, theBay, sources),
+              inputs=['sources'], outputs=['flowdf', 'bayfiles']),
+
+        # generate climate files including lake levels (lake level needs the flows)
+        Stage('genclimatefiles', lambda: genclimatefiles(forecastDate, theBay, sources),
+              inputs=['sources', 'flowdf'], outputs=['tempdf', 'bayfiles']),
+
+        # generate salinity file
+        Stage('gensalinefile', lambda: gensalinefile(theBay),
+              inputs=['dates'], outputs=['bayfiles'],
+              key=lambda: templatekey(theBay)),
+
+        # generate boundary condition file
+        Stage('genboundaryfile', lambda: genboundaryfile(theBay),
+              inputs=['dates'], outputs=['bayfiles'],
+              key=lambda: templatekey(theBay)),
+
+        # generate tracer files
+        Stage('gentracerfiles', lambda: gentracerfiles(theBay),
+              inputs=['dates'], outputs=['bayfiles'],
+              key=lambda: templatekey(theBay)),
+
+        # generate the water quality files (waterquality.py script)
+        Stage('genwqfiles', lambda: genwqfiles(theBay),
+              inputs=['flowdf', 'tempdf'], outputs=['bayfiles'],
+              key=lambda: templatekey(theBay, theBay.flowdf, theBay.tempdf, theBay.resolution,
+                                      theBay.sourcefiles, theBay.p_redux, theBay.chunks)),
+
+        # generate the datablock.xml file
+        Stage('gendatablockfile', lambda: gendatablockfile(forecastDate, theBay),
+              inputs=['forecastDate'], outputs=['bayfiles'],
+              key=lambda: templatekey(theBay, forecastDate)),
+
+        # generate control file, once every other file is written
+        Stage('gencntlfile', lambda: gencntlfile(forecastDate, theBay),
+              inputs=['forecastDate', 'bayfiles']),
+    ]).run(theBay, max_workers=max_workers, only=stages)
+
+
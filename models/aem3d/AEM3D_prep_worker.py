@@ -5,9 +5,15 @@
 #   - the bay of interest (Missisquoi, St. Albans)
 #   - the hydrology model (SWAT, RHESSys)
 
-from lib import cd, logger, IAMBAY
+from lib import logger, IAMBAY
 from .AEM3D_prep_IAM import *
-from sh import cp
+from .sweep import sweep
+from .ensemble import ensemble
+from .batch import batch
+from .hindcast import hindcast
+from .workspace import TemplateCache
+from .archive import pack
+from .handoff import savesources, loadsources, savebay, loadbay
 import os
 import sys
 import datetime
@@ -42,15 +48,19 @@ def main():
     #     os.makedirs(prep_path)
     
     #THEBAY = IAMBAY(settings['whichbay'])   # Create Bay Object for Bay specified
-    THEBAY = IAMBAY(bayid='ILS')   # Create Bay Object for Bay specified
+    # --bays MB,STA,ILS : prep several bays from one fetch (see batch.py), each in aem3d-run-<bay>
+    bayids = sys.argv[sys.argv.index('--bays') + 1].split(',') if '--bays' in sys.argv else ['ILS']
+    BAYS = [IAMBAY(bayid=bayid) for bayid in bayids]   # Create Bay Object for Bays specified
+    THEBAY = BAYS[0]
 
     # Make today and today at midnight
     today = datetime.date.today()
     #today = datetime.date(2023,9,13)
     todayMidnight = datetime.datetime.combine(today, datetime.datetime.min.time())
 
-    THEBAY.FirstDate = datetimeToOrdinal(datetime.datetime.combine(datetime.date(2023,1,2), datetime.datetime.min.time()))
-    THEBAY.LastDate = datetimeToOrdinal(todayMidnight + datetime.timedelta(days=7))
+    for bay in BAYS:
+        bay.FirstDate = datetimeToOrdinal(datetime.datetime.combine(datetime.date(2023,1,2), datetime.datetime.min.time()))
+        bay.LastDate = datetimeToOrdinal(todayMidnight + datetime.timedelta(days=7))
 
     ## Need dataframes for hydrology from Missisquoi, Mill, JewittStevens
     
@@ -69,41 +79,90 @@ def main():
     #             pkg_resources.resource_string('workers.prep_aem3d_worker.resources', f).decode('utf-8')
     #         )
 
-    THEBAY.infile_dir = os.path.join(prep_path, 'infiles')
-    THEBAY.template_dir = os.path.join(prep_path, 'TEMPLATES')
-    THEBAY.run_dir = prep_path
+    for bay in BAYS:
+        # absolute, so no stage thread or pool worker depends on the working directory
+        bay.run_dir = os.path.abspath(prep_path if len(BAYS) == 1 else f'{prep_path}-{bay.bayid}')
+        bay.infile_dir = os.path.join(bay.run_dir, 'infiles')
+        bay.template_dir = os.path.join(bay.run_dir, 'TEMPLATES')
 
     # Probably don't need this with the cp anymore...
     # if not os.path.exists(prep_path):
     #     os.makedirs(prep_path)
     
     # Copy current aem3d run template
-    cp('-R', '/netfiles/ciroh/models/aem3d/current/AEM3D-inputs', prep_path)
-
-    with cd('.'):
-
-        try:
-            # Create Dir for infiles
-            if not os.path.exists(THEBAY.infile_dir):
-                os.makedirs(THEBAY.infile_dir)
-
-            # source the python file prep script
-            preprc = AEM3D_prep_IAM(forecastDate=today, theBay=THEBAY)
-
-        except Exception as e:
-            logger.info('AEM3D_prep_IAM.py failed. Exiting.')
-            logger.info(traceback.print_exc())
-            sys.exit(1)
-
-        # # build this tar with everything under the run directory, but without the run directory itself
-        # tar(
-        #     'czf',
-        #     '%s-AEM3D-inputs.tar.gz' % SCENARIO.id,
-        #     '-C'
-        #     'AEM3D-inputs',
-        #     '.'
-        # )
-        # mv('%s-AEM3D-inputs.tar.gz' % SCENARIO.id, '../')
+    #   cp -R over NFS every run before; now cloned from a local cache of it (see workspace.py)
+    # cp('-R', '/netfiles/ciroh/models/aem3d/current/AEM3D-inputs', prep_path)
+    # --hardlinks : hard link the files the prep doesn't rewrite where they can't be reflinked
+    templates = TemplateCache()
+    for bay in BAYS:
+        templates.clone(bay.run_dir, hardlink='--hardlinks' in sys.argv)
+
+    try:
+        # Create Dir for infiles
+        for bay in BAYS:
+            if not os.path.exists(bay.infile_dir):
+                os.makedirs(bay.infile_dir)
+
+        # source the python file prep script
+        # --incremental : append to the last run's input files instead of rebuilding them
+        # --full-resolution : keep every series at its own sampling back to the spinup start
+        # --chunks <alias> : make and write the series files a period at a time, e.g. MS (months)
+        # --sweep <csv> : then a run directory per coefficient set in the csv (see sweep.py)
+        # --ensemble <csv> : then a run directory per P reduction scenario in the csv (see ensemble.py)
+        # --hindcast <YYYY-MM-DD>:<YYYY-MM-DD> : a run directory per past forecast date (see hindcast.py)
+        # --handoff <dir> --job fetch|prep|wq : one part of the prep as its own workflow job,
+        #       handing its intermediates to the next through <dir> (see handoff.py)
+        options = dict(incremental='--incremental' in sys.argv,
+                       resolution=None if '--full-resolution' in sys.argv else RESOLUTION_TIERS,
+                       chunks=sys.argv[sys.argv.index('--chunks') + 1] if '--chunks' in sys.argv else None)
+        handoff_dir = os.path.abspath(sys.argv[sys.argv.index('--handoff') + 1]) if '--handoff' in sys.argv else None
+        job = sys.argv[sys.argv.index('--job') + 1] if '--job' in sys.argv else 'prep'
+        if handoff_dir is not None and job == 'fetch':
+            savesources(fetchdata(today, zones=THEBAY.zonecoords()), handoff_dir)
+            preprc = 0
+        elif handoff_dir is not None and job == 'wq':
+            THEBAY = loadbay(handoff_dir)
+            prepstages(today, THEBAY, WQ_JOB_STAGES)
+            saveprepstate(today, THEBAY)
+            preprc = 0
+        elif handoff_dir is not None:
+            if os.path.exists(os.path.join(handoff_dir, 'sources')):
+                options['sources'] = loadsources(handoff_dir)
+            preprc = AEM3D_prep_IAM(forecastDate=today, theBay=THEBAY, stages=PREP_JOB_STAGES, **options)
+            savebay(THEBAY, handoff_dir)
+        elif len(BAYS) > 1:
+            preprc = max(batch(forecastDate=today, bays=BAYS, **options).values())
+        elif '--hindcast' in sys.argv:
+            start, end = (datetime.date.fromisoformat(date)
+                          for date in sys.argv[sys.argv.index('--hindcast') + 1].split(':'))
+            preprc = hindcast(start, end, THEBAY, **options)
+        elif '--sweep' in sys.argv:
+            preprc = sweep(forecastDate=today, theBay=THEBAY,
+                           table=sys.argv[sys.argv.index('--sweep') + 1], **options)
+        elif '--ensemble' in sys.argv:
+            preprc = ensemble(forecastDate=today, theBay=THEBAY,
+                              scenarios=sys.argv[sys.argv.index('--ensemble') + 1], **options)
+        else:
+            preprc = AEM3D_prep_IAM(forecastDate=today, theBay=THEBAY, **options)
+
+    except Exception as e:
+        logger.info('AEM3D_prep_IAM.py failed. Exiting.')
+        logger.info(traceback.print_exc())
+        sys.exit(1)
+
+    # # build this tar with everything under the run directory, but without the run directory itself
+    # tar(
+    #     'czf',
+    #     '%s-AEM3D-inputs.tar.gz' % SCENARIO.id,
+    #     '-C'
+    #     'AEM3D-inputs',
+    #     '.'
+    # )
+    # mv('%s-AEM3D-inputs.tar.gz' % SCENARIO.id, '../')
+    #   now --package : each bay's inputs as <run dir>.tar.zst (see archive.py)
+    if '--package' in sys.argv:
+        for bay in BAYS:
+            pack(bay.run_dir)
 
     logger.info('Fin')
 
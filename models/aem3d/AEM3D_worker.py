@@ -2,7 +2,9 @@ from lib import (
     cd,
     logger,
 )
+from .archive import pack
 from sh import Command, rm
+import sys
 
 
 # def activate_restart_file(aem3d_cntl_file_name):
@@ -132,6 +134,11 @@ def main():
         # Remove large 3D file???
         #rm('-rf', 'outfiles/nc/All3D.nc')
 
+    # --package : the run, inputs and outputs, as aem3d-run.tar.zst (see archive.py)
+    #   e.g. a restart file back out of it: extract('aem3d-run.tar.zst', ['outfiles/unf/restart_file.unf'])
+    if '--package' in sys.argv:
+        pack('aem3d-run')
+
     logger.info('Fin')
 
 
@@ -0,0 +1,434 @@
+#  Time Alignment for the AEM3D Lake Model Input Prep
+#
+#  The forcing sources each run on their own clock: Colchester Reef every 15
+#  minutes, BTV LCD roughly hourly at irregular minutes, GFS hourly and then
+#  3-hourly past 120h, NWM hourly.  The functions here splice, deduplicate and
+#  align such series with sorted-array searches and vectorized interpolation,
+#  working on plain arrays:
+#
+#       times  - int64 nanoseconds since the epoch, sorted (see stamps())
+#       values - float64, same length, NaN where missing
+#
+#  so a multi-year series is handled in one pass, with no DataFrames in
+#  between.  Wrap the result back up with pd.Series(values, index=pd.DatetimeIndex(times))
+#  where pandas is wanted.
+#
+#  Where observations and a forecast overlap, splice() takes an explicit policy
+#  for the seam (see OVERLAP_POLICIES).
+
+import numpy as np
+import pandas as pd
+
+# how splice() treats times both the observations and the forecast cover
+OVERLAP_POLICIES = (
+    'forecast',     # the forecast from its first time on, observations only before it
+    'observed',     # observations through their last time, the forecast only after it
+    'blend'         # ramp linearly from observations to forecast across the overlap
+)
+
+ALIGN_METHODS = ('nearest', 'linear', 'previous')
+
+
+def stamps(index):
+    '''
+    int64 nanosecond times for a DatetimeIndex (or anything pandas can make one from).
+    '''
+    return pd.DatetimeIndex(index).values.astype('datetime64[ns]').view('int64')
+
+
+def step(frequency):
+    '''
+    A step (pandas offset string, Timedelta or seconds) in nanoseconds.
+    '''
+    if isinstance(frequency, (int, float, np.integer, np.floating)):
+        return int(frequency * 1e9)
+    return pd.Timedelta(frequency).value
+
+
+def arrays(series):
+    '''
+    (times, values) of a Series, in time order, for the functions below.
+    '''
+    times = stamps(series.index)
+    values = series.to_numpy(dtype='float64', na_value=np.nan)
+    if len(times) > 1 and (np.diff(times) < 0).any():
+        order = np.argsort(times, kind='stable')
+        times, values = times[order], values[order]
+    return times, values
+
+
+def dedupe(times, values, keep='first'):
+    '''
+    Drop repeated times from a sorted series, keeping the first or last value at each.
+    '''
+    if len(times) < 2:
+        return times, values
+    if keep == 'first':
+        unique = np.concatenate([[True], times[1:] != times[:-1]])
+    elif keep == 'last':
+        unique = np.concatenate([times[1:] != times[:-1], [True]])
+    else:
+        raise Exception(f'Unknown keep {keep}; use first or last')
+    return times[unique], values[unique]
+
+
+def splice(observed, forecast, overlap='forecast'):
+    '''
+    One series from observations followed by a forecast.
+        observed, forecast - (times, values), sorted, without repeated times
+        overlap - seam policy, one of OVERLAP_POLICIES
+        Returns (times, values), sorted, without repeated times.
+    '''
+    if overlap not in OVERLAP_POLICIES:
+        raise Exception(f'Unknown overlap policy {overlap}; use one of {OVERLAP_POLICIES}')
+
+    obs_t, obs_v = observed
+    fc_t, fc_v = forecast
+    if not len(fc_t):
+        return obs_t, obs_v
+    if not len(obs_t):
+        return fc_t, fc_v
+
+    start, end = fc_t[0], obs_t[-1]
+    if end < start:
+        return np.concatenate([obs_t, fc_t]), np.concatenate([obs_v, fc_v])
+
+    if overlap == 'forecast':
+        cut = np.searchsorted(obs_t, start, side='left')
+        return np.concatenate([obs_t[:cut], fc_t]), np.concatenate([obs_v[:cut], fc_v])
+
+    if overlap == 'observed':
+        cut = np.searchsorted(fc_t, end, side='right')
+        return np.concatenate([obs_t, fc_t[cut:]]), np.concatenate([obs_v, fc_v[cut:]])
+
+    # blend: on every time either has inside the overlap, weight the forecast
+    #   from 0 at its first time to 1 at the last observation
+    head = np.searchsorted(obs_t, start, side='left')
+    tail = np.searchsorted(fc_t, end, side='right')
+    seam = np.union1d(obs_t[head:], fc_t[:tail])
+    weight = (seam - start) / (end - start) if end > start else np.ones(len(seam))
+    mixed = (1.0 - weight) * linear(obs_t, obs_v, seam) + weight * linear(fc_t, fc_v, seam)
+    return (np.concatenate([obs_t[:head], seam, fc_t[tail:]]),
+            np.concatenate([obs_v[:head], mixed, fc_v[tail:]]))
+
+
+def nearest(times, values, target):
+    '''
+    Values of a sorted series at the target times, from the nearest time in the series
+        (the later one on a tie, as pandas reindex(method='nearest') does).
+    '''
+    target = np.asarray(target)
+    if not len(times):
+        return np.full(len(target), np.nan)
+    right = np.searchsorted(times, target, side='left')
+    left = np.clip(right - 1, 0, len(times) - 1)
+    right = np.clip(right, 0, len(times) - 1)
+    pick = np.where(target - times[left] < times[right] - target, left, right)
+    return values[pick]
+
+
+def linear(times, values, target):
+    '''
+    Values of a sorted series at the target times by linear interpolation between
+        its valid points, NaN outside their span.
+    '''
+    target = np.asarray(target)
+    valid = ~np.isnan(values)
+    times, values = times[valid], values[valid]
+    if not len(times):
+        return np.full(len(target), np.nan)
+    out = np.interp(target.astype('float64'), times.astype('float64'), values)
+    out[(target < times[0]) | (target > times[-1])] = np.nan
+    return out
+
+
+def previous(times, values, target):
+    '''
+    Values of a sorted series at the target times, held from the last time at or
+        before each (NaN before the series starts).
+    '''
+    target = np.asarray(target)
+    pos = np.searchsorted(times, target, side='right') - 1
+    out = values[np.clip(pos, 0, None)] if len(times) else np.full(len(target), np.nan)
+    return np.where(pos >= 0, out, np.nan)
+
+
+def align(times, values, target, method='nearest'):
+    '''
+    Values of a sorted series at the target times by one of ALIGN_METHODS.
+    '''
+    if method == 'nearest':
+        return nearest(times, values, target)
+    if method == 'linear':
+        return linear(times, values, target)
+    if method == 'previous':
+        return previous(times, values, target)
+    raise Exception(f'Unknown align method {method}; use one of {ALIGN_METHODS}')
+
+
+def grid(start, end, every):
+    '''
+    Regular times from start through end (int64 ns), every `every` ns, on multiples of it.
+    '''
+    first = -(-start // every) * every
+    return np.arange(first, end + 1, every, dtype='int64')
+
+
+def resample(times, values, every, method='linear'):
+    '''
+    A sorted series on the regular grid of its span, every `every` (see step()).
+        Returns (times, values).
+    '''
+    if not len(times):
+        return times, values
+    target = grid(times[0], times[-1], step(every))
+    return target, align(times, values, target, method)
+
+
+def periods(times, frequency='MS'):
+    '''
+    Row slices of a sorted series, one per calendar period it has times in.
+        frequency - pandas offset alias of the periods, e.g. 'MS' (months) or 'D' (days)
+    '''
+    if not len(times):
+        return []
+    bounds = stamps(pd.date_range(pd.Timestamp(times[0]).normalize(), pd.Timestamp(times[-1]), freq=frequency))
+    cuts = np.searchsorted(times, bounds[bounds > times[0]], side='left')
+    cuts = np.unique(np.concatenate([[0], cuts, [len(times)]]))
+    return [slice(int(start), int(end)) for start, end in zip(cuts[:-1], cuts[1:])]
+
+
+def window_mean(times, values, window):
+    '''
+    Trailing mean of a sorted series over a time window (see step()), ignoring NaN:
+        each time averages the points in (time - window, time], like
+        Series.rolling(window, min_periods=1).mean() on a DatetimeIndex.
+    '''
+    span = step(window)
+    valid = ~np.isnan(values)
+    sums = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0.0))])
+    counts = np.concatenate([[0], np.cumsum(valid)])
+    start = np.searchsorted(times, times - span, side='right')
+    end = np.arange(1, len(times) + 1)
+    n = counts[end] - counts[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, (sums[end] - sums[start]) / n, np.nan)
+
+
+def bins(times, edges):
+    '''
+    Which bin [edges[i], edges[i+1]) each time falls in (-1 outside them all).
+    '''
+    which = np.searchsorted(edges, times, side='right') - 1
+    which[(which < 0) | (which >= len(edges) - 1)] = -1
+    return which
+
+
+def bin_mean(times, values, edges):
+    '''
+    Mean of the valid samples in each bin (NaN for bins without any).
+    '''
+    which = bins(times, edges)
+    keep = (which >= 0) & ~np.isnan(values)
+    n = np.bincount(which[keep], minlength=len(edges) - 1)
+    total = np.bincount(which[keep], weights=values[keep], minlength=len(edges) - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, total / n, np.nan)
+
+
+def bin_circular_mean(times, values, edges):
+    '''
+    Mean direction (degrees) of the valid samples in each bin, averaged as unit vectors.
+    '''
+    radians = np.deg2rad(values)
+    east = bin_mean(times, np.sin(radians), edges)
+    north = bin_mean(times, np.cos(radians), edges)
+    return np.rad2deg(np.arctan2(east, north)) % 360.0
+
+
+def bin_conserve(times, values, edges):
+    '''
+    Time average over each bin, integrating the series as linear between its valid
+        samples, so a rate's total over the bins is kept (rain, flow).  Bins the
+        series only partly covers are averaged over the part it covers, and a
+        bin it only touches at one sample takes that sample.
+    '''
+    valid = ~np.isnan(values)
+    times, values = times[valid], values[valid]
+    out = bin_mean(times, values, edges)
+    if len(times) < 2:
+        return out
+
+    # integral from the first sample to any time in the span
+    t = times.astype('float64')
+    area = np.concatenate([[0.0], np.cumsum(np.diff(t) * (values[1:] + values[:-1]) / 2.0)])
+    def integral(x):
+        k = np.searchsorted(t, x, side='right') - 1
+        return area[k] + (x - t[k]) * (values[k] + np.interp(x, t, values)) / 2.0
+
+    lo = np.clip(edges[:-1].astype('float64'), t[0], t[-1])
+    hi = np.clip(edges[1:].astype('float64'), t[0], t[-1])
+    span = hi > lo
+    out[span] = (integral(hi[span]) - integral(lo[span])) / (hi[span] - lo[span])
+    return out
+
+
+AGGREGATIONS = {
+    'mean': bin_mean,                   # state variables: temperature, humidity, concentrations
+    'conserve': bin_conserve,           # rates whose totals matter: rain, flow, radiation
+    'circular': bin_circular_mean       # directions in degrees
+}
+
+
+class Resolution:
+    '''
+    Tiered time resolution: series keep their own sampling close to a reference
+        time and are averaged into coarser steps further back.
+
+        tiers - [(age, step)], youngest first: from age before the reference back
+                to the next tier's age, values are averaged over step, e.g.
+                [('30D', '1h'), ('365D', '6h')] keeps the last 30 days as they are,
+                the 11 months before that hourly, and anything older 6 hourly
+        reference - time the ages count back from (e.g. the forecast date)
+        aggregation - {column header: one of AGGREGATIONS}; other columns use 'mean'
+
+    Each coarse value is stamped at the middle of its step.
+    '''
+
+    def __init__(self, tiers, reference, aggregation={}):
+        self.tiers = [(step(age), step(every)) for age, every in tiers]
+        self.reference = stamps([reference])[0]
+        self.aggregation = dict(aggregation)
+        for header, how in self.aggregation.items():
+            if how not in AGGREGATIONS:
+                raise Exception(f'Unknown aggregation {how} for {header}; use one of {list(AGGREGATIONS)}')
+
+    def __repr__(self):
+        # stable text for hashing into prep stage keys
+        return f'Resolution({self.tiers}, {self.reference}, {sorted(self.aggregation.items())})'
+
+    def edges(self, first):
+        '''
+        Bin edges covering first (int64 ns) up to where full resolution starts;
+            empty if first is already within it.
+        '''
+        cuts = [(self.reference - age) // every * every for age, every in self.tiers]
+        parts = []
+        end = cuts[0]                   # full resolution from here on
+        for i, (_, every) in enumerate(self.tiers):
+            start = cuts[i + 1] if i + 1 < len(cuts) else first // every * every
+            start = min(max(start, first // every * every), end)
+            if start < end:
+                parts.append(np.arange(start, end, every, dtype='int64'))
+            end = start
+            if end <= first:
+                break
+        if not parts:
+            return np.array([], dtype='int64')
+        return np.concatenate(parts[::-1] + [[cuts[0]]]).astype('int64')
+
+    def apply(self, times, columns, headers):
+        '''
+        Coarsen the old part of a sorted series.
+            times - int64 ns; columns - float64 arrays; headers - name of each column
+            Returns (rows, times, columns): the coarse rows that replace the first
+            `rows` rows, which are kept for bins with at least one sample.
+        '''
+        edges = self.edges(times[0]) if len(times) else []
+        if len(edges) < 2:
+            return 0, times[:0], [column[:0] for column in columns]
+
+        rows = np.searchsorted(times, edges[-1], side='left')
+        old = times[:rows]
+        have = np.bincount(bins(old, edges)[bins(old, edges) >= 0], minlength=len(edges) - 1) > 0
+        centres = edges[:-1] + (edges[1:] - edges[:-1]) // 2
+        coarse = [AGGREGATIONS[self.aggregation.get(header, 'mean')](old, column[:rows], edges)[have]
+                  for column, header in zip(columns, headers)]
+        return rows, centres[have], coarse
+
+    def stream(self, headers):
+        '''
+        A Coarsening: apply() on a series fed to it a chunk at a time.
+        '''
+        return Coarsening(self, headers)
+
+
+class Coarsening:
+    '''
+    Resolution.apply() on a sorted series arriving a chunk at a time, e.g. a
+        month each, coming out as it would for the whole series at once.
+
+        A bin is written once every sample it takes has arrived, and for a
+        'conserve' column once there's a valid sample at or past its end (its
+        integral interpolates across its edges).  Only the rows of bins still
+        open, and each such column's last valid sample before them, are held.
+    '''
+
+    def __init__(self, resolution, headers):
+        self.resolution = resolution
+        self.aggregations = [AGGREGATIONS[resolution.aggregation.get(header, 'mean')] for header in headers]
+        self.edges = None       # bin edges, from the first time fed
+        self.done = 0           # bins before edges[done] are written
+        self.last = None        # last time fed
+        self.times = np.array([], dtype='int64')            # rows held
+        self.columns = [np.array([]) for _ in headers]
+
+    def feed(self, times, columns):
+        '''
+        The next chunk: times (int64 ns, none before the last chunk's) and columns.
+            Returns (rows, times, columns) like apply(): the coarse rows complete so far,
+            which replace the first `rows` rows of this chunk (and any held from before).
+        '''
+        if not len(times):
+            return 0, times, list(columns)
+        if np.any(times[1:] < times[:-1]) or (self.last is not None and times[0] < self.last):
+            raise Exception('Coarsening needs its chunks in time order')
+        self.last = times[-1]
+        if self.edges is None:
+            self.edges = self.resolution.edges(times[0])
+        if len(self.edges) < 2 or self.done == len(self.edges) - 1:
+            return 0, times[:0], [column[:0] for column in columns]
+
+        rows = int(np.searchsorted(times, self.edges[-1], side='left'))
+        self.times = np.concatenate([self.times, times[:rows]])
+        self.columns = [np.concatenate([held, column[:rows]]) for held, column in zip(self.columns, columns)]
+        if rows < len(times):
+            stop = len(self.edges) - 1      # full resolution from here on: every bin is complete
+        else:
+            # the last edge behind every sample still to come, and behind a valid
+            #   sample of each 'conserve' column (ones with none yet are NaN up to it)
+            last = self.times[-1]
+            for column, how in zip(self.columns, self.aggregations):
+                valid = np.flatnonzero(~np.isnan(column))
+                if how is bin_conserve and len(valid):
+                    last = min(last, self.times[valid[-1]])
+            stop = int(np.searchsorted(self.edges, last, side='right')) - 1
+        return (rows,) + self.emit(stop)
+
+    def finish(self):
+        '''
+        The coarse rows still held once the whole series was fed, as (times, columns).
+        '''
+        if self.edges is None or len(self.edges) < 2:
+            return self.times, self.columns
+        return self.emit(len(self.edges) - 1)
+
+    def emit(self, stop):
+        # the bins from edges[done] to edges[stop], then let go of the rows only they needed
+        if stop <= self.done:
+            return self.times[:0], [column[:0] for column in self.columns]
+        edges = self.edges[self.done:stop + 1]
+        which = bins(self.times, edges)
+        have = np.bincount(which[which >= 0], minlength=len(edges) - 1) > 0
+        centres = edges[:-1] + (edges[1:] - edges[:-1]) // 2
+        coarse = [how(self.times, column, edges)[have] for how, column in zip(self.aggregations, self.columns)]
+
+        keep = int(np.searchsorted(self.times, edges[-1], side='left'))
+        for column, how in zip(self.columns, self.aggregations):
+            valid = np.flatnonzero(~np.isnan(column[:keep]))
+            if how is bin_conserve and len(valid):
+                keep = min(keep, int(valid[-1]))
+        self.times = self.times[keep:]
+        self.columns = [column[keep:] for column in self.columns]
+        self.done = stop
+        return centres[have], coarse
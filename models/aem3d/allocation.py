@@ -0,0 +1,214 @@
+#  Source Allocation for the AEM3D Lake Model Input Prep
+#
+#  A bay's inflow sources split its watersheds' flows by proportion
+#  (sourcemap: '201': {'wshed': 'msflow', 'prop': 0.57}, ...).  Here that is
+#  a (watersheds, sources) matrix, so the flows of every source come out of
+#  one product with the (time, watersheds) flows.
+#
+#  Each source is assigned its phosphorus CQ model and P speciation by name.
+#  Their coefficients are laid out as (1, sources) rows, so the kernels
+#  compute the water quality of every source in one pass over (time, sources).
+#  Nitrogen and suspended solids depend only on Missisquoi flow; they are
+#  computed once and shared by all sources.
+#
+#  The series are written a file per source ('each'), or every source as the
+#  columns of one file per variable group ('combined'), per bay.sourcefiles.
+
+from lib import logger
+from .AEM3D import InputFile
+from . import kernels
+
+import os
+import textwrap
+import numpy as np
+import pandas as pd
+
+# phosphorus CQ models (BREE2021Quad) by source name prefix:
+#   (watershed flow, a, b, c) for log10 TP (ug/L) = a + b logQ + c logQ^2
+CQ_MODELS = {
+    'MissisquoiRiver': ('msflow', 1.6884, -0.7758, 0.3952),
+    'RockRiver': ('msflow', 1.6884, -0.7758, 0.3952),
+    'PikeRiver': ('msflow', 1.6884, -0.7758, 0.3952),
+    'JewettStevens': ('jsflow', 2.2845, 0.5185, 0.1995),
+    'MillRiver': ('mlflow', 1.7935, 0.4052, 0.1221)
+}
+CQ_LOW_FLOW = ('msflow', 0.1)    # no TP on days this flow is below this
+
+# phosphorus species by source name prefix: PO4 and DOPL as (coefficient,
+#   exponent) of TP, POPL as a fraction of TP or None for the rest of it
+P_SPECIATION = {
+    'MissisquoiRiver': ((0.01401, 0.319), (0.03268, 0.319), None),
+    'RockRiver': ((0.1050, 1.0), (0.23275, 1.0), 0.30875),
+    'PikeRiver': ((0.1050, 1.0), (0.23275, 1.0), 0.30875),
+    'JewettStevens': ((0.1050, 1.0), (0.23275, 1.0), 0.30875),
+    'MillRiver': ((0.1050, 1.0), (0.23275, 1.0), 0.30875)
+}
+
+
+def assigned(table, name):
+    '''
+    The key of table the source name starts with, or None.
+    '''
+    for prefix in table:
+        if name.startswith(prefix):
+            return prefix
+    return None
+
+
+class SourceAllocation:
+    '''
+    A bay's sources as an allocation of its watershed flows.
+
+        sourcelist - source IDs, in file order
+        sourcemap - {source ID: {'name', 'wshed', 'prop'}}
+        cq, speciation - the tables sources are assigned their models from
+    '''
+
+    def __init__(self, sourcelist, sourcemap, cq=CQ_MODELS, speciation=P_SPECIATION):
+        self.sources = list(sourcelist)
+        self.names = [sourcemap[source]['name'] for source in self.sources]
+
+        # watersheds in the order first used, then the (watersheds, sources) proportions
+        self.watersheds = list(dict.fromkeys(sourcemap[source]['wshed'] for source in self.sources))
+        self.matrix = np.zeros((len(self.watersheds), len(self.sources)))
+        for s, source in enumerate(self.sources):
+            self.matrix[self.watersheds.index(sourcemap[source]['wshed']), s] = sourcemap[source]['prop']
+
+        # per-source CQ models: the watershed flow each reads, and its coefficients as (1, sources) rows
+        self.cqmodels = [assigned(cq, name) for name in self.names]
+        missing = [name for name, model in zip(self.names, self.cqmodels) if model is None]
+        if missing:
+            raise Exception(f'CQ Equation for baysource={missing} not found for cqVersion=BREE2021Quad')
+        models = [cq[model] for model in self.cqmodels]
+        self.cqflows = [model[0] for model in models]
+        self.cq = {key: np.array([[model[k + 1] for model in models]])
+                   for k, key in enumerate(['a', 'b', 'c'])}
+
+        species = [speciation.get(assigned(speciation, name)) for name in self.names]
+        missing = [name for name, entry in zip(self.names, species) if entry is None]
+        if missing:
+            raise Exception(f'baysource={missing} not found when calculating phosphorus species')
+        self.speciation = {
+            'po4': np.array([[entry[0][0] for entry in species]]),
+            'po4_exp': np.array([[entry[0][1] for entry in species]]),
+            'dopl': np.array([[entry[1][0] for entry in species]]),
+            'dopl_exp': np.array([[entry[1][1] for entry in species]]),
+            'popl': np.array([[entry[2] or 0.0 for entry in species]]),
+            'popl_rest': np.array([[entry[2] is None for entry in species]], dtype='float64')
+        }
+
+    @classmethod
+    def frombay(cls, bay):
+        return cls(bay.sourcelist, bay.sourcemap)
+
+    def flows(self, flowdf):
+        '''
+        Every source's flow, (time, sources), from the watershed flow columns of flowdf.
+        '''
+        return flowdf[self.watersheds].to_numpy(dtype='float64') @ self.matrix
+
+    def swept(self, table, p_redux=1.0):
+        '''
+        The CQ coefficients and p_redux for every row of a table of parameter sets,
+            with a leading (sets,) axis for phosphorus(): ({'a', 'b', 'c': (sets, 1,
+            sources)}, (sets, 1, 1)).  Columns '<CQ model>.a' (.b, .c), e.g.
+            'MissisquoiRiver.b', and 'p_redux'; ones left out keep their values.
+        '''
+        defaults = {f'{model}.{key}': self.cq[key][0, s]
+                    for s, model in enumerate(self.cqmodels) for key in self.cq}
+        defaults['p_redux'] = p_redux
+        swept = kernels.parameters(table, defaults)
+        cq = {key: np.stack([swept[f'{model}.{key}'][:, 0] for model in self.cqmodels], axis=-1)[:, None, :]
+              for key in self.cq}
+        return cq, swept['p_redux'][:, :, None]
+
+    def phosphorus(self, flowdf, p_redux=1.0, cq=None):
+        '''
+        TP and its species for every source, {name: (time, sources) array}.
+            p_redux - fraction of the CQ phosphorus kept (scalar or (1, sources))
+            cq - CQ coefficients other than the sources' own, e.g. from swept(); the
+                 results then have a leading (sets,) axis too
+        '''
+        # log10 of each watershed once, then picked out for each source's model
+        cqsheds = list(dict.fromkeys(self.cqflows))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logQ = np.log10(flowdf[cqsheds].to_numpy(dtype='float64'))
+        logQ = logQ[:, [cqsheds.index(shed) for shed in self.cqflows]]
+
+        lowflow = (flowdf[CQ_LOW_FLOW[0]].to_numpy(dtype='float64') < CQ_LOW_FLOW[1])[:, None]
+        with np.errstate(over='ignore', invalid='ignore'):
+            phosphorus = kernels.TP_CQ(logQ=logQ, lowflow=lowflow, p_redux=p_redux,
+                                       **(self.cq if cq is None else cq))
+            phosphorus.update(kernels.P_SPECIES(TP=phosphorus['TP'], **self.speciation))
+        return phosphorus
+
+    def nitrogen(self, flowdf):
+        '''
+        Nitrogen species, {name: (time,) array}, shared by every source.
+        '''
+        return kernels.NITROGEN(msflow=flowdf['msflow'])
+
+    def solids(self, flowdf):
+        '''
+        Suspended solids, {name: (time,) array}, shared by every source.
+        '''
+        return kernels.SOLIDS(msflow=flowdf['msflow'])
+
+    def frame(self, block, columns, index, source):
+        '''
+        One source's columns of (time, sources) or shared (time,) arrays as a DataFrame.
+        '''
+        s = self.sources.index(source)
+        return pd.DataFrame({column: block[column][:, s] if np.ndim(block[column]) == 2 else block[column]
+                             for column in columns}, index=index)
+
+    def write(self, bay, groups, index):
+        '''
+        Write series for every source: a {name}_{suffix}.dat each when bay.sourcefiles
+            is 'each', or all of them as the columns of the one file combined (source
+            by source, like WQ_DO.dat) when it's 'combined'.
+            groups - [(suffix, combined, block, columns)]: block is {column: (time, sources)
+                     array, or (time,) shared by every source}, or a function making that
+                     for a slice of index's rows; columns the AEM3D names of the ones to write
+            Each source's files are written together, in the groups' order.  With
+            bay.chunks set, a function's block is made (and written) a chunk of rows
+            at a time; otherwise once, for every file.
+        '''
+        if bay.chunks is None:
+            groups = [(suffix, combined, block(slice(None)) if callable(block) else block, columns)
+                      for suffix, combined, block, columns in groups]
+
+        if bay.sourcefiles == 'combined':
+            files = ((combined, ['Bay Sources:'] + textwrap.wrap(' '.join(self.names), 50), self.sources,
+                      [source for source in self.sources for _ in columns], list(columns) * len(self.sources),
+                      block, columns)
+                     for suffix, combined, block, columns in groups)
+        elif bay.sourcefiles == 'each':
+            files = ((f'{name}_{suffix}.dat', [f'Bay Source: {name}'], [source], source, list(columns),
+                      block, columns)
+                     for source, name in zip(self.sources, self.names)
+                     for suffix, combined, block, columns in groups)
+        else:
+            raise Exception(f'sourcefiles is neither "each" nor "combined": {bay.sourcefiles}')
+
+        def table(block, columns, sources, rows):
+            # the sources' columns, source by source, on a slice of the rows
+            if callable(block):
+                block = block(rows)
+            else:
+                block = {column: values[rows] if np.ndim(values) else values for column, values in block.items()}
+            return pd.DataFrame(np.hstack([self.frame(block, columns, index[rows], source).to_numpy(dtype='float64')
+                                           for source in sources]), index=index[rows])
+
+        for filename, comments, sources, source_ids, names, block, columns in files:
+            logger.info('Generating Bay Source File: '+filename)
+            InputFile(os.path.join(bay.infile_dir, filename),
+                      bay.bayid,
+                      comments,
+                      bay.appendfrom,
+                      bay.manifest,
+                      bay.resolution,
+                      bay.chunks,
+                      bay.history
+                      ).generate(index, lambda rows: table(block, columns, sources, rows), source_ids, names)
+            bay.addfile(fname=filename)    # remember generated file names
@@ -0,0 +1,213 @@
+#  Compressed Archives of AEM3D Run Directories
+#
+#  A run directory (its inputs, and after the run its outputs) is packed as a
+#  zstd compressed tar, streamed file by file straight from the run directory:
+#  no uncompressed tar or copies are staged anywhere.
+#
+#  Each file is its own zstd frame (compressed with several threads), and the
+#  frames concatenated are one ordinary .tar.zst:
+#
+#       zstd -dc run.tar.zst | tar x       still unpacks all of it
+#
+#  Directories are members too (a frame of just their tar header), so empty
+#  ones, like an outputs directory before the run, come back when unpacked.
+#
+#  The last tar member, MANIFEST_NAME, lists every file with the offset of its
+#  frame in the archive, its size and checksum, and every directory with the
+#  offset of its frame, and a skippable frame at the very end (which zstd
+#  passes over) holds the manifest's own offset.  So one file, say a restart
+#  file or one boundary series, can be extracted by decompressing its frame
+#  alone, without the rest of the archive, and streamed to disk as it's
+#  decompressed.  Names that would land outside the destination (absolute,
+#  or with '..') are refused.
+
+from lib import logger
+
+import os
+import json
+import struct
+import hashlib
+import tarfile
+import fnmatch
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_SUFFIX = '.tar.zst'
+MANIFEST_NAME = 'ARCHIVE_MANIFEST.json'
+ARCHIVE_LEVEL = 10         # zstd compression level
+ARCHIVE_THREADS = -1       # compression threads per frame (-1: one per CPU)
+COPY_CHUNK = 1 << 20
+
+# trailing skippable frame: magic, length, then our tag and the manifest frame's offset
+SKIPPABLE_MAGIC = 0x184D2A5A
+FOOTER_TAG = b'AEM3DARC'
+FOOTER = struct.Struct('<II8sQ')
+
+
+def _zstd():
+    if zstandard is None:
+        raise Exception('zstandard is not installed; it is needed to pack and extract run archives')
+    return zstandard
+
+
+def _tarheader(info):
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def _padding(size):
+    return b'\0' * (-size % tarfile.BLOCKSIZE)
+
+
+def pack(run_dir, archive=None, include=None, exclude=(), level=ARCHIVE_LEVEL, threads=ARCHIVE_THREADS):
+    '''
+    pack : A run directory as a zstd tar archive with an embedded manifest
+        archive - the archive's path (default <run_dir>.tar.zst, next to the run directory)
+        include - fnmatch patterns of the paths (in run_dir) to pack (default everything)
+        exclude - fnmatch patterns of the paths left out
+        Returns the archive's path.
+    '''
+    zstd = _zstd()
+    archive = archive or os.path.normpath(run_dir) + ARCHIVE_SUFFIX
+    compressor = zstd.ZstdCompressor(level=level, threads=threads)
+
+    def packed(rel):
+        return (include is None or any(fnmatch.fnmatch(rel, pattern) for pattern in include)) and \
+            not any(fnmatch.fnmatch(rel, pattern) for pattern in exclude)
+
+    # each directory ahead of what's in it
+    paths, directories = [], set()
+    for root, dirs, files in os.walk(run_dir):
+        dirs.sort()
+        rel = os.path.relpath(root, run_dir)
+        if rel != os.curdir and packed(rel):
+            directories.add(rel)
+            paths.append(rel)
+        paths += [rel for rel in (os.path.relpath(os.path.join(root, name), run_dir) for name in sorted(files))
+                  if packed(rel)]
+
+    manifest = {'run_dir': os.path.basename(os.path.normpath(run_dir)), 'files': {}, 'dirs': {}}
+    partial = archive + '.partial'
+    with open(partial, 'wb') as out:
+        for rel in paths:
+            path = os.path.join(run_dir, rel)
+            info = tarfile.TarInfo(rel.replace(os.sep, '/'))
+            status = os.stat(path)
+            info.mtime, info.mode = int(status.st_mtime), status.st_mode & 0o7777
+            if rel in directories:
+                info.type = tarfile.DIRTYPE
+                manifest['dirs'][info.name] = {'offset': out.tell()}
+                out.write(compressor.compress(_tarheader(info)))
+                continue
+            info.size = status.st_size
+
+            # this file's frame: its tar header, data and padding, streamed through the compressor
+            offset = out.tell()
+            digest = hashlib.blake2b(digest_size=16)
+            size = 0
+            with compressor.stream_writer(out, closefd=False) as frame, open(path, 'rb') as file:
+                frame.write(_tarheader(info))
+                for chunk in iter(lambda: file.read(COPY_CHUNK), b''):
+                    digest.update(chunk)
+                    frame.write(chunk)
+                    size += len(chunk)
+                if size != info.size:
+                    raise Exception(f'{path} changed while it was packed')
+                frame.write(_padding(size))
+            manifest['files'][info.name] = {'offset': offset, 'size': size,
+                                            'checksum': digest.hexdigest()}
+
+        # the manifest, the end of the tar, and where to find the manifest
+        offset = out.tell()
+        content = json.dumps(manifest, indent=1).encode()
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(content)
+        out.write(compressor.compress(_tarheader(info) + content + _padding(len(content))
+                                      + b'\0' * (2 * tarfile.BLOCKSIZE)))
+        out.write(FOOTER.pack(SKIPPABLE_MAGIC, FOOTER.size - 8, FOOTER_TAG, offset))
+    os.replace(partial, archive)
+
+    logger.info(f'Packed {len(manifest["files"])} files and {len(directories)} directories of {run_dir} '
+                f'into {archive} ({os.path.getsize(archive)} bytes)')
+    return archive
+
+
+@contextmanager
+def _member(file, offset):
+    # the tar member in the frame at offset, as (TarInfo, its data as a file
+    #   object decompressed as it's read, or None for a directory)
+    file.seek(offset)
+    reader = _zstd().ZstdDecompressor().stream_reader(file, read_across_frames=False, closefd=False)
+    with tarfile.open(fileobj=reader, mode='r|') as member:
+        info = member.next()
+        yield info, member.extractfile(info)
+
+
+def _destination(dest, name):
+    # where name is extracted to under dest, refusing any name that would land outside it
+    parts = name.split('/')
+    root = os.path.realpath(dest)
+    if name.startswith('/') or os.path.isabs(name) or os.pardir in parts or \
+            os.path.commonpath([root, os.path.realpath(os.path.join(root, *parts))]) != root:
+        raise Exception(f'Refusing to extract {name}: it is outside {dest}')
+    return os.path.join(dest, *parts)
+
+
+def manifest(archive):
+    '''
+    manifest : The manifest embedded in an archive,
+        {'run_dir', 'files': {name: {'offset', 'size', 'checksum'}}, 'dirs': {name: {'offset'}}}
+    '''
+    with open(archive, 'rb') as file:
+        file.seek(-FOOTER.size, os.SEEK_END)
+        magic, length, tag, offset = FOOTER.unpack(file.read(FOOTER.size))
+        if magic != SKIPPABLE_MAGIC or tag != FOOTER_TAG:
+            raise Exception(f'{archive} is not a run archive (no manifest)')
+        with _member(file, offset) as (info, content):
+            return json.load(content)
+
+
+def extract(archive, names, dest='.', contents=None):
+    '''
+    extract : Some files (or directories) of an archive, decompressing only their frames
+        names - the files (paths in the run directory), e.g. ['infiles/Lake_Level.dat']
+        dest - directory to write them in, under their paths
+        contents - the archive's manifest, if read already
+        Each file is streamed to disk as it's decompressed and checked against
+        its checksum before it replaces anything there.
+        Returns their paths under dest.
+    '''
+    contents = contents or manifest(archive)
+    files, directories = contents['files'], contents.get('dirs', {})
+    missing = [name for name in names if name not in files and name not in directories]
+    if missing:
+        raise Exception(f'Not in {archive}: {missing}')
+    paths = [_destination(dest, name) for name in names]
+
+    extracted = []
+    with open(archive, 'rb') as file:
+        for name, path in zip(names, paths):
+            entry = files[name] if name in files else directories[name]
+            with _member(file, entry['offset']) as (info, data):
+                if info.name.rstrip('/') != name:
+                    raise Exception(f'{name} in {archive} is not where its manifest has it')
+                if info.isdir():
+                    os.makedirs(path, exist_ok=True)
+                else:
+                    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                    digest = hashlib.blake2b(digest_size=16)
+                    with open(path + '.partial', 'wb') as out:
+                        for chunk in iter(lambda: data.read(COPY_CHUNK), b''):
+                            digest.update(chunk)
+                            out.write(chunk)
+                    if digest.hexdigest() != entry['checksum']:
+                        os.unlink(path + '.partial')
+                        raise Exception(f'{name} in {archive} does not match its checksum')
+                    os.replace(path + '.partial', path)
+            os.chmod(path, info.mode)
+            os.utime(path, (info.mtime, info.mtime))
+            extracted.append(path)
+    return extracted
@@ -0,0 +1,50 @@
+#  Multi-Bay Batch Prep of the AEM3D Lake Model Inputs
+#
+#  MB, STA and ILS read the same gauges and the same GFS forecast, each for
+#  its own climate zones.  A batch fetches the upstream data once, for the
+#  union of the bays' zones, derives the forcing they share once (the spliced
+#  gauge flows and the GFS forecast in AEM3D units, see sharedforcing()), then
+#  preps every bay from that one in-memory bundle, the bays in parallel.
+#
+#  Each bay writes into its own run directory, set on it beforehand.
+
+from lib import logger
+from .AEM3D_prep_IAM import AEM3D_prep_IAM, fetchdata, sharedforcing
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def batchzones(bays):
+    '''
+    batchzones : The union of the bays' climate zones, {zone name: (lat, lon)}
+    '''
+    zones = {}
+    for bay in bays:
+        for zone, coords in bay.zonecoords().items():
+            if zones.setdefault(zone, coords) != coords:
+                raise Exception(f'Climate zone {zone} is at {zones[zone]} and {coords} in batch bays')
+    return zones
+
+
+def batch(forecastDate, bays, max_workers=None, **options):
+    '''
+    batch : Prep several bays from one fetch of the upstream data
+        bays - the bays (IAMBAY), each with its own run_dir, infile_dir and template_dir
+        max_workers - bays prepped at once (default all of them)
+        options - for AEM3D_prep_IAM (incremental, resolution, zonefiles, ...)
+        Returns {bayid: AEM3D_prep_IAM's return}.
+    '''
+    bays = list(bays)
+    runs = [bay.run_dir for bay in bays]
+    if len(set(runs)) != len(runs):
+        raise Exception(f'Batch bays need run directories of their own: {runs}')
+
+    zones = batchzones(bays)
+    logger.info(f'Batch prep of {[bay.bayid for bay in bays]} for zones {list(zones)}')
+    sources = sharedforcing(fetchdata(forecastDate, zones=zones), zones)
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(bays), thread_name_prefix='bay') as pool:
+        futures = {bay.bayid: pool.submit(AEM3D_prep_IAM, forecastDate=forecastDate, theBay=bay,
+                                          sources=sources, **options)
+                   for bay in bays}
+        return {bayid: future.result() for bayid, future in futures.items()}
@@ -0,0 +1,87 @@
+#  Scenario Ensembles of the AEM3D Lake Model Input Prep
+#
+#  Management scenarios (e.g. 0, 20 and 40% P reduction) differ only in the
+#  water quality they feed the lake.  An ensemble preps the bay once (the flow
+#  and climate data are downloaded, decoded and written once), then writes
+#  every scenario's water quality and control files into its own copy of the
+#  run directory, the scenarios in parallel across a process pool:
+#
+#       <ensemble_dir>/<scenario>/      a ready to run AEM3D directory
+#
+#  Scenarios are {name: p_redux}, p_redux the fraction of the CQ phosphorus
+#  kept, or read from a p_reductions.csv (see reductions()).
+
+from lib import logger
+from .AEM3D_prep_IAM import AEM3D_prep_IAM, PREP_MANIFEST_FILE, PREP_STATE_FILE, gencntlfile
+from .waterquality import genwqfiles
+from .workspace import clonetree, writablefor
+
+import os
+import shutil
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+P_REDUCTIONS_FILE = 'p_reductions.csv'   # percent P reduction by year (rows) and scenario (columns)
+
+
+def reductions(path=P_REDUCTIONS_FILE, year=None):
+    '''
+    reductions : The scenarios of a p_reductions.csv, as {scenario: p_redux}
+        path - csv with a 'year' column and a column of percent reductions per
+               scenario, e.g. year,0_redux,20_redux,40_redux (as RCA's bcseries.r read)
+        year - the row to use (default the last one)
+    '''
+    table = pd.read_csv(path, delimiter=',', index_col='year')
+    if not len(table.columns):
+        raise Exception(f'No P reduction scenarios in {path}')
+    row = table.iloc[-1] if year is None else table.loc[year]
+    return {str(scenario): (100 - percent) / 100 for scenario, percent in row.items()}
+
+
+def prepscenario(forecastDate, variant, base_run_dir):
+    '''
+    prepscenario : Write one scenario's run directory (in a pool worker)
+        variant - the scenario's bay (see ensemble()), writing into its own run_dir
+        base_run_dir - the prepped run directory it starts as a copy of
+    '''
+    logger.info(f'Writing scenario p_redux={variant.p_redux} in {variant.run_dir}')
+    shutil.rmtree(variant.run_dir, ignore_errors=True)
+    clonetree(base_run_dir, variant.run_dir, writablefor(variant), ignore=[PREP_MANIFEST_FILE, PREP_STATE_FILE])
+    genwqfiles(variant)
+    gencntlfile(forecastDate, variant)
+    return variant.run_dir
+
+
+def ensemble(forecastDate, theBay, scenarios, ensemble_dir=None, max_workers=None, **options):
+    '''
+    ensemble : Prep the bay once, then write every scenario into its own run directory
+        scenarios - {name: p_redux}, or the path of a p_reductions.csv (its last year)
+        ensemble_dir - where the scenarios go (default <run_dir>-ensemble, next to the run directory)
+        max_workers - processes writing scenarios (default one per CPU)
+        options - for AEM3D_prep_IAM (incremental, resolution, sourcefiles, ...)
+        Returns {scenario: run directory}.
+    '''
+    if isinstance(scenarios, str):
+        scenarios = reductions(scenarios)
+    if not scenarios:
+        raise Exception('Ensemble needs one or more scenarios')
+
+    AEM3D_prep_IAM(forecastDate=forecastDate, theBay=theBay, **options)
+    ensemble_dir = ensemble_dir or os.path.normpath(theBay.run_dir) + '-ensemble'
+
+    # each scenario's bay: the prepped flows and temps, none of the forcing
+    #   store (only the water quality is rewritten), written whole
+    variants = {}
+    for name, p_redux in scenarios.items():
+        variant = theBay.variant(os.path.join(ensemble_dir, str(name)))
+        variant.p_redux = p_redux
+        variant.forcing = None
+        variant.appendfrom = None
+        variant.manifest = None
+        variant.history = None
+        variants[name] = variant
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {name: pool.submit(prepscenario, forecastDate, variant, theBay.run_dir)
+                   for name, variant in variants.items()}
+        return {name: future.result() for name, future in futures.items()}
@@ -0,0 +1,228 @@
+#  Aligned Forcing Store for the AEM3D Lake Model Input Prep
+#
+#  Observations (USGS, Colchester Reef, BTV) and forecasts (NWM, GFS) arrive as
+#  separate series, each on its own clock.  Rather than concat/merge/reindex them
+#  again for every zone and every file, each group of series sharing a clock is
+#  spliced once into a ForcingFrame:
+#
+#       time   - one sorted time axis shared by every variable in the frame
+#       values - {variable: float64 array (zones, time)}, contiguous along time
+#       valid  - {variable: bool array (zones, time)}: where each series has a value
+#
+#  A variable's series for one zone is its valid rows, in time order.  How
+#  observations and forecast meet is set per splice (see align.py); by default
+#  it's what pd.concat([observed, forecast]) produced when the observations end
+#  before the forecast starts.
+#
+#  The store hangs off the bay object (IAMBAY.forcing), one frame per clock,
+#  e.g. 'flow' (USGS + NWM), 'met' (Colchester Reef + GFS), 'lcd' (BTV + GFS).
+
+import numpy as np
+import pandas as pd
+
+from . import align
+
+
+class ForcingFrame:
+    '''
+    Variables x zones on one shared time axis.
+    '''
+
+    def __init__(self, zones):
+        self.zones = list(zones)
+        self.time = pd.DatetimeIndex([], name='time')
+        self.values = {}
+        self.valid = {}
+
+    @property
+    def variables(self):
+        return list(self.values)
+
+    def _extend(self, times):
+        # grow the time axis to include times (int64 ns arrays), moving what's already stored
+        stamps = np.unique(np.concatenate([align.stamps(self.time)] + list(times)))
+        if len(stamps) == len(self.time):
+            return
+
+        time = pd.DatetimeIndex(stamps.view('datetime64[ns]'), name='time')
+        positions = np.searchsorted(stamps, align.stamps(self.time))
+        for variable in self.values:
+            values = np.full((len(self.zones), len(time)), np.nan)
+            valid = np.zeros(values.shape, dtype=bool)
+            values[:, positions] = self.values[variable]
+            valid[:, positions] = self.valid[variable]
+            self.values[variable], self.valid[variable] = values, valid
+        self.time = time
+
+    def splice(self, variable, observed=None, forecast={}, overlap='forecast'):
+        '''
+        Add (or replace) a variable from observations followed by forecasts.
+            observed - Series shared by every zone, or {zone: Series}
+            forecast - {zone: Series}, or a DataFrame with a column per zone
+                       (zones on the same times are spliced as one block)
+            overlap - how each zone's seam is spliced, one of align.OVERLAP_POLICIES;
+                      by default observations are used up to the forecast's first time
+            Zones with neither stay empty.  Where a series repeats a timestamp,
+            the first value is kept.
+        '''
+        if isinstance(forecast, pd.DataFrame):
+            if not isinstance(observed, dict) and overlap != 'blend':
+                return self._spliceblock(variable, observed, forecast, overlap)
+            forecast = {zone: forecast[zone] for zone in forecast.columns}
+
+        # each distinct series (the shared observations especially) is sorted and deduplicated once
+        located = {}
+        def locate(series):
+            if series is None or not len(series):
+                return None
+            if id(series) not in located:
+                located[id(series)] = align.dedupe(*align.arrays(series))
+            return located[id(series)]
+
+        empty = (np.array([], dtype='int64'), np.array([]))
+        spliced = []
+        for zone in self.zones:
+            obs = locate(observed.get(zone) if isinstance(observed, dict) else observed)
+            fc = locate(forecast.get(zone))
+            if obs is None and fc is None:
+                spliced.append(empty)
+            else:
+                spliced.append(align.splice(obs or empty, fc or empty, overlap))
+
+        self._extend([times for times, _ in spliced])
+        axis = align.stamps(self.time)
+
+        row = np.full((len(self.zones), len(self.time)), np.nan)
+        rowvalid = np.zeros(row.shape, dtype=bool)
+        for z, (times, values) in enumerate(spliced):
+            pos = np.searchsorted(axis, times)
+            row[z, pos] = values
+            rowvalid[z, pos] = True
+        self.values[variable], self.valid[variable] = row, rowvalid
+        return self
+
+    def _spliceblock(self, variable, observed, forecast, overlap):
+        # every forecast zone on the same times, after the same observations: the
+        #   seam is found once and each side is placed for all zones in one go
+        fc_t = align.stamps(forecast.index)
+        order = np.argsort(fc_t, kind='stable')
+        fc_t = fc_t[order]
+        first = np.concatenate([[True], fc_t[1:] != fc_t[:-1]]) if len(fc_t) else np.ones(0, dtype=bool)
+        fc_t, block = fc_t[first], forecast.to_numpy(dtype='float64', na_value=np.nan)[order][first]
+
+        if observed is not None and len(observed):
+            obs_t, obs_v = align.dedupe(*align.arrays(observed))
+        else:
+            obs_t, obs_v = np.array([], dtype='int64'), np.array([])
+        obs_keep = np.ones(len(obs_t), dtype=bool)
+        fc_keep = np.ones(len(fc_t), dtype=bool)
+        if len(obs_t) and len(fc_t) and obs_t[-1] >= fc_t[0]:
+            if overlap == 'forecast':
+                obs_keep = obs_t < fc_t[0]
+            else:
+                fc_keep = fc_t > obs_t[-1]
+
+        self._extend([obs_t, fc_t])
+        axis = align.stamps(self.time)
+        obs_pos = np.searchsorted(axis, obs_t)
+        fc_pos = np.searchsorted(axis, fc_t[fc_keep])
+
+        row = np.full((len(self.zones), len(self.time)), np.nan)
+        rowvalid = np.zeros(row.shape, dtype=bool)
+        zones = np.array([self.zones.index(zone) for zone in forecast.columns], dtype='int64')
+        others = np.setdiff1d(np.arange(len(self.zones)), zones)
+
+        # zones without a forecast take all the observations
+        row[np.ix_(others, obs_pos)] = obs_v
+        rowvalid[np.ix_(others, obs_pos)] = True
+        row[np.ix_(zones, obs_pos[obs_keep])] = obs_v[obs_keep]
+        rowvalid[np.ix_(zones, obs_pos[obs_keep])] = True
+        row[np.ix_(zones, fc_pos)] = block[fc_keep].T
+        rowvalid[np.ix_(zones, fc_pos)] = True
+        self.values[variable], self.valid[variable] = row, rowvalid
+        return self
+
+    def series(self, variable, zone):
+        '''
+        The valid rows of one variable for one zone, indexed by time.
+        '''
+        z = self.zones.index(zone)
+        mask = self.valid[variable][z]
+        return pd.Series(self.values[variable][z, mask], index=self.time[mask], name=variable)
+
+    def periods(self, frequency='MS'):
+        '''
+        Slices of the time axis, one per calendar period (see align.periods()),
+            for reading the frame a chunk at a time with table() and block().
+        '''
+        return align.periods(align.stamps(self.time), frequency)
+
+    def table(self, variables, zone, how='outer', rows=slice(None)):
+        '''
+        Several variables for one zone as a DataFrame, like a join of their series:
+            how='outer' - rows where any of them is valid (NaN where one isn't)
+            how='inner' - rows where all of them are valid
+            rows - slice of the time axis to take them from (default all of it)
+        '''
+        z = self.zones.index(zone)
+        valid = np.array([self.valid[variable][z, rows] for variable in variables])
+        mask = valid.all(axis=0) if how == 'inner' else valid.any(axis=0)
+        return pd.DataFrame({variable: self.values[variable][z, rows][mask] for variable in variables},
+                            index=self.time[rows][mask])
+
+    def block(self, variables, zones, rows=slice(None)):
+        '''
+        Several variables for several zones as one DataFrame, on the rows where
+            all of them are valid; columns are zone by zone, variable by variable.
+            rows - slice of the time axis to take them from (default all of it)
+        '''
+        z = np.array([self.zones.index(zone) for zone in zones], dtype='int64')
+        mask = np.logical_and.reduce([self.valid[variable][z, rows].all(axis=0) for variable in variables])
+        columns = pd.MultiIndex.from_product([zones, variables], names=['zone', 'variable'])
+        data = np.stack([self.values[variable][z, rows][:, mask] for variable in variables], axis=1)
+        return pd.DataFrame(data.reshape(len(zones) * len(variables), -1).T,
+                            index=self.time[rows][mask], columns=columns)
+
+    def lookup(self, variable, zone, times):
+        '''
+        Values of one variable for one zone at the given times.
+            Returns (mask, values): which times the series has a value at, and those values.
+        '''
+        z = self.zones.index(zone)
+        pos = self.time.get_indexer(times)
+        mask = pos >= 0
+        mask[mask] = self.valid[variable][z, pos[mask]]
+        return mask, self.values[variable][z, pos[mask]]
+
+    def at(self, variable, zone, times, method='nearest'):
+        '''
+        One variable for one zone aligned to other times (by align.ALIGN_METHODS),
+            as a Series indexed by those times.
+        '''
+        z = self.zones.index(zone)
+        mask = self.valid[variable][z]
+        values = align.align(align.stamps(self.time[mask]), self.values[variable][z, mask],
+                             align.stamps(times), method)
+        return pd.Series(values, index=times, name=variable)
+
+
+class ForcingStore:
+    '''
+    The bay's forcing frames by name.
+    '''
+
+    def __init__(self):
+        self.frames = {}
+
+    def frame(self, name, zones):
+        '''
+        A new, empty frame called name for the given zones (replacing any old one).
+        '''
+        self.frames[name] = ForcingFrame(zones)
+        return self.frames[name]
+
+    def __getitem__(self, name):
+        return self.frames[name]
+
+    def __contains__(self, name):
+        return name in self.frames
@@ -0,0 +1,243 @@
+#  Handoff of Prep Intermediates Between Workflow Jobs
+#
+#  The prep's intermediates (the upstream data bundle, the bay's flow, temp and
+#  lake frames and its forcing store) otherwise only live inside one process.
+#  Here they're written as Arrow IPC (Feather v2) files, uncompressed, so a job
+#  on another node memory maps them and reads the columns without copying:
+#
+#       <handoff_dir>/sources/          fetchdata()'s bundle (see savesources())
+#       <handoff_dir>/bay/              the bay: bay.json, a .arrow file per frame
+#                                       and forcing/<frame>.arrow (see savebay())
+#
+#  so fetch, prep and water quality can run as separate workflow jobs, e.g.
+#
+#       fetch:  savesources(fetchdata(...), handoff_dir)
+#       prep:   AEM3D_prep_IAM(..., sources=loadsources(handoff_dir), stages=PREP_JOB_STAGES)
+#               savebay(bay, handoff_dir)
+#       wq:     bay = loadbay(handoff_dir); prepstages(forecastDate, bay, WQ_JOB_STAGES)
+#               saveprepstate(forecastDate, bay)
+#
+#  The prep job stops before the water quality and control files, which only
+#  the wq job writes.
+
+from lib import IAMBAY, PrepManifest
+from .forcing import ForcingStore, ForcingFrame
+from .align import Resolution
+from .AEM3D import AppendHistory
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:
+    pyarrow = None
+
+HANDOFF_STATE = 'bay.json'
+HANDOFF_INDEX = 'index.json'
+BAY_FRAMES = ['flowdf', 'tempdf', 'lakedf']                 # the bay's DataFrames
+BAY_OBJECTS = BAY_FRAMES + ['forcing', 'manifest', 'history', 'resolution', 'templates']
+
+
+def _arrow():
+    if pyarrow is None:
+        raise Exception('pyarrow is not installed; it is needed to hand prep intermediates between jobs')
+    return pyarrow
+
+
+def writetable(path, frame):
+    '''
+    writetable : A DataFrame as an uncompressed Arrow IPC (Feather v2) file
+    '''
+    pa = _arrow()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    pa.feather.write_feather(pa.Table.from_pandas(frame, preserve_index=True), path + '.partial',
+                             compression='uncompressed')
+    os.replace(path + '.partial', path)
+
+
+def readtable(path):
+    '''
+    readtable : A DataFrame from an Arrow IPC file, memory mapped; numeric
+        columns without nulls are views of the mapped file, not copies
+    '''
+    pa = _arrow()
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks=True)
+
+
+def saveframe(path, frame):
+    '''
+    saveframe : A ForcingFrame as an Arrow IPC file: its time axis, then each
+        variable's values and valid rows per zone
+    '''
+    columns = {'time': frame.time}
+    for variable in frame.variables:
+        for z, zone in enumerate(frame.zones):
+            columns[f'{variable}|{zone}'] = frame.values[variable][z]
+            columns[f'{variable}|{zone}|valid'] = frame.valid[variable][z]
+    writetable(path, pd.DataFrame(columns))
+    with open(path + '.json', 'w') as file:
+        json.dump({'zones': frame.zones, 'variables': frame.variables}, file)
+
+
+def loadframe(path):
+    '''
+    loadframe : A ForcingFrame saved by saveframe()
+    '''
+    with open(path + '.json', 'r') as file:
+        layout = json.load(file)
+    table = readtable(path)
+    frame = ForcingFrame(layout['zones'])
+    frame.time = pd.DatetimeIndex(table['time'], name='time')
+    for variable in layout['variables']:
+        frame.values[variable] = np.stack([table[f'{variable}|{zone}'].to_numpy(dtype='float64')
+                                           for zone in frame.zones])
+        frame.valid[variable] = np.stack([table[f'{variable}|{zone}|valid'].to_numpy(dtype=bool)
+                                          for zone in frame.zones])
+    return frame
+
+
+def _save(value, directory):
+    # a bundle entry: dicts as directories, DataFrames and ForcingFrames as files
+    os.makedirs(directory, exist_ok=True)
+    index = {}
+    for n, (key, entry) in enumerate(value.items()):
+        name = os.path.join(directory, str(n))
+        if isinstance(entry, dict):
+            _save(entry, name)
+            index[key] = 'dict'
+        elif isinstance(entry, ForcingFrame):
+            saveframe(name + '.arrow', entry)
+            index[key] = 'forcing'
+        elif isinstance(entry, (pd.DataFrame, pd.Series)):
+            writetable(name + '.arrow', entry.to_frame() if isinstance(entry, pd.Series) else entry)
+            index[key] = 'series' if isinstance(entry, pd.Series) else 'table'
+        else:
+            raise Exception(f'Cannot hand off {key}: {type(entry).__name__}')
+    with open(os.path.join(directory, HANDOFF_INDEX), 'w') as file:
+        json.dump(list(index.items()), file, indent=1)
+
+
+def _load(directory):
+    with open(os.path.join(directory, HANDOFF_INDEX), 'r') as file:
+        index = json.load(file)
+    value = {}
+    for n, (key, kind) in enumerate(index):
+        name = os.path.join(directory, str(n))
+        if kind == 'dict':
+            value[key] = _load(name)
+        elif kind == 'forcing':
+            value[key] = loadframe(name + '.arrow')
+        else:
+            value[key] = readtable(name + '.arrow')
+            if kind == 'series':
+                value[key] = value[key].iloc[:, 0]
+    return value
+
+
+def savesources(sources, handoff_dir):
+    '''
+    savesources : fetchdata()'s bundle (and any shared forcing derived into it) for other jobs
+    '''
+    directory = os.path.join(handoff_dir, 'sources')
+    shutil.rmtree(directory, ignore_errors=True)
+    _save(sources, directory)
+
+
+def loadsources(handoff_dir):
+    '''
+    loadsources : A bundle saved by savesources(), for AEM3D_prep_IAM(sources=...)
+    '''
+    return _load(os.path.join(handoff_dir, 'sources'))
+
+
+def _setstate(value):
+    # sets (e.g. the sourcelist) as {'set': [...]} in the bay's json
+    if isinstance(value, set):
+        return {'set': list(value)}
+    raise TypeError(f'Cannot hand off {type(value).__name__}')
+
+
+def _loadset(entry):
+    return set(entry['set']) if list(entry) == ['set'] else entry
+
+
+def savebay(theBay, handoff_dir):
+    '''
+    savebay : The bay as prepped so far: its settings and registered files, its
+        flow, temp and lake frames and its forcing store
+    '''
+    directory = os.path.join(handoff_dir, 'bay')
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+    state = {name: value for name, value in theBay.__getstate__().items() if name not in BAY_OBJECTS}
+    state['frames'] = [name for name in BAY_FRAMES if getattr(theBay, name) is not None]
+    for name in state['frames']:
+        writetable(os.path.join(directory, name + '.arrow'), getattr(theBay, name))
+
+    state['forcing'] = list(theBay.forcing.frames) if theBay.forcing is not None else None
+    for name in state['forcing'] or []:
+        saveframe(os.path.join(directory, 'forcing', name + '.arrow'), theBay.forcing[name])
+
+    state['manifest'] = theBay.manifest.path if theBay.manifest is not None else None
+    history = theBay.history
+    state['history'] = None if history is None else {
+        'cutoff': history.cutoff,
+        'previous': history.previous,
+        'files': history.files
+    }
+    resolution = theBay.resolution
+    state['resolution'] = None if resolution is None else {
+        'tiers': [[f'{age}ns', f'{every}ns'] for age, every in resolution.tiers],
+        'reference': int(resolution.reference),
+        'aggregation': resolution.aggregation
+    }
+    with open(os.path.join(directory, HANDOFF_STATE), 'w') as file:
+        json.dump(state, file, indent=1, default=_setstate)
+
+
+def loadbay(handoff_dir):
+    '''
+    loadbay : A bay saved by savebay(), ready for the stages that follow
+    '''
+    directory = os.path.join(handoff_dir, 'bay')
+    with open(os.path.join(directory, HANDOFF_STATE), 'r') as file:
+        state = json.load(file, object_hook=_loadset)
+
+    theBay = IAMBAY(bayid=state['bayid'])
+    for name in state.pop('frames'):
+        setattr(theBay, name, readtable(os.path.join(directory, name + '.arrow')))
+
+    forcing = state.pop('forcing')
+    if forcing is not None:
+        theBay.forcing = ForcingStore()
+        for name in forcing:
+            theBay.forcing.frames[name] = loadframe(os.path.join(directory, 'forcing', name + '.arrow'))
+
+    manifest = state.pop('manifest')
+    theBay.manifest = PrepManifest(manifest) if manifest is not None else None
+    history = state.pop('history')
+    if history is not None:
+        theBay.history = AppendHistory(history['cutoff'], history['previous'])
+        theBay.history.files.update(history['files'])
+    resolution = state.pop('resolution')
+    if resolution is not None:
+        theBay.resolution = Resolution(resolution['tiers'], pd.Timestamp(resolution['reference']),
+                                       resolution['aggregation'])
+
+    state['bayfiles'] = [tuple(entry) for entry in state['bayfiles']]
+    state['_fileorder'] = [tuple(entry) for entry in state['_fileorder']]
+    for name, value in state.items():
+        # sets come back from the json as new sets, which can iterate in another
+        #   order; one equal to the set IAMBAY() made (e.g. the sourcelist) is left
+        #   as that, so files list the sources as a bay made in one job does
+        if not (isinstance(value, set) and value == getattr(theBay, name, None)):
+            setattr(theBay, name, value)
+    return theBay
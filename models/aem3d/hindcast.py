@@ -0,0 +1,98 @@
+#  Hindcasts (Backfills) of the AEM3D Lake Model Input Prep
+#
+#  Regenerates the inputs of past forecast dates, a run directory per date:
+#
+#       <hindcast_dir>/<YYYYMMDD>/      the prepped run for that forecast date
+#
+#  The observations (USGS, BTV, Colchester Reef) of every date in the range
+#  are the same series, ending at different days, so they're fetched once, up
+#  to the last date, and preloaded into each worker process; each date takes
+#  the ones before its own forecast start.  The forecasts (NWM, GFS) are that
+#  date's own, fetched by the worker preparing it.
+
+from lib import logger
+from .AEM3D_prep_IAM import (AEM3D_prep_IAM, PREP_MANIFEST_FILE, PREP_STATE_FILE,
+                             fetchdata, datetimeToOrdinal)
+from .workspace import clonetree, writablefor
+
+import os
+import shutil
+import datetime as dt
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+OBSERVED_SOURCES = ['usgs', 'btv', 'colchester']   # fetchdata() sources shared by every date
+FORECAST_SOURCES = ['nwm', 'gfs']                  # fetched for each date
+FORECAST_DAYS = 7                                  # days past the forecast start the run ends
+
+_observed = None   # in each worker process, the observations preloaded for every date
+
+
+def hindcastdates(start, end):
+    '''
+    hindcastdates : The forecast dates from start to end, inclusive, a day apart
+    '''
+    if end < start:
+        raise Exception(f'Hindcast ends ({end}) before it starts ({start})')
+    return [start + dt.timedelta(days=day) for day in range((end - start).days + 1)]
+
+
+def asof(observed, forecastDate):
+    '''
+    asof : The observations before a forecast date's start (midnight), as fetched for it
+        observed - a bundle of DataFrames / Series indexed by time, or dicts of them
+    '''
+    if isinstance(observed, dict):
+        return {name: asof(value, forecastDate) for name, value in observed.items()}
+    return observed[observed.index < pd.Timestamp(forecastDate)]
+
+
+def _preload(observed):
+    global _observed
+    _observed = observed
+
+
+def prepdate(forecastDate, theBay, template_dir, options):
+    '''
+    prepdate : Prep one forecast date in its own run directory (in a pool worker)
+        theBay - the date's bay, writing into its own run_dir
+        template_dir - the run directory it starts as a copy of
+    '''
+    logger.info(f'Hindcast of {forecastDate} in {theBay.run_dir}')
+    shutil.rmtree(theBay.run_dir, ignore_errors=True)
+    clonetree(template_dir, theBay.run_dir, writablefor(theBay), ignore=[PREP_MANIFEST_FILE, PREP_STATE_FILE])
+
+    sources = asof(_observed, forecastDate)
+    sources.update(fetchdata(forecastDate, names=FORECAST_SOURCES, zones=theBay.zonecoords()))
+    AEM3D_prep_IAM(forecastDate=forecastDate, theBay=theBay, sources=sources, **options)
+    return theBay.run_dir
+
+
+def hindcast(start, end, theBay, hindcast_dir=None, max_workers=None, **options):
+    '''
+    hindcast : Prep every forecast date from start to end, each in its own run directory
+        theBay - the bay, its run directory the template every date's starts from
+        hindcast_dir - where the dates go (default <run_dir>-hindcast, next to the run directory)
+        max_workers - dates prepped at once (default one per CPU)
+        options - for AEM3D_prep_IAM (resolution, zonefiles, sourcefiles, ...)
+        Returns {forecast date: run directory}.
+    '''
+    dates = hindcastdates(start, end)
+    hindcast_dir = hindcast_dir or os.path.normpath(theBay.run_dir) + '-hindcast'
+    options = dict(options, incremental=False)     # every date is written whole
+
+    logger.info(f'Hindcast of {len(dates)} dates, {dates[0]} to {dates[-1]}, in {hindcast_dir}')
+    observed = fetchdata(dates[-1], names=OBSERVED_SOURCES)
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_preload, initargs=(observed,)) as pool:
+        futures = {}
+        for forecastDate in dates:
+            bay = theBay.variant(os.path.join(hindcast_dir, forecastDate.strftime('%Y%m%d')))
+            bay.LastDate = datetimeToOrdinal(dt.datetime.combine(forecastDate + dt.timedelta(days=FORECAST_DAYS),
+                                                                 dt.datetime.min.time()))
+            bay.forcing = None
+            bay.appendfrom = None       # AEM3D_prep_IAM sets these up in the date's own run directory
+            bay.manifest = None
+            bay.history = None
+            futures[forecastDate] = pool.submit(prepdate, forecastDate, bay, theBay.run_dir, options)
+        return {forecastDate: future.result() for forecastDate, future in futures.items()}
@@ -0,0 +1,258 @@
+#  Derived Forcing Kernels for the AEM3D Lake Model Input Prep
+#
+#  Unit conversions, wind from its U/V components, the rain/snow partition,
+#  DO saturation and the lake level regression are written here once, as
+#  formulas over named arrays:
+#
+#       WIND_SPEED = 'sqrt(U10**2 + V10**2)'
+#
+#  A Kernels set evaluates all its formulas in one pass over whole arrays.
+#  Inputs can be (zones, time) blocks, so every zone is done at once, and
+#  per-zone parameters broadcast as (zones, 1) columns.  Formulas may use the
+#  results of formulas listed before them.
+#
+#  numexpr evaluates the formulas when it's installed (one pass over memory,
+#  no temporaries); otherwise numpy does, from formulas compiled once.
+
+import numpy as np
+import pandas as pd
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# functions and constants the formulas can use (numexpr knows the same names)
+FUNCTIONS = {
+    'sqrt': np.sqrt,
+    'exp': np.exp,
+    'log': np.log,
+    'log10': np.log10,
+    'arctan2': np.arctan2,
+    'where': np.where
+}
+CONSTANTS = {
+    'pi': np.pi
+}
+
+
+class Kernels:
+    '''
+    A set of derived variables, {name: formula}, evaluated in order.
+
+        engine - 'numexpr' or 'numpy'; default numexpr when it's installed
+    '''
+
+    def __init__(self, formulas, engine=None):
+        self.formulas = dict(formulas)
+        self.engine = engine or ('numexpr' if numexpr is not None else 'numpy')
+        if self.engine == 'numexpr' and numexpr is None:
+            raise Exception('numexpr engine asked for, but numexpr is not installed')
+
+        self.code = {name: compile(formula, f'<kernel {name}>', 'eval')
+                     for name, formula in self.formulas.items()}
+
+        # names read from outside: everything a formula uses that isn't a
+        #   function, a constant or an earlier formula's result
+        self.inputs = []
+        made = set()
+        for name, code in self.code.items():
+            for used in code.co_names:
+                if used not in FUNCTIONS and used not in CONSTANTS and used not in made \
+                        and used not in self.inputs:
+                    self.inputs.append(used)
+            made.add(name)
+
+    def __call__(self, **arrays):
+        '''
+        Evaluate every formula.
+            arrays - the inputs by name: arrays (broadcastable against each
+                     other) or scalars
+            Returns {name: array} for every formula.
+        '''
+        missing = [name for name in self.inputs if name not in arrays]
+        if missing:
+            raise Exception(f'Kernel inputs missing: {missing}')
+
+        names = dict(CONSTANTS)
+        names.update({name: np.asarray(value, dtype='float64') for name, value in arrays.items()})
+        results = {}
+        for name, formula in self.formulas.items():
+            if self.engine == 'numexpr':
+                results[name] = numexpr.evaluate(formula, local_dict=names)
+            else:
+                results[name] = eval(self.code[name], {'__builtins__': {}, **FUNCTIONS}, names)
+            names[name] = results[name]
+        return results
+
+
+def parameters(table, defaults):
+    '''
+    Kernel parameters for every row of a table of parameter sets, as (sets, 1)
+        columns, so results get a leading (sets,) axis.
+        table - DataFrame, a row per set
+        defaults - {name: value}, for the names the table leaves out (or blank)
+    '''
+    return {name: (table[name].fillna(value).to_numpy(dtype='float64') if name in table
+                   else np.full(len(table), value, dtype='float64'))[:, None]
+            for name, value in defaults.items()}
+
+
+def stack(frames, columns):
+    '''
+    Columns of per-zone DataFrames as (zones, time) blocks for Kernels.
+        frames - {zone: DataFrame}, all on the same time index
+        Returns (index, {column: array}).
+    '''
+    frames = list(frames.values())
+    index = frames[0].index
+    for frame in frames[1:]:
+        if not frame.index.equals(index):
+            raise Exception('Zone frames are not on the same times; evaluate them one zone at a time')
+    return index, {column: np.stack([frame[column].to_numpy(dtype='float64', na_value=np.nan)
+                                     for frame in frames])
+                   for column in columns}
+
+
+def unstack(index, zones, block, name=None):
+    '''
+    A (zones, time) block back to {zone: Series}.
+    '''
+    block = np.broadcast_to(block, (len(zones), len(index)))
+    return {zone: pd.Series(block[z], index=index, name=name) for z, zone in enumerate(zones)}
+
+
+def zonal(kernels, frames, zones=None, **parameters):
+    '''
+    Evaluate kernels on every zone's DataFrame, in one pass over (zones, time)
+        blocks when the zones share their times, else zone by zone.
+        frames - {zone: DataFrame}, one DataFrame shared by the given zones, or
+                 a wide DataFrame with (variable, zone) columns
+        parameters - extra inputs, broadcast against the blocks (e.g. (zones, 1))
+        Returns {name: {zone: Series}}; for a wide frame, {name: DataFrame} with
+            a column per zone.
+    '''
+    if isinstance(frames, pd.DataFrame) and frames.columns.nlevels == 2:
+        zones = list(zones) if zones is not None else list(frames.columns.unique(1))
+        results = kernels(**{column: frames[column][zones].to_numpy(dtype='float64', na_value=np.nan).T
+                             for column in kernels.inputs if column not in parameters},
+                          **parameters)
+        return {name: pd.DataFrame(np.broadcast_to(block, (len(zones), len(frames.index))).T,
+                                   index=frames.index, columns=zones)
+                for name, block in results.items()}
+
+    if isinstance(frames, pd.DataFrame):
+        results = kernels(**{column: frames[column].to_numpy(dtype='float64', na_value=np.nan)
+                             for column in kernels.inputs if column not in parameters},
+                          **parameters)
+        return {name: unstack(frames.index, zones, block, name) for name, block in results.items()}
+
+    zones = list(frames)
+    if all(frames[zone].index.equals(frames[zones[0]].index) for zone in zones):
+        index, blocks = stack(frames, [name for name in kernels.inputs if name not in parameters])
+        results = kernels(**blocks, **parameters)
+        return {name: unstack(index, zones, block, name) for name, block in results.items()}
+
+    results = {name: {} for name in kernels.formulas}
+    for zone in zones:
+        frame = frames[zone]
+        for name, values in kernels(**{column: frame[column].to_numpy(dtype='float64', na_value=np.nan)
+                                         for column in kernels.inputs if column not in parameters},
+                                      **parameters).items():
+            results[name][zone] = pd.Series(values, index=frame.index, name=name)
+    return results
+
+
+#
+#   The prep's derived variables
+#
+
+# GFS forecast per zone to AEM3D units
+#   T2: K to C; RAIN: kg/m^2/s (mm/s) to m/day; TCDC, RH2: percent to fraction
+#   wind: U (east) and V (north) at 10m to speed and the compass direction
+#         it blows from, 𝜙 = 180 + (180/𝜋) * atan2(u, v)
+GFS_FORCING = Kernels({
+    'T2': 'T2 - 273.15',
+    'RAIN': 'RAIN * 86.4',
+    'TCDC': 'TCDC / 100.0',
+    'RH2': 'RH2 * .01',
+    'WIND_SPEED': 'sqrt(U10**2 + V10**2)',
+    'WIND_DIR': '180 + arctan2(U10, V10) * 180 / pi'
+})
+
+# Colchester Reef observations: RH2 percent to fraction; wind speed scaled by
+#   each zone's exposure
+CR_FORCING = Kernels({
+    'RH2': 'RH2 * .01',
+    'WIND_SPEED': 'WSPEED * exposure'
+})
+
+# BTV LCD observations: RAIN inches/hr to m/day (* 24 * 0.0254)
+BTV_FORCING = Kernels({
+    'RAIN': 'RAIN * 0.6096'
+})
+
+# Snow water from rain and air temp (C), by the BTV GHCN SNOW/PRCP ratio fit
+#   (see Pat's rainToSnow.R), none above -2.0 C
+SNOW = Kernels({
+    'SNOW': 'where(TEMP > -2.0, 0.0, RAIN * exp(2.1413626 - 0.1921400*TEMP - 0.0079924*TEMP*TEMP))'
+})
+
+# Saturated dissolved oxygen (mg/L) at the water temp (C)
+#   (Rich 1973 from Henderson-Sellers 1984, Engineering Limnology)
+DO_SATURATION = Kernels({
+    'DO': '14.652 - 4.1022e-1 * WTR_TEMP + 7.991e-3 * WTR_TEMP**2 - 7.77774e-5 * WTR_TEMP**3'
+})
+
+# Lake level (ft) regressed on air temp (C) and Missisquoi flow with its 7, 30
+#   and 60 sample means, bias corrected by the quadratic fit of the residuals
+#   against observed levels, then as meters above 93ft for AEM3D
+LAKE_LEVEL = Kernels({
+    'LakeLevel': 'll_0 + ll_T2 * T2 + ll_msflow * msflow + ll_07 * flowmean_07'
+                 ' + ll_30 * flowmean_30 + ll_60 * flowmean_60',
+    'LakeLevel_corrected': 'LakeLevel + (bias_0 + bias_1 * LakeLevel + bias_2 * LakeLevel**2)',
+    'LakeLevel_delta': '(LakeLevel_corrected - 93) * 0.3048'
+})
+LAKE_LEVEL_COEFFICIENTS = {
+    'll_0': 94.05887,
+    'll_T2': 0.007910834,
+    'll_msflow': 7.034478e-05,
+    'll_07': 0.003396492,
+    'll_30': 0.01173037,
+    'll_60': 0.0258206,
+    'bias_0': -358.51020205,
+    'bias_1': 7.16150850,
+    'bias_2': -0.03570562
+}
+
+# Total phosphorus (mg/L) by each source's CQ model: log10 TP (ug/L) is a
+#   quadratic in log10 of its watershed's flow (BREE2021Quad, Takis' stream fits),
+#   none on low flow days (the log blows the concentration up)
+TP_CQ = Kernels({
+    'TP': 'where(lowflow > 0, 0.0, 10**(a + b * logQ + c * logQ * logQ) * p_redux / 1000)'
+})
+
+# Phosphorus species from TP (updated 2021.05.27 per WQS Docs): PO4 and DOPL are
+#   power laws of TP, POPL either its own fraction or the rest of TP
+P_SPECIES = Kernels({
+    'PO4': 'po4 * TP**po4_exp',
+    'DOPL': 'dopl * TP**dopl_exp',
+    'POPL': 'where(popl_rest > 0, TP - PO4 - DOPL, popl * TP)'
+})
+
+# Nitrogen (mg N/L) on Missisquoi flow (Clelia Marti, June 2020; species updated
+#   2021.05.27 per WQS Docs), the same for every source
+NITROGEN = Kernels({
+    'zTN': '(msflow - 166.3734) / 138.1476',
+    'TN': '0.00407 * zTN**2 + 0.12853 * zTN + 0.75675',
+    'NH4': '0.1 * TN',
+    'NO3': '0.3 * TN',
+    'DONL': '0.1 * TN',
+    'PONL': '0.475 * TN'
+})
+
+# Suspended solids group 1 (mg/L) on Missisquoi flow, the same for every source
+SOLIDS = Kernels({
+    'zSS': '(msflow - 170.0903) / 142.1835',
+    'SSOL1': '17.7558 * zSS**2 + 59.5663 * zSS + 48.0127'
+})
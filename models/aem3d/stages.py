@@ -0,0 +1,151 @@
+#  Stage Graph for the AEM3D Lake Model Input Prep
+#
+#  Each prep step is declared as a Stage with the names of what it needs
+#  (inputs) and what it makes (outputs).  A stage becomes runnable once every
+#  stage producing one of its inputs has finished, so stages that don't depend
+#  on each other (e.g. the template files and the flow series) overlap in a
+#  thread pool.
+#
+#  Names are just labels shared between stages, e.g. 'flowdf', 'tempdf',
+#  'bayfiles'.  An input may be produced by several stages (every file writer
+#  outputs 'bayfiles'), in which case the consumer waits for all of them.
+#  Inputs nobody produces (e.g. 'forecastDate') are taken as given.
+#
+#  Files registered with IAMBAY.addfile() inside a stage are ranked by the
+#  stage's position in the declaration, which keeps the control file order
+#  deterministic.
+#
+#  A stage that only writes files can be given a key, a hash of everything it
+#  reads.  With a PrepManifest on the bay, a stage that last finished with the
+#  same key, and whose files are untouched since, is skipped and its files are
+#  registered again as they were, so a rerun after a failure picks up at the
+#  first stage that still has work to do.  With an AppendHistory on the bay
+#  (see AEM3D.py) the digests its files were written with are kept with the
+#  stage and recorded again too, so a skipped stage's files can still be
+#  appended to by the next incremental prep; a stage whose digests were taken
+#  for another forecast start is run again.
+#
+#  Only some of the stages can be run, the rest taken as done, e.g. when the
+#  prep is split into workflow jobs that each run a part of it on a bay handed
+#  from the last (see handoff.py).  They keep their declared ranks.
+
+from lib import logger
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import os
+
+
+class Stage:
+    '''
+    One step of the prep.
+
+        name - stage name (for logs)
+        func - callable with no arguments that does the work
+        inputs - names this stage reads
+        outputs - names this stage produces
+        key - callable returning a hash of the stage's inputs, for stages
+              that only write files (see PrepManifest)
+    '''
+
+    def __init__(self, name, func, inputs=(), outputs=(), key=None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.key = key
+
+
+class StageGraph:
+    '''
+    A set of stages and the dependencies implied by their inputs and outputs.
+        Stages must be declared after the stages they depend on.
+    '''
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+        producers = {}
+        self.dependencies = {}
+        for stage in self.stages:
+            if stage.name in self.dependencies:
+                raise Exception(f'Stage {stage.name} declared twice')
+            self.dependencies[stage.name] = {p for name in stage.inputs for p in producers.get(name, [])}
+            for name in stage.outputs:
+                producers.setdefault(name, []).append(stage.name)
+
+        # an input produced by a stage declared later would be a cycle or an ordering mistake
+        for i, stage in enumerate(self.stages):
+            later = {o for s in self.stages[i + 1:] for o in s.outputs}
+            missing = set(stage.inputs) & later
+            if missing:
+                raise Exception(f'Stage {stage.name} needs {sorted(missing)} from a stage declared after it')
+
+    def run(self, theBay=None, max_workers=4, only=None):
+        '''
+        Run every stage, overlapping independent stages on max_workers threads.
+            only - names of the stages to run (default all of them); the
+                   others are taken as done already
+            If theBay is given, each stage runs inside theBay.stage(rank) so its
+            registered files keep the declared stage order, and stages with a
+            key are skipped when theBay.manifest says they're up to date.
+            The first stage failure is raised once running stages have finished.
+        '''
+
+        rank = {stage.name: i for i, stage in enumerate(self.stages)}
+        if only is not None and set(only) - set(rank):
+            raise Exception(f'No such stages: {sorted(set(only) - set(rank))}')
+        waiting = [stage for stage in self.stages if only is None or stage.name in only]
+        done = {stage.name for stage in self.stages} - {stage.name for stage in waiting}
+        running = {}
+
+        manifest = None if theBay is None else theBay.manifest
+        history = None if theBay is None else theBay.history
+
+        def call(stage):
+            if theBay is None:
+                logger.info(f'Prep stage {stage.name} started')
+                stage.func()
+                logger.info(f'Prep stage {stage.name} finished')
+                return
+
+            with theBay.stage(rank[stage.name]):
+                key = None
+                if manifest is not None and stage.key is not None:
+                    key = stage.key()
+                    files = manifest.stagefiles(stage.name, key, theBay.infile_dir)
+                    if files is not None and history is not None and \
+                            not history.restore(manifest.stagehistory(stage.name)):
+                        files = None
+                    if files is not None:
+                        for fname, ftype in files:
+                            theBay.addfile(fname=fname, ftype=ftype)
+                        logger.info(f'Prep stage {stage.name} is up to date, skipping')
+                        return
+                    manifest.forgetstage(stage.name)
+
+                logger.info(f'Prep stage {stage.name} started')
+                stage.func()
+                if key is not None:
+                    files = theBay.stagefiles(rank[stage.name])
+                    manifest.recordstage(stage.name, key, files, history and history.entries(
+                        [os.path.join(theBay.infile_dir, fname) for fname, _ in files]))
+                logger.info(f'Prep stage {stage.name} finished')
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while waiting or running:
+                for stage in [s for s in waiting if self.dependencies[s.name] <= done]:
+                    waiting.remove(stage)
+                    running[pool.submit(call, stage)] = stage
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        logger.info(f'Prep stage {stage.name} failed')
+                        wait(running)
+                        if manifest is not None:
+                            manifest.save()     # keep what finished for a rerun
+                        raise error
+                    done.add(stage.name)
+                    if manifest is not None:
+                        manifest.save()
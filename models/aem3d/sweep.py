@@ -0,0 +1,97 @@
+#  Parameter Sweeps of the AEM3D Lake Model Input Prep
+#
+#  Calibration varies the phosphorus CQ coefficients, p_redux and the lake
+#  level regression coefficients.  A sweep preps the bay once (the flow and
+#  climate data are loaded and written once), then evaluates every set of
+#  coefficients at once, as a leading (sets,) axis on the kernels' arrays, and
+#  writes each set's variant of the files they change into its own copy of
+#  the run directory:
+#
+#       <sweep_dir>/<set name>/     the prepped run, with the set's WQ P and
+#                                   Lake_Level files and sweep_parameters.json
+#
+#  The table of sets has a row per set, indexed by its name, with columns
+#  (ones left out, or blank, keep the prep's values):
+#
+#       p_redux             fraction of the CQ phosphorus kept
+#       <CQ model>.a|b|c    allocation.CQ_MODELS coefficients, e.g. MissisquoiRiver.b
+#       ll_*, bias_*        kernels.LAKE_LEVEL_COEFFICIENTS
+
+from lib import logger
+from .AEM3D_prep_IAM import (AEM3D_prep_IAM, PREP_MANIFEST_FILE, PREP_STATE_FILE,
+                             lakelevels, writelakelevel)
+from .allocation import SourceAllocation, CQ_MODELS
+from . import kernels
+from .workspace import clonetree, writablefor
+
+import os
+import json
+import shutil
+import pandas as pd
+
+SWEEP_FILE = 'sweep_parameters.json'   # in each variant's run directory, the set it was written with
+
+
+def parameters(table):
+    '''
+    parameters : A table of coefficient sets, checked
+        table - DataFrame, a row per set indexed by set name, or the path of a .csv of one
+    '''
+    if isinstance(table, str):
+        table = pd.read_csv(table, index_col=0)
+    table = table.set_axis(table.index.astype(str), axis=0)
+
+    known = {'p_redux', *kernels.LAKE_LEVEL_COEFFICIENTS,
+             *(f'{model}.{key}' for model in CQ_MODELS for key in ['a', 'b', 'c'])}
+    unknown = [column for column in table.columns if column not in known]
+    if unknown:
+        raise Exception(f'Unknown sweep parameters: {unknown}')
+    if not table.index.is_unique or not len(table):
+        raise Exception('Sweep needs one or more parameter sets with distinct names')
+    return table
+
+
+def sweep(forecastDate, theBay, table, sweep_dir=None, **options):
+    '''
+    sweep : Prep the bay once, then write every coefficient set's variant into its own run directory
+        table - the coefficient sets (see parameters())
+        sweep_dir - where the variants go (default <run_dir>-sweep, next to the run directory)
+        options - for AEM3D_prep_IAM (incremental, resolution, sourcefiles, ...)
+        Returns {set name: variant run directory}.
+    '''
+    table = parameters(table)
+    AEM3D_prep_IAM(forecastDate=forecastDate, theBay=theBay, **options)
+
+    #   every set at once: phosphorus is (sets, time, sources), lake level (sets, time)
+    allocation = SourceAllocation.frombay(theBay)
+    cq, p_redux = allocation.swept(table)
+    phosphorus = allocation.phosphorus(theBay.flowdf, p_redux, cq)
+    levels = lakelevels(theBay.lakedf, kernels.parameters(table, kernels.LAKE_LEVEL_COEFFICIENTS))['LakeLevel_delta']
+
+    flowdates = theBay.flowdf['ordinaldate'].to_numpy()
+    lakedates = theBay.lakedf['ordinaldate'].to_numpy()
+    sweep_dir = sweep_dir or os.path.normpath(theBay.run_dir) + '-sweep'
+
+    variants = {}
+    for k, name in enumerate(table.index):
+        run_dir = os.path.join(sweep_dir, name)
+        logger.info(f'Writing sweep variant {name} in {run_dir}')
+
+        shutil.rmtree(run_dir, ignore_errors=True)
+        clonetree(theBay.run_dir, run_dir, writablefor(theBay), ignore=[PREP_MANIFEST_FILE, PREP_STATE_FILE])
+        variant = theBay.variant(run_dir)
+        variant.appendfrom = None     # variants are written whole
+        variant.manifest = None
+        variant.history = None
+
+        allocation.write(variant, [('WQ_P', 'WQ_P.dat', {species: phosphorus[species][k]
+                                                         for species in ['PO4', 'DOPL', 'POPL']},
+                                    ['PO4', 'DOPL', 'POPL'])],
+                         flowdates)
+        writelakelevel(variant, lakedates, levels[k])
+
+        with open(os.path.join(run_dir, SWEEP_FILE), 'w') as file:
+            json.dump({'name': name, **table.loc[name].dropna().to_dict()}, file, indent=2)
+        variants[name] = run_dir
+
+    return variants
@@ -0,0 +1,251 @@
+#  Run Directory Workspaces for the AEM3D Lake Model Input Prep
+#
+#  Every run starts from the current AEM3D run template (grid, bathymetry,
+#  TEMPLATES, ...) on NFS, and nearly all of it never changes.  Rather than
+#  copying it over the network each run, it's kept in a local cache:
+#
+#       <cache_dir>/                    the template tree, files read only
+#       <cache_dir>.manifest.json       upstream version, and each file's checksum
+#
+#  The cache is refreshed only when the upstream tree changed (a file's size
+#  or modification time), and then only the files that changed are copied.
+#  Before a run directory is cloned from it every cached file is checked
+#  against its checksum, and any that doesn't match is copied again.
+#
+#  Run directories are cloned from it file by file: reflinked when the
+#  filesystem can, so a run directory (or an ensemble of them) costs next to
+#  no disk or time, else copied.  Each clone has its own data, so writing to
+#  it never reaches the cache.
+#
+#  Hard links are opt-in (hardlink=True, or WORKSPACE_HARDLINKS) for the files
+#  the prep doesn't rewrite, where reflinks aren't available.  They share the
+#  cache's data: its files are read only, but that stops neither root nor a
+#  process that opens one for writing anyway, and the next clone would get
+#  the change too.
+
+from lib import logger, PrepManifest
+from .AEM3D_prep_IAM import PREP_MANIFEST_FILE, PREP_STATE_FILE
+
+import os
+import json
+import stat
+import fnmatch
+import hashlib
+import shutil
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+TEMPLATE_UPSTREAM = '/netfiles/ciroh/models/aem3d/current/AEM3D-inputs'   # the current run template
+TEMPLATE_CACHE_DIR = '/data/aem3d/template-cache/AEM3D-inputs'             # its local cache
+
+# files of a run directory the prep (re)writes, as fnmatch patterns of their
+#   paths in it: these are cloned as copies, never links
+WORKSPACE_WRITABLE = ['infiles/*', 'run_aem3d.dat', PREP_STATE_FILE, PREP_MANIFEST_FILE]
+
+# hard link the files not in WORKSPACE_WRITABLE where they can't be reflinked,
+#   rather than copy them (see above)
+WORKSPACE_HARDLINKS = False
+
+FICLONE = 0x40049409      # Linux ioctl: make dst a copy-on-write clone of src
+COPY_CHUNK = 1 << 20
+
+
+def reflink(src, dst):
+    '''
+    reflink : Clone src to dst sharing its data until either is written, if the filesystem can
+        Returns False (and leaves no dst) where it can't.
+    '''
+    if fcntl is None:
+        return False
+    try:
+        with open(src, 'rb') as source, open(dst, 'wb') as clone:
+            fcntl.ioctl(clone.fileno(), FICLONE, source.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.unlink(dst)
+        return False
+
+
+def clonefile(src, dst, writable, hardlink=WORKSPACE_HARDLINKS):
+    '''
+    clonefile : dst as src, replacing whatever was there
+        writable - dst is rewritten by the prep, so never a hard link
+        hardlink - a file that isn't writable may be hard linked where it
+                   can't be reflinked; else dst gets its own data (a copy)
+        Returns how: 'reflink', 'link' or 'copy'.
+    '''
+    if os.path.lexists(dst):
+        os.unlink(dst)      # never write through an old link
+    if reflink(src, dst):
+        how = 'reflink'
+    elif hardlink and not writable and _link(src, dst):
+        return 'link'
+    else:
+        shutil.copyfile(src, dst)
+        how = 'copy'
+    os.chmod(dst, stat.S_IMODE(os.stat(src).st_mode) | stat.S_IWUSR)
+    return how
+
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:         # another filesystem, or no hard links there
+        return False
+
+
+def writablefor(theBay):
+    '''
+    writablefor : WORKSPACE_WRITABLE for a bay's layout (its infile_dir in its run_dir)
+    '''
+    infiles = os.path.relpath(theBay.infile_dir, theBay.run_dir)
+    return [os.path.join(infiles, '*')] + WORKSPACE_WRITABLE[1:]
+
+
+def clonetree(src, dst, writable=WORKSPACE_WRITABLE, ignore=(), hardlink=WORKSPACE_HARDLINKS):
+    '''
+    clonetree : A run directory dst cloned from src (see clonefile())
+        writable - fnmatch patterns of the paths (in src) that are cloned writable
+        ignore - fnmatch patterns of the paths left out
+        hardlink - hard link the other files where they can't be reflinked
+        Returns {'reflink', 'link', 'copy': count of files cloned that way}.
+    '''
+    counts = {'reflink': 0, 'link': 0, 'copy': 0}
+    for root, dirs, files in os.walk(src):
+        os.makedirs(os.path.join(dst, os.path.relpath(root, src)), exist_ok=True)
+        for name in sorted(files):
+            rel = os.path.relpath(os.path.join(root, name), src)
+            if any(fnmatch.fnmatch(rel, pattern) for pattern in ignore):
+                continue
+            counts[clonefile(os.path.join(src, rel), os.path.join(dst, rel),
+                             any(fnmatch.fnmatch(rel, pattern) for pattern in writable), hardlink)] += 1
+    return counts
+
+
+class TemplateCache:
+    '''
+    A local, checksummed cache of the AEM3D run template.
+
+        upstream - the template tree (on NFS)
+        cache_dir - where it's cached
+    '''
+
+    _threadlock = threading.Lock()
+
+    def __init__(self, upstream=TEMPLATE_UPSTREAM, cache_dir=TEMPLATE_CACHE_DIR):
+        self.upstream = upstream
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.normpath(cache_dir) + '.manifest.json'
+
+    @staticmethod
+    def scan(tree):
+        # {path in tree: [size, mtime_ns]} of every file
+        files = {}
+        for root, dirs, names in os.walk(tree):
+            for name in names:
+                path = os.path.join(root, name)
+                status = os.stat(path)
+                files[os.path.relpath(path, tree)] = [status.st_size, status.st_mtime_ns]
+        return files
+
+    @staticmethod
+    def checksum(path):
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(COPY_CHUNK), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @contextmanager
+    def locked(self):
+        # one refresh at a time, across threads and processes sharing the cache
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        with self._threadlock, open(os.path.normpath(self.cache_dir) + '.lock', 'w') as lockfile:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            yield
+
+    def load(self):
+        if not os.path.exists(self.manifest_path):
+            return {'version': None, 'files': {}}
+        with open(self.manifest_path, 'r') as file:
+            return json.load(file)
+
+    def intact(self, rel, entry, verify=False):
+        # the cached copy is as it was written (by size and mtime, or by its checksum)
+        path = os.path.join(self.cache_dir, rel)
+        if not os.path.exists(path):
+            return False
+        status = os.stat(path)
+        if [status.st_size, status.st_mtime_ns] != entry['local']:
+            return False
+        return not verify or self.checksum(path) == entry['checksum']
+
+    def fetch(self, rel):
+        # copy one upstream file into the cache (read only), checksummed as it's read
+        src = os.path.join(self.upstream, rel)
+        dst = os.path.join(self.cache_dir, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        digest = hashlib.blake2b(digest_size=16)
+        partial = dst + '.partial'
+        with open(src, 'rb') as source, open(partial, 'wb') as copy:
+            for chunk in iter(lambda: source.read(COPY_CHUNK), b''):
+                digest.update(chunk)
+                copy.write(chunk)
+        os.chmod(partial, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(partial, dst)
+        status = os.stat(dst)
+        return {'checksum': digest.hexdigest(), 'local': [status.st_size, status.st_mtime_ns]}
+
+    def refresh(self, verify=False):
+        '''
+        Bring the cache up to the upstream version, copying only the files that changed.
+            verify - also check every cached file against its checksum
+            Returns the paths (in the tree) copied.
+        '''
+        with self.locked():
+            upstream = self.scan(self.upstream)
+            version = PrepManifest.key(repr(sorted(upstream.items())))
+            manifest = self.load()
+            if manifest['version'] == version and not verify and \
+                    all(self.intact(rel, entry) for rel, entry in manifest['files'].items()):
+                return []
+
+            files, fetched = {}, []
+            for rel, upstat in sorted(upstream.items()):
+                entry = manifest['files'].get(rel)
+                if entry is not None and entry['upstream'] == upstat and self.intact(rel, entry, verify):
+                    files[rel] = entry
+                    continue
+                files[rel] = dict(self.fetch(rel), upstream=upstat)
+                fetched.append(rel)
+
+            for rel in set(manifest['files']) - set(upstream):
+                path = os.path.join(self.cache_dir, rel)
+                if os.path.exists(path):
+                    os.unlink(path)
+
+            partial = self.manifest_path + '.partial'
+            with open(partial, 'w') as file:
+                json.dump({'upstream': self.upstream, 'version': version, 'files': files}, file, indent=1)
+            os.replace(partial, self.manifest_path)
+
+        logger.info(f'Template cache {self.cache_dir} refreshed, {len(fetched)} of {len(upstream)} files copied')
+        return fetched
+
+    def clone(self, run_dir, writable=WORKSPACE_WRITABLE, hardlink=WORKSPACE_HARDLINKS):
+        '''
+        A run directory from the refreshed cache, every file of it checked
+            against its checksum first (see clonetree()).
+        '''
+        self.refresh(verify=True)
+        counts = clonetree(self.cache_dir, run_dir, writable, ignore=['*.partial'], hardlink=hardlink)
+        logger.info(f'Run directory {run_dir} cloned from {self.cache_dir}: {counts}')
+        return counts